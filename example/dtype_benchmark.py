@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# dtype_benchmark.py: Accuracy and speed of single-precision folding
+# author : Antoine Passemiers
+
+from gaussfold import GaussFold, Optimizer, tm_score
+from gaussfold import PDBParser, SS3Parser, FastaParser, ContactParser
+
+import os
+import time
+import numpy as np
+
+
+DATA_FOLDER = 'data'
+DTYPES = [np.float64, np.float32]
+MODES = ['dense', 'sparse', 'tiled']
+
+
+def fold(dtype, sequence, ssp, acc, cmap, seed=0):
+    np.random.seed(seed)
+    gf = GaussFold(n_top=2.5, corrector='projection', dtype=dtype)
+    gf.optimizer = Optimizer(pop_size=200, n_iter=5000, early_stopping=1000, dtype=dtype)
+    start = time.time()
+    coords = gf.run(np.copy(cmap), ssp, acc, sequence, verbose=False)
+    return gf, coords, time.time() - start
+
+
+if __name__ == '__main__':
+
+    filepath = os.path.join(DATA_FOLDER, 'sequence.fa')
+    sequence = FastaParser().parse(filepath)['sequences'][0]
+    ssp = SS3Parser().parse(os.path.join(DATA_FOLDER, 'ss3.txt')).argmax(axis=1)
+    acc = SS3Parser().parse(os.path.join(DATA_FOLDER, 'acc.txt')).argmax(axis=1)
+    parser = PDBParser(sequence, '1DRBA', method='CA')
+    distances, coords_target = parser.parse(os.path.join(DATA_FOLDER, 'native.pdb'))
+    L = len(sequence)
+    cmap = ContactParser(L, target_cols=[4]).parse(os.path.join(DATA_FOLDER, 'psicov.out'))
+
+    # Fold the protein once in double precision, and evaluate
+    # perturbations of the solution with both types
+    gf, coords, _ = fold(np.float64, sequence, ssp, acc, cmap)
+    model = gf.model
+    rng = np.random.RandomState(0)
+    X = model.get_coords() + rng.normal(0., 1., size=(100,) + coords.shape)
+    print('\nRelative error of the log-likelihood in single precision')
+    for mode in MODES:
+        model.mode = mode
+        model.dtype = np.float64
+        reference = np.asarray([model.evaluate(x) for x in X])
+        model.dtype = np.float32
+        start = time.time()
+        values = np.asarray([model.evaluate(x.astype(np.float32)) for x in X])
+        elapsed = (time.time() - start) / len(X)
+        errors = np.abs(values - reference) / np.abs(reference)
+        print('%-7s max: %.2e, mean: %.2e (%.3f ms per evaluation)' % (
+            mode, errors.max(), errors.mean(), 1000. * elapsed))
+
+    # Fold the protein with both types, from the same random seed
+    print('\nFolding')
+    for dtype in DTYPES:
+        gf, coords, elapsed = fold(dtype, sequence, ssp, acc, cmap)
+        gf.model.dtype = np.float64
+        score = gf.model.evaluate(gf.model.get_coords())
+        tm = tm_score(coords, coords_target)
+        print('%-8s log-likelihood: %.2f, TM-score: %.4f, time: %.1f s' % (
+            np.dtype(dtype).name, score, tm, elapsed))
@@ -1,4 +1,15 @@
+from .adam import *
+from .autoconfig import *
+from .batch import *
+from .continuation import *
 from .core import *
+from .differential_evolution import *
+from .kernels import *
 from .metrics import *
+from .octree import *
 from .optimizer import *
-from .parsers import *
\ No newline at end of file
+from .parsers import *
+from .portfolio import *
+from .replica_exchange import *
+from .smacof import *
+from .torsion import *
\ No newline at end of file
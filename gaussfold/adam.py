@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# adam.py: Stochastic gradient descent over minibatches of restraints
+# author : Antoine Passemiers
+
+from gaussfold.lbfgs import lbfgs
+
+import numpy as np
+
+
+class MinibatchAdam:
+    """Gradient-based optimizer where each step only uses a random
+    minibatch of restraints, so that the cost of a step does not depend
+    on the total number of restraints. Restraints between residues
+    that are close in sequence (the backbone band) are always part of
+    the minibatch, while the other ones are sampled uniformly and
+    reweighted to get an unbiased estimate of the gradient.
+    Coordinates are updated with Adam, with a learning rate decaying
+    geometrically, and are finally polished with full-batch steps.
+
+    Attributes:
+        n_iter (int): Number of minibatch steps.
+        batch_size (int): Number of sampled restraints per step,
+            in addition to the backbone band.
+        band_width (int): Largest sequence separation of the restraints
+            of the backbone band. Requires `segments` to be set.
+        learning_rate (float): Initial learning rate.
+        decay (float): Ratio between the final and the initial
+            learning rates.
+        beta1 (float): Decay rate of the first moment estimates.
+        beta2 (float): Decay rate of the second moment estimates.
+        n_polish (int): Number of full-batch steps at the end,
+            with the final learning rate.
+        eval_every (int): Number of steps between two exact evaluations
+            of the log-likelihood, used to keep track of the best solution.
+        use_lbfgs (bool): Whether to improve local convergence
+            with L-BFGS algorithm.
+        random_state (int): Seed of the random number generator.
+        segments (list): Indices of the residues of each contiguous
+            segment of predicted secondary structure, in sequence order.
+        scores (list): History of best score over time.
+        pop (list): Best solution found during the last run.
+        pop_scores (:obj:`np.ndarray`): Fitness of the solution in `pop`.
+    """
+
+    EPSILON = 1e-8
+
+    def __init__(self, n_iter=5000, batch_size=1024, band_width=3,
+                 learning_rate=0.5, decay=0.01, beta1=0.9, beta2=0.999,
+                 n_polish=200, eval_every=100, use_lbfgs=False,
+                 random_state=None):
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+        self.band_width = band_width
+        self.learning_rate = learning_rate
+        self.decay = decay
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.n_polish = n_polish
+        self.eval_every = eval_every
+        self.use_lbfgs = use_lbfgs
+        self.random_state = random_state
+        self.segments = list()
+        self.sse_segments = list()
+        self.continuation = None
+        self.scores = list()
+        self.pop = None
+        self.pop_scores = None
+
+    def backbone_band(self, model):
+        """Finds the restraints of the backbone band.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model.
+
+        Returns:
+            :obj:`np.ndarray`: Boolean array indicating, for each
+                restrained pair of `model.pair_list()`, whether it
+                belongs to the backbone band.
+        """
+        rows, cols = model.pair_list()[:2]
+        if len(self.segments) == 0:
+            return np.zeros(len(rows), dtype=bool)
+
+        # Position of each atom in the sequence. Atoms that are not
+        # residues of the chain are placed far away from the band.
+        positions = np.full(model.n_atoms, -model.n_atoms * 2)
+        backbone = np.concatenate(self.segments)
+        positions[backbone] = np.arange(len(backbone))
+        separations = np.abs(positions[rows] - positions[cols])
+        return separations <= self.band_width
+
+    def run(self, model, verbose=True, pop=None, scores=None):
+        """Runs minibatch Adam on the current coordinates of a model.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model
+            verbose (bool): Whether to display messages in stdout.
+            pop (list, optional): Solutions to start from, for example
+                the `pop` attribute of a previous run. Optimization
+                starts from the best one.
+            scores (:obj:`np.ndarray`, optional): Fitness of the
+                solutions in `pop`. Computed if not provided.
+
+        Returns:
+            :obj:`np.ndarray`: Optimal solution.
+        """
+        rng = np.random.RandomState(self.random_state)
+        if pop is None:
+            x = model.get_coords()
+        else:
+            if scores is None:
+                scores = np.asarray([model.evaluate(ind) for ind in pop])
+            x = np.copy(pop[np.argmax(scores)])
+
+        band = self.backbone_band(model)
+        band_indices = np.where(band)[0]
+        other_indices = np.where(~band)[0]
+        n_sampled = min(self.batch_size, len(other_indices))
+        weights = np.ones(len(band_indices) + n_sampled)
+        if n_sampled > 0:
+            weights[len(band_indices):] = len(other_indices) / float(n_sampled)
+
+        best_coords, best_score = np.copy(x), model.evaluate(x)
+        self.scores = list()
+        m, v = np.zeros_like(x), np.zeros_like(x)
+        n_steps = self.n_iter + self.n_polish
+        for t in range(1, n_steps + 1):
+            alpha = min(t - 1, self.n_iter) / float(max(self.n_iter, 1))
+            learning_rate = self.learning_rate * self.decay ** alpha
+
+            if t <= self.n_iter:
+                # Backbone band and uniformly sampled restraints
+                sampled = other_indices[rng.randint(0, len(other_indices), size=n_sampled)] \
+                    if n_sampled > 0 else other_indices[:0]
+                indices = np.concatenate((band_indices, sampled))
+                grad = model.gradient_subset(x, indices, weights=weights)
+            else:
+                # Full-batch polishing
+                grad = model.gradient(x)
+
+            m = self.beta1 * m + (1. - self.beta1) * grad
+            v = self.beta2 * v + (1. - self.beta2) * grad ** 2.
+            m_hat = m / (1. - self.beta1 ** t)
+            v_hat = v / (1. - self.beta2 ** t)
+            x = x - learning_rate * m_hat / (np.sqrt(v_hat) + MinibatchAdam.EPSILON)
+
+            if t % self.eval_every == 0 or t == n_steps:
+                score = model.evaluate(x)
+                if score > best_score:
+                    best_coords, best_score = np.copy(x), score
+                self.scores.append(best_score)
+                if verbose and t % (10 * self.eval_every) == 0:
+                    print('[Adam] Log-likelihood at step %i: %f' % (t, score))
+
+        # Fine-tune solution with L-BFGS
+        if self.use_lbfgs:
+            new_coords = lbfgs(best_coords, model, verbose=verbose)
+            new_score = model.evaluate(new_coords)
+            if new_score > best_score:
+                best_coords, best_score = new_coords, new_score
+
+        self.pop, self.pop_scores = [best_coords], np.asarray([best_score])
+
+        # Update coordinates in model
+        model.set_coords(best_coords)
+        return best_coords
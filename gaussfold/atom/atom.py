@@ -18,7 +18,7 @@ class Atom(metaclass=ABCMeta):
         self._identifier = Atom.__n_atoms__
         Atom.__n_atoms__ += 1
         self.bonded_atoms = list()
-        self.coords = np.asarray(list(coords), dtype=np.float)
+        self.coords = np.asarray(list(coords), dtype=np.float64)
         self.charge = q
         
         self._group = Group(self.name)
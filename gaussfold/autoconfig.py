@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# autoconfig.py: Resource-aware choice of hyper-parameters
+# author : Antoine Passemiers
+
+import os
+import numpy as np
+
+
+class ExecutionPlan:
+    """Settings chosen by `AutoConfig` for a given protein.
+
+    Attributes:
+        mode (str): Evaluation mode of the Gaussian model,
+            either 'dense', 'sparse' or 'tiled'.
+        dtype (type): Floating-point type of the Gaussian model
+            and of the population of the optimizer.
+        pop_size (int): Population size of the genetic algorithm.
+        partition_size (int): Partition size for the selection of parents.
+        batch_size (int): Number of new solutions evaluated at once.
+        n_workers (int): Number of folds that can run concurrently,
+            each one in its own process.
+        blas_threads (int): Number of BLAS/OpenMP threads per process.
+            The thread pools of the current process are resized with
+            threadpoolctl, if installed. The environment variables only
+            affect the processes started afterwards.
+    """
+
+    def __init__(self, mode, dtype, pop_size, partition_size, batch_size,
+                 n_workers, blas_threads):
+        self.mode = mode
+        self.dtype = dtype
+        self.pop_size = pop_size
+        self.partition_size = partition_size
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.blas_threads = blas_threads
+
+    def apply(self, model=None, optimizer=None):
+        """Applies the plan to a model, an optimizer, to the
+        thread pools of the current process and to the environment
+        of the processes it starts.
+
+        Parameters:
+            model (:obj:`gaussfold.AminoAcidModel`, optional): Gaussian model.
+            optimizer (:obj:`gaussfold.Optimizer`, optional): Optimizer.
+        """
+        if model is not None:
+            model.mode = self.mode
+            model.dtype = self.dtype
+        if optimizer is not None:
+            # The number of iterations is expressed in batches
+            # of new solutions: keep the same evaluation budget
+            if optimizer.batch_size != self.batch_size:
+                n_evaluations = optimizer.n_iter * optimizer.batch_size
+                optimizer.n_iter = int(np.ceil(n_evaluations / self.batch_size))
+                n_evaluations = optimizer.early_stopping * optimizer.batch_size
+                optimizer.early_stopping = int(np.ceil(n_evaluations / self.batch_size))
+            optimizer.pop_size = self.pop_size
+            optimizer.partition_size = self.partition_size
+            optimizer.batch_size = self.batch_size
+            optimizer.dtype = self.dtype
+
+        # BLAS libraries read these variables when they are loaded, so
+        # that only child processes (e.g. the workers of concurrent folds)
+        # are affected. The current process is limited by threadpoolctl.
+        for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[name] = str(self.blas_threads)
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=self.blas_threads)
+        except ImportError:
+            pass
+
+    def __str__(self):
+        return 'mode=%s, dtype=%s, pop_size=%i, partition_size=%i, batch_size=%i, ' \
+               'workers=%i, blas_threads=%i' % (
+                   self.mode, np.dtype(self.dtype).name, self.pop_size,
+                   self.partition_size, self.batch_size, self.n_workers,
+                   self.blas_threads)
+
+
+class AutoConfig:
+    """Chooses hyper-parameters of the optimizer and of the Gaussian
+    model from the protein size and the available resources.
+
+    Attributes:
+        n_cpus (int): Number of available cores. Detected if not provided.
+        memory_limit (float): Maximum amount of memory, in bytes, that all
+            concurrent folds are allowed to use. Defaults to half of the
+            physical memory.
+        n_workers (int): Number of folds meant to run concurrently.
+        max_pop_size (int): Population size for small proteins.
+        cost_limit (float): Maximum number of restraint evaluations
+            spent on the initial population.
+        workspace_size (float): Memory, in bytes, of the buffers used
+            to evaluate a batch of solutions. Should roughly fit in
+            the last-level cache.
+    """
+
+    # Fraction of pairs with a restraint other than a repulsion
+    # under which pair-list evaluation is chosen
+    SPARSE_DENSITY = 0.75
+
+    # Number of residues above which distances are computed
+    # in single precision
+    FLOAT32_LENGTH = 400
+
+    # Number of restrained pairs under which solutions
+    # are evaluated in batches
+    BATCH_RESTRAINTS = 1000
+
+    def __init__(self, n_cpus=None, memory_limit=None, n_workers=1,
+                 max_pop_size=2000, cost_limit=5e8, workspace_size=32e6):
+        self.n_cpus = n_cpus
+        self.memory_limit = memory_limit
+        self.n_workers = n_workers
+        self.max_pop_size = max_pop_size
+        self.cost_limit = cost_limit
+        self.workspace_size = workspace_size
+
+    def available_cpus(self):
+        if self.n_cpus is not None:
+            return self.n_cpus
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    def available_memory(self):
+        if self.memory_limit is not None:
+            return self.memory_limit
+        try:
+            return 0.5 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return 4e9
+
+    def plan(self, L, n_restraints, n_informative=None):
+        """Creates an execution plan.
+
+        Parameters:
+            L (int): Number of residues in the protein.
+            n_restraints (int): Number of restrained pairs of residues.
+            n_informative (int, optional): Number of restrained pairs whose
+                restraint is not a repulsion. Repulsions usually cover all
+                the other pairs, so that the density of the restraints is
+                measured on these ones. Defaults to `n_restraints`.
+
+        Returns:
+            :obj:`ExecutionPlan`: The chosen settings.
+        """
+        n_cpus = self.available_cpus()
+        n_workers = max(1, min(self.n_workers, n_cpus))
+        blas_threads = max(1, n_cpus // n_workers)
+        memory = self.available_memory() / n_workers
+        n_restraints = max(n_restraints, 1)
+        n_informative = n_restraints if n_informative is None else n_informative
+
+        # Dense evaluation allocates about a dozen (L, L) arrays of doubles,
+        # while tiled evaluation only allocates blocks of pairs. Dense
+        # evaluation is faster as long as these arrays fit in memory
+        n_pairs = max(L * (L - 1) / 2., 1.)
+        density = n_informative / n_pairs
+        dense_memory = 12. * L ** 2. * 8.
+        if density < AutoConfig.SPARSE_DENSITY:
+            mode = 'sparse'
+        elif dense_memory > 0.5 * memory:
+            mode = 'tiled'
+        else:
+            mode = 'dense'
+
+        # Single precision halves memory bandwidth of the pair-list
+        # kernels. Log-likelihoods are still summed in double precision.
+        if mode == 'sparse' and L >= AutoConfig.FLOAT32_LENGTH:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        itemsize = np.dtype(dtype).itemsize
+
+        # Population is bounded by the cost of its initial evaluation
+        # and by the memory it occupies
+        pop_size = min(self.max_pop_size, max(200, 10 * L))
+        pop_size = min(pop_size, int(self.cost_limit / n_restraints))
+        pop_size = min(pop_size, int(0.25 * memory / (3. * L * 8.)))
+        pop_size = max(pop_size, 20)
+
+        # Keep the selection pressure of the default settings
+        # (partitions of 50 individuals among 2000)
+        partition_size = int(np.clip(pop_size // 40, 2, pop_size // 2))
+
+        # Batches only pay off when the per-call overhead dominates,
+        # i.e. for small numbers of restraints. Buffers are kept
+        # to about `workspace_size` bytes.
+        if mode == 'sparse' and n_restraints < AutoConfig.BATCH_RESTRAINTS:
+            batch_size = int(self.workspace_size / (4. * n_restraints * itemsize))
+            batch_size = int(np.clip(batch_size, 1, min(64, pop_size // 4)))
+        else:
+            batch_size = 1
+
+        return ExecutionPlan(mode, dtype, pop_size, partition_size,
+                             batch_size, n_workers, blas_threads)
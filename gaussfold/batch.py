@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# batch.py: Folding of many proteins at once
+# author : Antoine Passemiers
+
+from gaussfold.chain.chain import Chain
+from gaussfold.core import GaussFold
+
+import numpy as np
+
+
+class BatchModel:
+    """Several Gaussian models evaluated together.
+
+    The restrained pairs of all models are stored in padded buffers
+    of shape (n_models, max_n_restraints). Padding pairs have a
+    weight of zero, and coordinates of the models are padded with
+    atoms that are not involved in any restraint. Restraints to the
+    center of mass are padded the same way, and the center of mass
+    of each model only depends on its own atoms.
+
+    Attributes:
+        models (list): Gaussian models (`gaussfold.AminoAcidModel`).
+        n_models (int): Number of models.
+        n_atoms (int): Number of atoms of the largest model.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.n_models = len(models)
+        self.n_atoms = max(model.n_atoms for model in models)
+        n_restraints = max(model.n_restraints for model in models)
+
+        shape = (self.n_models, n_restraints)
+        self._rows = np.zeros(shape, dtype=np.int64)
+        self._cols = np.zeros(shape, dtype=np.int64)
+        self._mu = np.zeros(shape, dtype=np.float64)
+        self._sigma = np.ones(shape, dtype=np.float64)
+        self._weights = np.zeros(shape, dtype=np.float64)
+        for k, model in enumerate(models):
+            rows, cols, mu, sigma, weights = model.pair_list()
+            n = len(rows)
+            self._rows[k, :n], self._cols[k, :n] = rows, cols
+            self._mu[k, :n], self._sigma[k, :n] = mu, sigma
+            self._weights[k, :n] = weights
+
+        n_center = max(len(model.center_list()[0]) for model in models)
+        shape = (self.n_models, n_center)
+        self._center_atoms = np.zeros(shape, dtype=np.int64)
+        self._center_mu = np.zeros(shape, dtype=np.float64)
+        self._center_sigma = np.ones(shape, dtype=np.float64)
+        self._center_weights = np.zeros(shape, dtype=np.float64)
+        self._mask = np.zeros((self.n_models, self.n_atoms), dtype=np.float64)
+        for k, model in enumerate(models):
+            atoms, mu, sigma, weights = model.center_list()
+            n = len(atoms)
+            self._center_atoms[k, :n] = atoms
+            self._center_mu[k, :n], self._center_sigma[k, :n] = mu, sigma
+            self._center_weights[k, :n] = weights
+            self._mask[k, :model.n_atoms] = 1. / model.n_atoms
+
+    def pad(self, coords):
+        """Stacks coordinates of the models into a padded array.
+
+        Parameters:
+            coords (list): Arrays of shape (n_atoms_k, 3), where
+                n_atoms_k is the number of atoms of model k.
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (n_models, n_atoms, 3).
+        """
+        padded = np.zeros((self.n_models, self.n_atoms, 3), dtype=np.float64)
+        for k, x in enumerate(coords):
+            padded[k, :len(x)] = x
+        return padded
+
+    def unpad(self, coords):
+        """Inverse of `pad`."""
+        return [coords[k, :model.n_atoms] for k, model in enumerate(self.models)]
+
+    def _pair_deltas(self, coords):
+        # Flatten all solutions of all models into a single
+        # array of atoms, and offset the pair indices accordingly
+        n_solutions = coords.size // (3 * self.n_atoms * self.n_models)
+        X = np.ascontiguousarray(coords.reshape(-1, 3).T)
+        offsets = np.arange(self.n_models * n_solutions) * self.n_atoms
+        offsets = offsets.reshape(self.n_models, n_solutions, 1)
+        rows = (self._rows[:, np.newaxis, :] + offsets).ravel()
+        cols = (self._cols[:, np.newaxis, :] + offsets).ravel()
+        delta = np.take(X, rows, axis=1)
+        delta -= np.take(X, cols, axis=1)
+        return delta.reshape(3, self.n_models, n_solutions, -1), rows, cols
+
+    def _center_deltas(self, coords):
+        # Vectors going from the center of mass of each model
+        # to its restrained atoms, of shape (n_models, n_solutions, m, 3)
+        coords = coords.reshape(self.n_models, -1, self.n_atoms, 3)
+        center = np.einsum('kn,ksnd->ksd', self._mask, coords)
+        models = np.arange(self.n_models)[:, np.newaxis, np.newaxis]
+        solutions = np.arange(coords.shape[1])[np.newaxis, :, np.newaxis]
+        delta = coords[models, solutions, self._center_atoms[:, np.newaxis, :]]
+        return delta - center[:, :, np.newaxis, :]
+
+    def evaluate(self, coords):
+        """Computes the log-likelihood of one or several solutions per model.
+
+        Parameters:
+            coords (:obj:`np.ndarray`): Array of shape (n_models, n_atoms, 3)
+                or (n_models, n_solutions, n_atoms, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (n_models,) or
+                (n_models, n_solutions) containing log-likelihoods.
+        """
+        delta, _, _ = self._pair_deltas(coords)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        mu = self._mu[:, np.newaxis, :]
+        sigma = self._sigma[:, np.newaxis, :]
+        logp = ((distances - mu) / sigma) ** 2.
+        logp *= self._weights[:, np.newaxis, :]
+        logp = -0.5 * logp.sum(axis=2)
+
+        # Restraints to the center of mass
+        distances = np.sqrt((self._center_deltas(coords) ** 2.).sum(axis=3))
+        mu = self._center_mu[:, np.newaxis, :]
+        sigma = self._center_sigma[:, np.newaxis, :]
+        center_logp = ((distances - mu) / sigma) ** 2.
+        center_logp *= self._center_weights[:, np.newaxis, :]
+        logp -= 0.5 * center_logp.sum(axis=2)
+        return logp.reshape(coords.shape[:-2])
+
+    def gradient(self, coords):
+        """Computes the gradient of the negative log-likelihood
+        of each model with respect to 3D coordinates.
+
+        Parameters:
+            coords (:obj:`np.ndarray`): Array of shape (n_models, n_atoms, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (n_models, n_atoms, 3).
+        """
+        delta, rows, cols = self._pair_deltas(coords)
+        delta = delta.reshape(3, -1)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        F = (distances - self._mu.ravel()) / (distances * self._sigma.ravel() ** 2.)
+        F *= self._weights.ravel()
+        delta *= np.nan_to_num(F)
+
+        size = self.n_models * self.n_atoms
+        grad = np.empty((size, 3), dtype=np.float64)
+        for k in range(3):
+            grad[:, k] = np.bincount(rows, weights=delta[k], minlength=size)
+            grad[:, k] -= np.bincount(cols, weights=delta[k], minlength=size)
+        grad = grad.reshape(self.n_models, self.n_atoms, 3)
+
+        # Restraints to the center of mass, which moves by 1/n_atoms_k
+        # of the displacement of each atom of model k
+        delta = self._center_deltas(coords)[:, 0]
+        distances = np.sqrt((delta ** 2.).sum(axis=2))
+        F = (distances - self._center_mu) / (distances * self._center_sigma ** 2.)
+        F *= self._center_weights
+        forces = np.nan_to_num(F)[..., np.newaxis] * delta
+        models = np.arange(self.n_models)[:, np.newaxis]
+        np.add.at(grad, (models, self._center_atoms), forces)
+        grad -= self._mask[..., np.newaxis] * forces.sum(axis=1)[:, np.newaxis, :]
+        return grad
+
+
+class BatchOptimizer:
+    """Genetic algorithm of `gaussfold.Optimizer`, run simultaneously
+    on several models. At each iteration, one new solution is created
+    per model, and all new solutions are evaluated in one pass.
+
+    Attributes:
+        pop_size (int): Number of solutions kept in memory per model.
+        n_iter (int): Maximum number of iterations.
+        partition_size (int): Partition size for the selection
+            of parents. Each partition elects one of the two parents.
+        mutation_rate (float): Percentage of points in child's solution
+            to be mutated by the given standard deviation.
+        mutation_std (float): Standard deviation of the noise to be
+            added for mutating points coordinates.
+        init_std (float): Standard deviation used to generate the
+            population from an initial solution.
+        early_stopping (int): Maximum number of iterations without
+            score improvement before stopping the algorithm on a model.
+        scores (list): History of best scores over time.
+    """
+
+    def __init__(self, pop_size=2000, n_iter=200000, partition_size=50,
+                 mutation_rate=0.5, mutation_std=0.3, init_std=10.,
+                 early_stopping=300):
+        self.pop_size = pop_size
+        self.n_iter = n_iter
+        self.partition_size = partition_size
+        self.mutation_rate = mutation_rate
+        self.mutation_std = mutation_std
+        self.init_std = init_std
+        self.early_stopping = early_stopping
+        self.scores = list()
+
+    def run(self, model, initial_coords, verbose=True):
+        """Runs the genetic algorithm on all models.
+
+        Parameters:
+            model (:obj:`BatchModel`): Gaussian models.
+            initial_coords (:obj:`np.ndarray`): Array of shape
+                (n_models, n_atoms, 3) of initial solutions.
+            verbose (bool): Whether to display messages in stdout.
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (n_models, n_atoms, 3)
+                containing the best solution of each model.
+        """
+        K, n_atoms = model.n_models, model.n_atoms
+        P, ps = self.pop_size, self.partition_size
+        targets = np.arange(K)
+
+        # Randomly initializes populations and adds initial
+        # solutions to them
+        pop = np.random.normal(0., self.init_std, size=(K, P, n_atoms, 3))
+        pop += initial_coords[:, np.newaxis, :, :]
+        pop[:, -1] = initial_coords
+        scores = np.asarray([model.evaluate(pop[:, i]) for i in range(P)]).T
+
+        self.scores = list()
+        best_scores = np.full(K, -np.inf)
+        best_iterations = np.zeros(K, dtype=np.int64)
+        active = np.ones(K, dtype=bool)
+        for k in range(self.n_iter):
+
+            # Elect a winner in each of the two random partitions,
+            # made of the individuals with the smallest random keys
+            keys = np.random.rand(K, P)
+            indices = np.argpartition(keys, (ps - 1, 2 * ps - 1), axis=1)[:, :2*ps]
+            partition_scores = scores[targets[:, np.newaxis], indices]
+            left = indices[targets, np.argmax(partition_scores[:, :ps], axis=1)]
+            right = indices[targets, ps + np.argmax(partition_scores[:, ps:], axis=1)]
+
+            # Apply the cross-over and mutation operators
+            alpha = np.random.randint(0, 2, size=(K, n_atoms, 1))
+            children = alpha * pop[targets, left] + (1. - alpha) * pop[targets, right]
+            mutations = np.random.normal(0., self.mutation_std, size=(K, n_atoms, 3))
+            mutations *= (np.random.rand(K, n_atoms, 1) < self.mutation_rate)
+            children += mutations
+            children_scores = model.evaluate(children)
+
+            # Replace worst solutions of the models that are still optimized
+            worst = np.argmin(scores, axis=1)
+            pop[targets[active], worst[active]] = children[active]
+            scores[targets[active], worst[active]] = children_scores[active]
+
+            # Check if improvement
+            improved = active & (children_scores > best_scores)
+            best_scores[improved] = children_scores[improved]
+            best_iterations[improved] = k
+            if verbose and (k + 1) % 100 == 0:
+                print('Mean log-likelihood at iteration %i: %f (%i models left)' \
+                    % (k + 1, best_scores.mean(), active.sum()))
+            self.scores.append(np.copy(best_scores))
+
+            # Stop optimizing models with no more improvement
+            active &= (k - best_iterations < self.early_stopping)
+            if not active.any():
+                break
+
+        return pop[targets, np.argmax(scores, axis=1)]
+
+
+class BatchFold:
+    """Folds collections of proteins by grouping proteins of similar
+    lengths and optimizing their Gaussian models together.
+
+    Attributes:
+        gf (:obj:`gaussfold.GaussFold`): Object used to build the initial
+            structures and the Gaussian models.
+        optimizer (:obj:`BatchOptimizer`): Optimizer run on each group.
+        bucket_width (int): Maximum difference of length between
+            proteins of a same group.
+        max_batch_size (int): Maximum number of proteins per group.
+    """
+
+    def __init__(self, gf=None, optimizer=None, bucket_width=16, max_batch_size=64):
+        self.gf = GaussFold() if gf is None else gf
+        self.optimizer = BatchOptimizer() if optimizer is None else optimizer
+        self.bucket_width = bucket_width
+        self.max_batch_size = max_batch_size
+
+    def buckets(self, lengths):
+        """Groups proteins by length.
+
+        Parameters:
+            lengths (list): Number of residues of each protein.
+
+        Returns:
+            list: Groups of protein indices.
+        """
+        buckets = list()
+        for i in np.argsort(lengths, kind='stable'):
+            if len(buckets) == 0 or len(buckets[-1]) >= self.max_batch_size or \
+                    lengths[i] - lengths[buckets[-1][0]] > self.bucket_width:
+                buckets.append(list())
+            buckets[-1].append(i)
+        return buckets
+
+    def prepare(self, cmap, ssp, acc, seq):
+        """Builds the residue chain, the Gaussian model and the initial
+        solution of a protein.
+
+        Parameters:
+            cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                predicted contact probabilities.
+            ssp (:obj:`np.ndarray`): 3-state secondary structure prediction.
+            acc (:obj:`np.ndarray`): 3-state solvent accessibility prediction.
+            seq (str): Protein primary structure.
+
+        Returns:
+            tuple: Chain, Gaussian model and initial solution.
+        """
+        L = len(cmap)
+        cmap = np.array(cmap, dtype=np.float64)
+        cmap[np.isnan(cmap)] = 0.
+        np.fill_diagonal(cmap, 0)
+        _, gds, _ = self.gf.contact_graph(cmap)
+        initial_coords = self.gf.embed(gds, verbose=False)
+        chain = Chain.from_string(seq, c='CA')
+        weights = np.ones((L, L), dtype=np.float64)
+        model = self.gf.create_model(chain, cmap, gds, ssp, acc, weights)
+        for i in range(len(chain)):
+            chain[i].ref().set_coords(*initial_coords[i])
+        return chain, model, model.get_coords()
+
+    def run(self, targets, verbose=True):
+        """Folds a collection of proteins.
+
+        Parameters:
+            targets (list): List of tuples (cmap, ssp, acc, seq), with the
+                same meaning as the parameters of `GaussFold.run`.
+            verbose (bool): Whether to display messages in stdout.
+
+        Returns:
+            list: Arrays of shape (L, 3) representing each protein
+                in the 3D space, in the order of `targets`.
+        """
+        results = [None] * len(targets)
+        lengths = [len(seq) for _, _, _, seq in targets]
+        for bucket in self.buckets(lengths):
+            if verbose:
+                print('Fold %i proteins of length %i to %i' % (
+                    len(bucket), lengths[bucket[0]], lengths[bucket[-1]]))
+            chains, models, initial_coords = list(), list(), list()
+            for i in bucket:
+                chain, model, coords = self.prepare(*targets[i])
+                chains.append(chain)
+                models.append(model)
+                initial_coords.append(coords)
+
+            batch = BatchModel(models)
+            best_coords = self.optimizer.run(
+                    batch, batch.pad(initial_coords), verbose=verbose)
+            for i, chain, model, coords in zip(bucket, chains, models, batch.unpad(best_coords)):
+                model.set_coords(coords)
+                results[i] = np.asarray([chain[j].ref().get_coords() for j in range(len(chain))])
+        return results
@@ -5,6 +5,15 @@
 from gaussfold.constraints.gaussian_constraint import GaussianConstraint
 
 
+# Average and standard deviation of the distance between
+# residues i and i + k (k = 1, 2, ...) in an alpha helix
+HELIX_DISTANCES = [(3.82, 0.35), (5.48, 0.14), (5.20, 0.14), (6.28, 0.26), (8.75, 0.26)]
+
+# Average and standard deviation of the distance between
+# residues i and i + k (k = 1, 2, ...) in a beta strand
+STRAND_DISTANCES = [(3.80, 0.28), (6.74, 0.28), (10.10, 0.32), (13.30, 1.41)]
+
+
 class DistanceRestraint(GaussianConstraint):
 
     def __init__(self, atom_a, atom_b, mu, sigma, **kwargs):
@@ -11,10 +11,11 @@ class GaussianConstraint(metaclass=ABCMeta):
 
     __CENTER_OF_MASS__ = DummyAtom('center of mass')
 
-    def __init__(self, atom_a, atom_b, weight=1.):
+    def __init__(self, atom_a, atom_b, weight=1., label=None):
         self.atom_a = atom_a
         self.atom_b = atom_b
         self._weight = weight
+        self._label = label
 
     def atoms(self):
         return (self.atom_a, self.atom_b)
@@ -29,3 +30,8 @@ class GaussianConstraint(metaclass=ABCMeta):
 
     def weight(self):
         return self._weight
+
+    def label(self):
+        """Name of the class of restraints the constraint belongs to,
+        used to break energies down. Defaults to the name of its type."""
+        return type(self).__name__ if self._label is None else self._label
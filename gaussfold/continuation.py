@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# continuation.py: Progressive tightening of the Gaussian model
+# author : Antoine Passemiers
+
+import numpy as np
+
+
+class Continuation:
+    """Continuation schedule of the Gaussian model. The first stage
+    optimizes a smoothed log-likelihood, where standard deviations
+    of all restraints are inflated and only the contacts with the
+    highest predicted probabilities are restrained. Standard deviations
+    are then tightened and lower-ranked contacts are added at each stage,
+    until the original model is recovered at the last stage.
+
+    Attributes:
+        n_stages (int): Number of stages, including the last one
+            where the model is unchanged.
+        sigma_scale (float): Factor applied to standard deviations
+            during the first stage. The factor decreases geometrically
+            down to 1 at the last stage.
+        min_fraction (float): Fraction of the contact restraints used
+            during the first stage. The fraction increases linearly
+            up to 1 at the last stage.
+        contacts (list): Groups of contact restraints, by decreasing
+            predicted contact probability. Each group contains the
+            restraints of a same pair of residues.
+    """
+
+    def __init__(self, n_stages=4, sigma_scale=3., min_fraction=0.25):
+        self.n_stages = n_stages
+        self.sigma_scale = sigma_scale
+        self.min_fraction = min_fraction
+        self.contacts = list()
+        self._n_active = 0
+
+    def set_contacts(self, contacts, probabilities):
+        """Sets the contact restraints to be progressively added.
+        All of them are assumed to be part of the model.
+
+        Parameters:
+            contacts (list): Groups of contact restraints. Each group
+                contains the restraints of a same pair of residues,
+                in the order they were added to the model.
+            probabilities (list): Predicted probability of each contact.
+        """
+        order = np.argsort(-np.asarray(probabilities), kind='stable')
+        self.contacts = [contacts[i] for i in order]
+        self._n_active = len(self.contacts)
+
+    def parameters(self, stage):
+        """Returns the settings of a given stage.
+
+        Parameters:
+            stage (int): Stage index, between 0 and `n_stages` - 1.
+
+        Returns:
+            tuple: Factor applied to standard deviations, and number
+                of groups of contact restraints in the model.
+        """
+        if self.n_stages <= 1:
+            return 1., len(self.contacts)
+        alpha = min(stage, self.n_stages - 1) / float(self.n_stages - 1)
+        sigma_scale = self.sigma_scale ** (1. - alpha)
+        fraction = self.min_fraction + alpha * (1. - self.min_fraction)
+        n_active = int(np.ceil(fraction * len(self.contacts)))
+        return sigma_scale, n_active
+
+    def apply(self, model, stage):
+        """Updates the model for a given stage. Only the contact
+        restraints that enter or leave the model are updated.
+
+        Parameters:
+            model (:obj:`gaussfold.AminoAcidModel`): Gaussian model.
+            stage (int): Stage index, between 0 and `n_stages` - 1.
+        """
+        sigma_scale, n_active = self.parameters(stage)
+        added, removed = list(), list()
+        for group in self.contacts[n_active:self._n_active]:
+            removed += group
+        for group in self.contacts[self._n_active:n_active]:
+            added += group
+        self._n_active = n_active
+        model.update_constraints(added=added, removed=removed)
+        model.sigma_scale = sigma_scale
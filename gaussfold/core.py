@@ -2,14 +2,20 @@
 # core.py: GDE-GaussFold core algorithm
 # author : Antoine Passemiers
 
+from gaussfold import kernels
 from gaussfold.aa import Glycine, Cysteine
+from gaussfold.autoconfig import AutoConfig
 from gaussfold.chain.chain import Chain
 from gaussfold.constraints import *
-from gaussfold.corrector import DeviationCorrector
+from gaussfold.corrector import DeviationCorrector, ProjectionCorrector
 from gaussfold.graph import Graph
+from gaussfold.initializers import classical_mds, insert_fragments
 from gaussfold.model.amino_acid_model import AminoAcidModel
 from gaussfold.model.all_atom_model import AllAtomModel
 from gaussfold.optimizer import Optimizer
+from gaussfold.portfolio import Portfolio
+from gaussfold.smacof import sparse_smacof
+from gaussfold.torsion import TorsionModel
 
 import numpy as np
 import random
@@ -28,15 +34,49 @@ class GaussFold:
             Multi-Dimensional Scaling algorithm.
         eps (float): Convergence threshold of Multi-Dimensional
             Scaling algorithm.
+        fragments (bool): Whether to replace predicted helices and
+            strands of the initial embedding by ideal fragments.
+        corrector (str): Correction of adjacent residues applied to
+            the initial embedding. Either 'deviation' (parabola fitting)
+            or 'projection' (fast iterative projection).
+        torsion_space (bool): Whether the optimizer searches the
+            pseudo bond angles and torsion angles of the C-alpha trace,
+            with fixed C-alpha - C-alpha distances, instead of Cartesian
+            coordinates. Only `Optimizer` is supported in this space,
+            with angle-scale mutations (see `angle_mutation_std` and
+            `angle_init_std`). Segment operators and repair are disabled,
+            and the Newton refinement, the alignment of parents and the
+            canonicalization of the population are not supported.
+        dtype (type, optional): Floating-point type of the Gaussian
+            model, of the population of the optimizer and of the
+            projection corrector, for example `np.float32` to halve
+            memory traffic. Log-likelihoods are summed in double
+            precision. Defaults to double precision, or to the type
+            chosen by the auto-configuration if any.
+        backend (str, optional): Kernel backend used to evaluate the
+            Gaussian model, either 'auto', 'numpy' or 'numba'. Defaults
+            to the backend selected with `gaussfold.kernels.set_backend`.
     """
 
-    def __init__(self, sep=1, n_runs=1, max_n_iter=300, eps=1e-3, n_top=2.5):
+    MAX_GRAPH_DISTANCE = 14
+
+    def __init__(self, sep=1, n_runs=1, max_n_iter=300, eps=1e-3, n_top=2.5,
+                 fragments=False, corrector='deviation', torsion_space=False,
+                 dtype=None, backend=None):
         self.sep = sep
         self.n_runs = n_runs
         self.max_n_iter = max_n_iter
         self.eps = eps
+        self.fragments = fragments
+        self.corrector = corrector
+        self.torsion_space = torsion_space
+        self.dtype = dtype
+        self.backend = backend
         self._model = None
         self._optimizer = None
+        self._portfolio = None
+        self._auto_config = None
+        self._result = None
         self._n_top = int(np.round(n_top))
 
     def run(self, cmap, ssp, acc, seq, verbose=True):
@@ -60,15 +100,263 @@ class GaussFold:
                 protein in the 3D space.
         """
         L = len(cmap)
+        self.check_torsion_space()
+
+        if self.backend is not None:
+            kernels.set_backend(self.backend)
+        if verbose:
+            print('[Backend] %s' % kernels.describe_backend())
 
         # Set diagonal to zeros
         cmap = np.asarray(cmap)
         cmap[np.isnan(cmap)] = 0.
         np.fill_diagonal(cmap, 0)
 
+        A, gds, n_top = self.contact_graph(cmap)
+
+        # Compute confidence indexes
+        #weights = cmap - threshold
+        #weights[weights < 0.] = 0.
+        #weights /= np.max(weights)
+        weights = np.ones((L, L), dtype=np.float64)
+        #weights[missing, :] = 0.
+        #weights[:, missing] = 0.
+
+        initial_coords = self.embed(
+                gds, ssp=(ssp if self.fragments else None), verbose=verbose)
+
+        # Create Gaussian model if not set by the user
+        if not isinstance(self._model, AminoAcidModel):
+            if verbose:
+                print('Model not set by user. Creating model from scratch...')
+            chain = Chain.from_string(seq, c='CA')
+            self._model = self.create_model(chain, cmap, gds, ssp, acc, weights)
+        elif isinstance(self._result, FoldingResult) and self._result.model is self._model:
+            # Model created by a previous run
+            chain = self._result.chain
+        else:
+            chain = self.model_chain(self._model, seq)
+        for i in range(len(chain)):
+            chain[i].ref().set_coords(*initial_coords[i])
+
+        # Choose evaluation mode and hyper-parameters
+        # from available resources
+        plan = None
+        if isinstance(self._auto_config, AutoConfig):
+            plan = self._auto_config.plan(
+                    L, self._model.n_restraints, self._model.n_informative_restraints)
+            if verbose:
+                print('[AutoConfig] %s' % plan)
+            plan.apply(model=self._model)
+        if self.dtype is not None:
+            self._model.dtype = self.dtype
+
+        # Create optimizer if not set by the user.
+        # Use default hyper-parameters, or the ones
+        # from the execution plan.
+        if self._optimizer is None:
+            if verbose:
+                print('Optimizer not set by user. Using default parameters.')
+            self._optimizer = Optimizer()
+            if plan is not None:
+                plan.apply(optimizer=self._optimizer)
+        if self.dtype is not None and isinstance(self._optimizer, Optimizer):
+            self._optimizer.dtype = self.dtype
+        self._optimizer.segments, self._optimizer.sse_segments = \
+            self.model_segments(chain, self._model, ssp)
+
+        # Restrain contacts progressively, by decreasing
+        # predicted probability
+        if self._optimizer.continuation is not None:
+            self._optimizer.continuation.set_contacts(
+                    *self.ranked_contacts(chain, self._model, cmap, gds, ssp))
+
+        # Race a portfolio of alternative initial embeddings
+        # and keep the most promising one
+        if isinstance(self._portfolio, Portfolio):
+            if verbose:
+                print('Race portfolio of %i initial embeddings' % self._portfolio.n_starts)
+            pop, scores = self._portfolio.run(
+                    self, chain, cmap, ssp, self._model, self._optimizer, verbose=verbose)
+        else:
+            pop, scores = None, None
+
+        # Search the internal coordinates of the C-alpha
+        # trace instead of the Cartesian coordinates
+        target = self._model
+        if self.torsion_space:
+            target = TorsionModel(self._model, np.concatenate(self._optimizer.segments))
+            self._optimizer.segments, self._optimizer.sse_segments = list(), list()
+            if pop is not None:
+                pop, scores = [target.encode(x) for x in pop], None
+
+        # Run optimizer on the Gaussian model
+        self._optimizer.run(target, verbose=verbose, pop=pop, scores=scores)
+        best_coords = np.empty((len(chain), 3), dtype=np.float64)
+        for i in range(len(chain)):
+            best_coords[i, :] = chain[i].ref().get_coords()
+        if verbose:
+            _, energies, _ = self._model.evaluate(self._model.get_coords(), breakdown=True)
+            print('[Model] Energy breakdown: %s' % ', '.join(
+                    '%s: %.2f' % (label, energy) for label, energy in energies.items()))
+
+        # Keep intermediate results for incremental refolding
+        self._result = FoldingResult(
+                best_coords, chain, self._model, A, gds, n_top, ssp, acc, seq,
+                pop=self._optimizer.pop, pop_scores=self._optimizer.pop_scores)
+        return best_coords
+
+    def refold(self, new_cmap, previous_result=None, verbose=True):
+        """Refolds a protein after an update of its predicted contacts.
+
+        Only the contacts that enter or leave the set of top contacts
+        are taken into account: graph distances and restraints of the
+        Gaussian model are updated incrementally, and the optimizer is
+        warm-started from the population of the previous run.
+        Multi-Dimensional Scaling and deviation correction are skipped.
+        If the new contact graph is disconnected while the previous one
+        was connected, the protein is folded from scratch. If both are
+        disconnected (`contact_graph` accepts a disconnected graph once
+        it reaches 6.5 L contacts), the warm start is kept and graph
+        distances are recomputed from scratch.
+
+        Parameters:
+            new_cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                the updated predicted contact probabilities.
+            previous_result (:obj:`FoldingResult`, optional): Result of a
+                previous call to `run` or `refold` on the same sequence.
+                Defaults to the result of the last call.
+            verbose (bool): Whether to display messages in stdout.
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (L, 3) representing the
+                protein in the 3D space.
+        """
+        result = self._result if previous_result is None else previous_result
+        assert(isinstance(result, FoldingResult))
+        self.check_torsion_space()
+        chain, model, ssp = result.chain, result.model, result.ssp
+
+        # Set diagonal to zeros
+        cmap = np.asarray(new_cmap)
+        cmap[np.isnan(cmap)] = 0.
+        np.fill_diagonal(cmap, 0)
+
+        # Select the same number of top contacts as in previous run
+        L = len(cmap)
+        proba = cmap[np.triu_indices(L, -self.sep)]
+        proba.sort()
+        A = (cmap > proba[-result.n_top])
+        G = Graph(A)
+        connected = G.is_connected()
+        if not connected and Graph(result.A).is_connected():
+            if verbose:
+                print('[Warning] Disconnected graph. Folding from scratch.')
+            self._model = None
+            return self.run(cmap, ssp, result.acc, result.seq, verbose=verbose)
+
+        # Diff the contact sets
+        changed = np.triu(A != result.A, k=1)
+        added = [(i, j) for i, j in zip(*np.where(changed & A))]
+        removed = [(i, j) for i, j in zip(*np.where(changed & ~A))]
+        if verbose:
+            print('Refold with %i new contacts and %i removed contacts' \
+                % (len(added), len(removed)))
+        if connected:
+            gds = G.update_distances(result.gds, added, removed,
+                                     max_distance=GaussFold.MAX_GRAPH_DISTANCE)
+        else:
+            # Incremental updates assume that all residues are reachable
+            gds = np.minimum(G.distances(), GaussFold.MAX_GRAPH_DISTANCE)
+
+        # Update restraints on the pairs of residues whose
+        # contact status changed
+        segment_ids = self.segment_ids(ssp)
+        new_constraints, old_constraints = list(), list()
+        for j, i in added + removed:
+            if self.has_intra_segment_restraint(i, j, ssp, segment_ids):
+                # Contact restraint would be overridden anyway
+                continue
+            if A[i, j]:
+                new_constraints += self.contact_constraints(chain, i, j, ssp, segment_ids)
+            else:
+                for constraint in model.pair_constraints(chain[i].ref(), chain[j].ref()):
+                    if isinstance(constraint, DistanceRestraint):
+                        old_constraints.append(constraint)
+
+        # Pair cysteines again from the new contact probabilities
+        new_bonds, old_bonds = self.update_disulfide_bonds(
+                chain, model, cmap, excluded=old_constraints)
+        model.update_constraints(added=new_bonds + new_constraints,
+                                 removed=old_bonds + old_constraints)
+        self._model = model
+
+        # Warm-start the optimizer from the previous population
+        if self._optimizer is None:
+            self._optimizer = Optimizer()
+        if self._optimizer.continuation is not None:
+            self._optimizer.continuation.set_contacts(
+                    *self.ranked_contacts(chain, model, cmap, gds, ssp))
+        for i in range(len(chain)):
+            chain[i].ref().set_coords(*result.coords[i])
+        target = model
+        if self.torsion_space:
+            segments, _ = self.model_segments(chain, model, ssp)
+            target = TorsionModel(model, np.concatenate(segments))
+        self._optimizer.run(target, verbose=verbose, pop=result.pop)
+        best_coords = np.empty((len(chain), 3), dtype=np.float64)
+        for i in range(len(chain)):
+            best_coords[i, :] = chain[i].ref().get_coords()
+
+        self._result = FoldingResult(
+                best_coords, chain, model, A, gds, result.n_top, ssp,
+                result.acc, result.seq, pop=self._optimizer.pop,
+                pop_scores=self._optimizer.pop_scores)
+        return best_coords
+
+    def check_torsion_space(self):
+        """Checks that the optimizer can search the internal coordinates
+        of the C-alpha trace if `torsion_space` is enabled, and raises
+        a `ValueError` otherwise.
+        """
+        if not self.torsion_space or self._optimizer is None:
+            return
+        if not isinstance(self._optimizer, Optimizer):
+            raise ValueError(
+                    '%s requires Cartesian coordinates and cannot be used '
+                    'with torsion_space=True' % type(self._optimizer).__name__)
+        if self._optimizer.use_newton:
+            raise ValueError(
+                    'Newton refinement (use_newton=True) requires Hessian-vector '
+                    'products and cannot be used with torsion_space=True')
+
+        # Superpositions would rotate the rows of angles as if
+        # they were coordinates
+        if self._optimizer.align_parents:
+            raise ValueError('align_parents=True cannot be used with torsion_space=True')
+        if self._optimizer.canonicalize_every > 0:
+            raise ValueError('canonicalize_every > 0 cannot be used with torsion_space=True')
+
+    def contact_graph(self, cmap, n_top=None):
+        """Selects the top predicted contacts and computes graph distances
+        between residues in the resulting contact graph.
+
+        Parameters:
+            cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                predicted contact probabilities, with a diagonal of zeros.
+            n_top (float, optional): Number of top contacts divided by L.
+                Defaults to the value provided at construction.
+
+        Returns:
+            tuple: Boolean adjacency matrix of shape (L, L), matrix of
+                shape (L, L) of graph distances between residues, and
+                the number of top contacts that has been used to make
+                the graph connected.
+        """
         # Choose threshold such that exactly n_tops*L contacts
         # are obtained
         L = len(cmap)
+        n_top = self._n_top if n_top is None else n_top
 
         """
         mask = np.zeros((L, L), dtype=np.bool)
@@ -94,7 +382,7 @@ class GaussFold:
         """
         proba = cmap[np.triu_indices(L, -self.sep)]
         proba.sort()
-        n_top = int(np.round(self._n_top * L))
+        n_top = int(np.round(n_top * L))
         threshold = proba[-n_top]
 
         A = (cmap > threshold)
@@ -125,20 +413,35 @@ class GaussFold:
             G = Graph(A)
             gds = G.distances()
 
-        # Compute confidence indexes
-        #weights = cmap - threshold
-        #weights[weights < 0.] = 0.
-        #weights /= np.max(weights)
-        weights = np.ones((L, L), dtype=np.float)
-        #weights[missing, :] = 0.
-        #weights[:, missing] = 0.
-
         # Graph distances above 14 are statistically impossible
-        gds = np.minimum(gds, 14)
+        gds = np.minimum(gds, GaussFold.MAX_GRAPH_DISTANCE)
+        return A, gds, n_top
+
+    def embed(self, gds, random_state=None, initializer='mds', ssp=None, verbose=True):
+        """Computes approximate 3D coordinates from graph distances.
+
+        Parameters:
+            gds (:obj:`np.ndarray`): Matrix of graph distance
+                between each pair of residues in the protein.
+            random_state (int, optional): Seed of the Multi-Dimensional
+                Scaling algorithm.
+            initializer (str): Embedding algorithm, either 'mds' for
+                metric Multi-Dimensional Scaling, 'classical' for
+                classical (Torgerson) Multi-Dimensional Scaling, or
+                'smacof' for stress majorization started from classical
+                Multi-Dimensional Scaling, where the stress of each pair
+                is weighted by its inverse squared distance.
+            ssp (:obj:`np.ndarray`, optional): Array of shape (L,)
+                representing 3-state secondary structure prediction.
+                If provided, predicted helices and strands are replaced
+                by ideal fragments.
+            verbose (bool): Whether to display messages in stdout.
 
-        import matplotlib.pyplot as plt
-        plt.imshow(gds)
-        plt.show()
+        Returns:
+            :obj:`np.ndarray`: Array of shape (L, 3) representing the
+                initial coordinates of the residues.
+        """
+        assert(initializer in ['mds', 'classical', 'smacof'])
 
         # Apply theoretical linear correspondence between graph
         # distance and Angstroms distance based on statistical
@@ -151,55 +454,52 @@ class GaussFold:
         # 3D coordinates
         if verbose:
             print('Apply Multi-Dimensional Scaling algorithm')
-        embedding = MDS(
-                n_components=3,
-                metric=True,
-                n_init=self.n_runs,
-                max_iter=self.max_n_iter,
-                eps=self.eps,
-                n_jobs=None,
-                random_state=None,
-                dissimilarity='precomputed')
-        X_transformed = embedding.fit_transform(distances)
+        if initializer == 'classical':
+            X_transformed = classical_mds(distances)
+        elif initializer == 'smacof':
+            # Local distances are the most reliable ones
+            rows, cols = np.tril_indices(len(distances), k=-1)
+            mu = distances[rows, cols]
+            weights = 1. / np.maximum(mu, 1e-12) ** 2.
+            X_transformed, _ = sparse_smacof(
+                    classical_mds(distances), rows, cols, mu, weights,
+                    n_iter=self.max_n_iter, eps=self.eps)
+        else:
+            embedding = MDS(
+                    n_components=3,
+                    metric=True,
+                    n_init=self.n_runs,
+                    max_iter=self.max_n_iter,
+                    eps=self.eps,
+                    n_jobs=None,
+                    random_state=random_state,
+                    dissimilarity='precomputed')
+            X_transformed = embedding.fit_transform(distances)
 
         # Apply correction on pairs of adjacent residues
         # based on known C_alpha-C_alpha (or C_beta-C_beta) distance
         if verbose:
             print('Apply deviation correction')
-        corrector = DeviationCorrector(len(distances))
+        if self.corrector == 'projection':
+            dtype = np.float64 if self.dtype is None else self.dtype
+            corrector = ProjectionCorrector(len(distances), dtype=dtype)
+        else:
+            corrector = DeviationCorrector(len(distances))
         try:
             X_transformed = corrector.fit_transform(X_transformed)
-        except np.linalg.linalg.LinAlgError:
+        except np.linalg.LinAlgError:
             if verbose:
                 print('[Warning] Invalid value encountered in deviation corrector')
         except ValueError:
             if verbose:
                 print('[Warning] Invalid value encountered in deviation corrector')
-        initial_coords = X_transformed
 
-        # Create Gaussian model if not set by the user
-        if not isinstance(self._model, AminoAcidModel):
+        # Start from ideal secondary structure elements
+        if ssp is not None:
             if verbose:
-                print('Model not set by user. Creating model from scratch...')
-            chain = Chain.from_string(seq, c='CA')
-            self._model = self.create_model(chain, cmap, gds, ssp, acc, weights)
-        for i in range(len(chain)):
-            chain[i].ref().set_coords(*initial_coords[i])
-
-        # Create optimizer if not set by the user.
-        # Use default hyper-parameters.
-        if not isinstance(self._optimizer, Optimizer):
-            if verbose:
-                print('Optimizer not set by user. Using default parameters.')
-            self._optimizer = Optimizer()
-        
-        # Run optimizer on the Gaussian model
-        self._optimizer.run(self._model, verbose=verbose)
-        best_coords = np.empty((len(chain), 3), dtype=np.float)
-        for i in range(len(chain)):
-            best_coords[i, :] = chain[i].ref().get_coords()
-            print(chain[i].ref().__to_pdb__(i, ' ', i))
-        return best_coords
+                print('Insert ideal helix and strand fragments')
+            X_transformed = insert_fragments(X_transformed, ssp)
+        return X_transformed
 
     def create_model(self, chain, cmap, gds, ssp, acc, weights):
         """Creates a Gaussian model for the protein.
@@ -219,17 +519,15 @@ class GaussFold:
         # Cut predicted secondary structure
         # into contiguous segments
         L = len(ssp)
-        segment_ids = [0]
-        for i in range(1, L):
-            if ssp[i] != ssp[i-1]:
-                segment_ids.append(segment_ids[i-1] + 1)
-            else:
-                segment_ids.append(segment_ids[i-1])
+        segment_ids = self.segment_ids(ssp)
 
         # Instantiate an empty model. Restraints have
         # to be defined for each pair of residues before
         # optimizing this model.
-        model = AminoAcidModel(L)
+        model = AminoAcidModel(L, dtype=(np.float64 if self.dtype is None else self.dtype))
+
+        # Residues are numbered in sequence order in the model
+        model.add_atoms([chain[i].ref() for i in range(L)])
 
         # Repulsion constraints
         for i in range(L):
@@ -270,68 +568,175 @@ class GaussFold:
         for i in range(L - 3):
             model.add_constraint(Adjacent(chain[i].ref(), chain[i + 3].ref(), 3))
 
-        # Regular contacts
-        for i in range(L):
-            for j in range(max(0, i-self.sep)):
-                if gds[i, j] == 1:
-                    model.add_constraint(DistanceRestraint(chain[i].ref(), chain[j].ref(), 3.82, 0.35))
-
-        # Add restraints based on contacts in predicted
+        # Regular contacts, and contacts in predicted
         # secondary structures
-
         for i in range(L):
-            for j in range(max(0, i - 4)):
+            for j in range(max(0, i - min(self.sep, 4))):
                 if gds[i, j] == 1: # Contact
-                    if segment_ids[i] != segment_ids[j]:
-                        if ssp[i] == 1 and ssp[j] == 1:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 4.54, 0.32))
-                        elif (ssp[i] == 0 and ssp[j] == 1) or (ssp[i] == 1 and ssp[j] == 0):
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 6.05, 0.95))
-                        elif (ssp[i] == 0 and ssp[j] == 2) or (ssp[i] == 2 and ssp[j] == 0):
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 6.60, 0.92))
-                        elif (ssp[i] == 1 and ssp[j] == 2) or (ssp[i] == 2 and ssp[j] == 1):
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 6.44, 1.00))
+                    for constraint in self.contact_constraints(chain, i, j, ssp, segment_ids):
+                        model.add_constraint(constraint)
 
+        # Restraints based on the geometry of ideal
+        # helices and strands
         for i in range(L):
             for j in range(0, i):
                 sep = np.abs(i - j)
                 if segment_ids[i] == segment_ids[j]:
                     if ssp[i] == 0: # Helix
-                        if sep == 1:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 3.82, 0.35))
-                        elif sep == 2:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 5.48, 0.14))
-                        elif sep == 3:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 5.20, 0.14))
-                        elif sep == 4:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 6.28, 0.26))
-                        elif sep == 5:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 8.75, 0.26))
+                        distances = HELIX_DISTANCES
                     elif ssp[i] == 1: # Beta strand
-                        if sep == 1:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 3.80, 0.28))
-                        elif sep == 2:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 6.74, 0.28))
-                        elif sep == 3:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 10.10, 0.32))
-                        elif sep == 4:
-                            model.add_constraint(DistanceRestraint(
-                                    chain[i].ref(), chain[j].ref(), 13.30, 1.41))
+                        distances = STRAND_DISTANCES
+                    else:
+                        continue
+                    if sep <= len(distances):
+                        mu, sigma = distances[sep - 1]
+                        model.add_constraint(DistanceRestraint(
+                                chain[i].ref(), chain[j].ref(), mu, sigma, label='SSE'))
 
         return model.initialize()
 
+    def segment_ids(self, ssp):
+        """Cuts predicted secondary structure into contiguous segments.
+
+        Parameters:
+            ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+                3-state secondary structure prediction.
+
+        Returns:
+            list: Segment identifier of each residue.
+        """
+        segment_ids = [0]
+        for i in range(1, len(ssp)):
+            if ssp[i] != ssp[i-1]:
+                segment_ids.append(segment_ids[i-1] + 1)
+            else:
+                segment_ids.append(segment_ids[i-1])
+        return segment_ids
+
+    def model_chain(self, model, seq):
+        """Creates the residue chain of a model set by the user.
+        The reference atom of each residue is the atom registered
+        at the same position with `model.add_atoms`.
+
+        Parameters:
+            model (:obj:`gaussfold.model.AminoAcidModel`): Gaussian model.
+            seq (str): Protein primary structure.
+
+        Returns:
+            :obj:`gaussfold.chain.Chain`: Residue chain.
+        """
+        chain = Chain.from_string(seq, c='CA')
+        atoms = model.atoms
+        if len(atoms) < len(chain):
+            raise ValueError(
+                    'Model set by user must register one atom per residue '
+                    'with add_atoms (got %i atoms for %i residues)' % (len(atoms), len(chain)))
+        for i in range(len(chain)):
+            chain[i].CA = atoms[i]
+        return chain
+
+    def model_segments(self, chain, model, ssp):
+        """Lists the indices, in the coordinates of a model, of the
+        residues of each segment of predicted secondary structure.
+
+        Parameters:
+            chain (:obj:`gaussfold.chain.Chain`): Residue chain.
+            model (:obj:`gaussfold.model.AminoAcidModel`): Gaussian model.
+            ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+                3-state secondary structure prediction.
+
+        Returns:
+            tuple: Indices of the residues of all segments, and
+                indices of the residues of helices and strands
+                of at least 3 residues.
+        """
+        segment_ids = np.asarray(self.segment_ids(ssp))
+        ids = np.asarray([model.atom_id(chain[i].ref()) for i in range(len(chain))])
+        segments, sse_segments = list(), list()
+        for segment_id in np.unique(segment_ids):
+            residues = np.where(segment_ids == segment_id)[0]
+            segments.append(ids[residues])
+            if ssp[residues[0]] in (0, 1) and len(residues) >= 3:
+                sse_segments.append(ids[residues])
+        return segments, sse_segments
+
+    def contact_constraints(self, chain, i, j, ssp, segment_ids):
+        """Creates the restraints associated to a predicted contact.
+
+        Parameters:
+            chain (:obj:`gaussfold.chain.Chain`): Residue chain.
+            i (int): Identifier of first residue.
+            j (int): Identifier of second residue, with j < i.
+            ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+                3-state secondary structure prediction.
+            segment_ids (list): Segment identifier of each residue.
+
+        Returns:
+            list: Restraints, in the order they must be added to the model.
+        """
+        constraints = list()
+        if i - j > self.sep:
+            constraints.append(DistanceRestraint(
+                    chain[i].ref(), chain[j].ref(), 3.82, 0.35, label='Contact'))
+
+        # Add restraints based on contacts in predicted
+        # secondary structures
+        if i - j > 4:
+            if segment_ids[i] != segment_ids[j]:
+                if ssp[i] == 1 and ssp[j] == 1:
+                    constraints.append(DistanceRestraint(
+                            chain[i].ref(), chain[j].ref(), 4.54, 0.32, label='Contact'))
+                elif (ssp[i] == 0 and ssp[j] == 1) or (ssp[i] == 1 and ssp[j] == 0):
+                    constraints.append(DistanceRestraint(
+                            chain[i].ref(), chain[j].ref(), 6.05, 0.95, label='Contact'))
+                elif (ssp[i] == 0 and ssp[j] == 2) or (ssp[i] == 2 and ssp[j] == 0):
+                    constraints.append(DistanceRestraint(
+                            chain[i].ref(), chain[j].ref(), 6.60, 0.92, label='Contact'))
+                elif (ssp[i] == 1 and ssp[j] == 2) or (ssp[i] == 2 and ssp[j] == 1):
+                    constraints.append(DistanceRestraint(
+                            chain[i].ref(), chain[j].ref(), 6.44, 1.00, label='Contact'))
+        return constraints
+
+    def ranked_contacts(self, chain, model, cmap, gds, ssp):
+        """Lists the contact restraints of a model created by
+        `create_model`, along with predicted contact probabilities.
+
+        Parameters:
+            chain (:obj:`gaussfold.chain.Chain`): Residue chain.
+            model (:obj:`gaussfold.model.AminoAcidModel`): Gaussian model.
+            cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                predicted contact probabilities.
+            gds (:obj:`np.ndarray`): Matrix of graph distance
+                between each pair of residues in the protein.
+            ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+                3-state secondary structure prediction.
+
+        Returns:
+            tuple: Groups of contact restraints, one group per pair
+                of residues, and predicted probability of each contact.
+        """
+        segment_ids = self.segment_ids(ssp)
+        contacts, probabilities = list(), list()
+        for i in range(len(chain)):
+            for j in range(max(0, i - min(self.sep, 4))):
+                if gds[i, j] != 1 or self.has_intra_segment_restraint(i, j, ssp, segment_ids):
+                    continue
+                group = [constraint for constraint in model.pair_constraints(
+                        chain[i].ref(), chain[j].ref()) if isinstance(constraint, DistanceRestraint)]
+                if len(group) > 0:
+                    contacts.append(group)
+                    probabilities.append(cmap[i, j])
+        return contacts, probabilities
+
+    def has_intra_segment_restraint(self, i, j, ssp, segment_ids):
+        """Whether `create_model` restrains the pair (i, j) with the
+        geometry of an ideal helix or strand."""
+        if segment_ids[i] != segment_ids[j]:
+            return False
+        sep = np.abs(i - j)
+        return (ssp[i] == 0 and sep <= len(HELIX_DISTANCES)) or \
+            (ssp[i] == 1 and sep <= len(STRAND_DISTANCES))
+
     def make_disulfide_bonds(self, cmap, chain):
         cysteine_ids = [i for i, amino_acid in enumerate(chain) if isinstance(amino_acid, Cysteine)]
         n_cysteines = len(cysteine_ids)
@@ -359,6 +764,50 @@ class GaussFold:
             n_cysteines -= 2
         return constraints
 
+    def update_disulfide_bonds(self, chain, model, cmap, excluded=()):
+        """Pairs cysteines again after an update of the predicted contacts,
+        and lists the changes to apply to the disulfide bonds of a model.
+        Restraints that are added after disulfide bonds in `create_model`
+        are added again after the new bonds, so that they keep precedence.
+
+        Parameters:
+            chain (:obj:`gaussfold.Chain`): Chain of the model.
+            model (:obj:`gaussfold.AminoAcidModel`): Gaussian model.
+            cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                the updated predicted contact probabilities.
+            excluded (list): Constraints that are about to be removed
+                from the model, and should not be added again.
+
+        Returns:
+            tuple: Constraints to add to the model, and constraints
+                to remove from the model.
+        """
+        cysteine_ids = [i for i, amino_acid in enumerate(chain) if isinstance(amino_acid, Cysteine)]
+        old_bonds = dict()
+        for i in cysteine_ids:
+            for j in cysteine_ids:
+                if i < j:
+                    for constraint in model.pair_constraints(chain[i].ref(), chain[j].ref()):
+                        if isinstance(constraint, DisulfideBond):
+                            old_bonds[(i, j)] = constraint
+        ids = { chain[i].ref(): i for i in cysteine_ids }
+        new_bonds = dict()
+        for constraint in self.make_disulfide_bonds(cmap, chain):
+            i, j = ids[constraint.atom_a], ids[constraint.atom_b]
+            new_bonds[(min(i, j), max(i, j))] = constraint
+
+        added = list()
+        removed = [constraint for pair, constraint in old_bonds.items() if pair not in new_bonds]
+        for (i, j), constraint in new_bonds.items():
+            if (i, j) in old_bonds:
+                continue
+            added.append(constraint)
+            for other in model.pair_constraints(chain[i].ref(), chain[j].ref()):
+                if not isinstance(other, (Repulsion, DisulfideBond)) and other not in excluded:
+                    removed.append(other)
+                    added.append(other)
+        return added, removed
+
     @property
     def model(self):
         return self._model
@@ -374,3 +823,58 @@ class GaussFold:
     @optimizer.setter
     def optimizer(self, optimizer):
         self._optimizer = optimizer
+
+    @property
+    def portfolio(self):
+        return self._portfolio
+
+    @portfolio.setter
+    def portfolio(self, portfolio):
+        self._portfolio = portfolio
+
+    @property
+    def auto_config(self):
+        return self._auto_config
+
+    @auto_config.setter
+    def auto_config(self, auto_config):
+        self._auto_config = auto_config
+
+    @property
+    def result(self):
+        return self._result
+
+
+class FoldingResult:
+    """Intermediate and final results of GDE-GaussFold, used
+    for refolding a protein incrementally.
+
+    Attributes:
+        coords (:obj:`np.ndarray`): Array of shape (L, 3) representing
+            the protein in the 3D space.
+        chain (:obj:`gaussfold.chain.Chain`): Residue chain.
+        model (:obj:`gaussfold.model.AminoAcidModel`): Gaussian model.
+        A (:obj:`np.ndarray`): Adjacency matrix of the contact graph.
+        gds (:obj:`np.ndarray`): Matrix of graph distances.
+        n_top (int): Number of top contacts used to build the graph.
+        ssp (:obj:`np.ndarray`): 3-state secondary structure prediction.
+        acc (:obj:`np.ndarray`): 3-state solvent accessibility prediction.
+        seq (str): Protein primary structure.
+        pop (list): Final population of the optimizer, in internal
+            coordinates if the protein has been folded in torsion space.
+        pop_scores (:obj:`np.ndarray`): Fitness of the individuals in `pop`.
+    """
+
+    def __init__(self, coords, chain, model, A, gds, n_top, ssp, acc, seq,
+                 pop=None, pop_scores=None):
+        self.coords = coords
+        self.chain = chain
+        self.model = model
+        self.A = A
+        self.gds = gds
+        self.n_top = n_top
+        self.ssp = ssp
+        self.acc = acc
+        self.seq = seq
+        self.pop = pop
+        self.pop_scores = pop_scores
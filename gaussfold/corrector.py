@@ -138,3 +138,68 @@ class DeviationCorrector:
         x_hat = result.x
         y_hat = poly(x_hat)
         return np.asarray([x_hat, y_hat])
+
+
+class ProjectionCorrector:
+    """Applies corrections to 3D coordinates of residues that do
+    not have a distance of 3.8 Angstroms with adjacent residues,
+    by iteratively projecting each pair of adjacent residues onto
+    the C-alpha - C-alpha distance (SHAKE-like algorithm).
+
+    Pairs (i, i + 1) with even i and pairs with odd i are projected
+    alternately: each residue belongs to at most one pair of a same
+    parity, so that each half-sweep is a single vectorized operation.
+
+    Attributes:
+        L (int): Number of residues in the protein.
+        n_iter (int): Maximum number of sweeps over the chain.
+        tol (float): Maximum absolute deviation from the C-alpha -
+            C-alpha distance at convergence.
+        dtype (type): Floating-point type of the corrected coordinates.
+    """
+
+    def __init__(self, L, n_iter=50, tol=1e-2, dtype=np.float64):
+        """Constructs a projection corrector.
+
+        Parameters:
+            L (int): Number of residues in the protein.
+            n_iter (int): Maximum number of sweeps over the chain.
+            tol (float): Maximum absolute deviation at convergence.
+            dtype (type): Floating-point type of the corrected coordinates.
+        """
+        self.L = L
+        self.n_iter = n_iter
+        self.tol = tol
+        self.dtype = dtype
+        self._pairs = [np.arange(offset, L - 1, 2) for offset in (0, 1)]
+
+    def fit_transform(self, coords):
+        """Applies corrections to coordinates of adjacent residues,
+        based on average C-alpha - C-alpha distance.
+
+        Parameters:
+            coords (np.ndarray): Array of shape (L, 3) representing
+                the initial coordinates.
+
+        Returns;
+            np.ndarray: Array of shape (L, 3) representing the
+                refined coordinates.
+        """
+        coords = np.array(coords, dtype=self.dtype)
+        target = DeviationCorrector.CA_CA_DISTANCE
+        for k in range(self.n_iter):
+            max_deviation = 0.
+            for i in self._pairs:
+                delta = coords[i + 1] - coords[i]
+                distances = np.sqrt((delta ** 2.).sum(axis=1))
+                deviations = distances - target
+                max_deviation = max(max_deviation, np.abs(deviations).max(initial=0.))
+
+                # Move both residues by half of the deviation
+                # along the axis joining them
+                delta *= (0.5 * deviations / np.maximum(distances, 1e-8))[:, np.newaxis]
+                coords[i] += delta
+                coords[i + 1] -= delta
+            if max_deviation < self.tol:
+                break
+        return coords
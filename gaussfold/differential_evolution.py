@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# differential_evolution.py: Differential evolution for Gaussian models
+# author : Antoine Passemiers
+
+from gaussfold.lbfgs import lbfgs
+
+import numpy as np
+
+
+class DifferentialEvolution:
+    """Heuristic optimizer based on the DE/rand/1/bin variant of
+    differential evolution. Each generation is created at once:
+    each individual competes with a trial solution made of a base
+    individual, moved by the scaled difference of two others and
+    crossed over with the individual, residue by residue.
+
+    Attributes:
+        pop_size (int): Number of solutions kept in memory.
+        n_iter (int): Maximum number of generations.
+        F (float): Scale factor of the difference vectors.
+        CR (float): Probability for each residue of a trial solution
+            to be taken from the mutant vector.
+        init_std (float): Standard deviation used to generate the
+            population from an initial solution.
+        early_stopping (int): Maximum number of generations without
+            score improvement before stopping the algorithm.
+        batch_size (int): Number of trial solutions evaluated at once.
+        use_lbfgs (bool): Whether to improve local convergence
+            with L-BFGS algorithm.
+        random_state (int): Seed of the random number generator.
+        scores (list): History of best score over time.
+        pop (list): Population at the end of the last run.
+        pop_scores (:obj:`np.ndarray`): Fitness of the individuals
+            in `pop`.
+    """
+
+    def __init__(self, pop_size=50, n_iter=2000, F=0.5, CR=0.1, init_std=1.,
+                 early_stopping=100, batch_size=32, use_lbfgs=False,
+                 random_state=None):
+        self.pop_size = pop_size
+        self.n_iter = n_iter
+        self.F = F
+        self.CR = CR
+        self.init_std = init_std
+        self.early_stopping = early_stopping
+        self.batch_size = batch_size
+        self.use_lbfgs = use_lbfgs
+        self.random_state = random_state
+        self.segments = list()
+        self.sse_segments = list()
+        self.continuation = None
+        self.scores = list()
+        self.pop = None
+        self.pop_scores = None
+
+    def evaluate(self, model, X):
+        """Evaluates solutions by batches of `batch_size`.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model.
+            X (:obj:`np.ndarray`): Solutions, as an array
+                of shape (n_solutions, L, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Log-likelihood of each solution.
+        """
+        batch_size = max(1, self.batch_size)
+        return np.concatenate([model.evaluate_batch(X[k:k+batch_size])
+                               for k in range(0, len(X), batch_size)])
+
+    def generation(self, X, rng):
+        """Creates the trial solutions of a generation.
+
+        Parameters:
+            X (:obj:`np.ndarray`): Current population, as an array
+                of shape (pop_size, L, 3).
+            rng (:obj:`np.random.RandomState`): Random number generator.
+
+        Returns:
+            :obj:`np.ndarray`: Trial solutions, as an array
+                of shape (pop_size, L, 3).
+        """
+        P, L = X.shape[0], X.shape[1]
+
+        # Draw three distinct individuals, different from the target one
+        keys = rng.rand(P, P)
+        np.fill_diagonal(keys, np.inf)
+        r = np.argpartition(keys, 2, axis=1)[:, :3]
+        mutants = X[r[:, 0]] + self.F * (X[r[:, 1]] - X[r[:, 2]])
+
+        # Binomial cross-over, with at least one residue
+        # taken from the mutant vector
+        mask = rng.rand(P, L) < self.CR
+        mask[np.arange(P), rng.randint(0, L, size=P)] = True
+        return np.where(mask[..., np.newaxis], mutants, X)
+
+    def run(self, model, verbose=True, pop=None, scores=None):
+        """Run differential evolution on an initial solution,
+        with given objective function.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model
+            verbose (bool): Whether to display messages in stdout.
+            pop (list, optional): Population to resume from, for example
+                the `pop` attribute of a previous run. If not provided,
+                the population is generated from the current coordinates
+                of the model.
+            scores (:obj:`np.ndarray`, optional): Fitness of the individuals
+                in `pop`. Computed if not provided.
+
+        Returns:
+            :obj:`np.ndarray`: Optimal solution.
+        """
+        rng = np.random.RandomState(self.random_state)
+        if pop is None:
+            # Randomly initializes population and adds initial
+            # solution to it
+            initial_solution = model.get_coords()
+            X = initial_solution + rng.normal(
+                    0., self.init_std, size=(self.pop_size,) + initial_solution.shape)
+            X[-1] = initial_solution
+            scores = None
+        else:
+            X = np.array(pop, dtype=np.float64)
+        if scores is None:
+            scores = self.evaluate(model, X)
+        else:
+            scores = np.array(scores, dtype=np.float64)
+
+        self.scores = list()
+        best_score = np.max(scores)
+        best_iteration = 0
+        for k in range(self.n_iter):
+            trials = self.generation(X, rng)
+            trial_scores = self.evaluate(model, trials)
+
+            # Each trial solution replaces its target
+            # solution if it is at least as good
+            improved = (trial_scores >= scores)
+            X[improved] = trials[improved]
+            scores[improved] = trial_scores[improved]
+
+            # Check if improvement
+            if np.max(scores) > best_score:
+                best_score = np.max(scores)
+                best_iteration = k
+            if verbose and (k + 1) % 10 == 0:
+                print('[DE] Log-likelihood at generation %i: %f' % (k + 1, best_score))
+            self.scores.append(best_score)
+
+            if np.isnan(best_score):
+                if verbose:
+                    print('[Warning] Invalid value encountered in differential evolution')
+                break
+
+            # Stop algorithm if no more improvement
+            if k - best_iteration >= self.early_stopping:
+                break
+
+        # Fine-tune solution with L-BFGS
+        best_coords = X[np.argmax(scores)]
+        if self.use_lbfgs:
+            new_coords = lbfgs(best_coords, model, verbose=verbose)
+            if model.evaluate(new_coords) > best_score:
+                best_coords = new_coords
+
+        # Keep final population for warm restarts
+        self.pop, self.pop_scores = list(X), scores
+
+        # Update coordinates in model
+        model.set_coords(best_coords)
+        return best_coords
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# geometry.py: Rigid-body superposition of 3D points
+# author : Antoine Passemiers
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+
+def kabsch(mobile, target):
+    """Finds the rotations and translations that superpose point sets
+    onto other point sets with minimal root-mean-square deviation.
+    Reflections are not allowed, so that chirality is preserved.
+
+    Parameters:
+        mobile (:obj:`np.ndarray`): Array of shape (..., n_points, 3)
+            representing the points to move.
+        target (:obj:`np.ndarray`): Array of shape (..., n_points, 3)
+            representing the reference points.
+
+    Returns:
+        tuple: Rotation matrices of shape (..., 3, 3) and translation
+            vectors of shape (..., 3), such that `mobile @ R + t`
+            is superposed onto `target`.
+    """
+    mobile_center = mobile.mean(axis=-2)
+    target_center = target.mean(axis=-2)
+    H = np.matmul(
+            np.swapaxes(mobile - mobile_center[..., np.newaxis, :], -1, -2),
+            target - target_center[..., np.newaxis, :])
+    U, _, Vt = np.linalg.svd(H)
+
+    # Flip the last singular vector if needed to get a proper rotation
+    d = np.where(np.linalg.det(np.matmul(U, Vt)) < 0, -1., 1.)
+    U[..., :, -1] *= d[..., np.newaxis]
+    R = np.matmul(U, Vt)
+    t = target_center - np.matmul(mobile_center[..., np.newaxis, :], R)[..., 0, :]
+    return R, t
+
+
+def superpose(mobile, target):
+    """Superposes point sets onto other point sets with `kabsch`.
+
+    Parameters:
+        mobile (:obj:`np.ndarray`): Array of shape (..., n_points, 3)
+            representing the points to move.
+        target (:obj:`np.ndarray`): Array of shape (..., n_points, 3)
+            representing the reference points.
+
+    Returns:
+        :obj:`np.ndarray`: Moved points, of same shape as `mobile`.
+    """
+    R, t = kabsch(mobile, target)
+    return np.matmul(mobile, R) + t[..., np.newaxis, :]
+
+
+def random_rotation(std):
+    """Draws a rotation around a random axis, with a normally
+    distributed angle.
+
+    Parameters:
+        std (float): Standard deviation of the angle (in radians).
+
+    Returns:
+        :obj:`np.ndarray`: Rotation matrix of shape (3, 3).
+    """
+    axis = np.random.normal(0., 1., size=3)
+    axis /= np.linalg.norm(axis)
+    angle = np.random.normal(0., std)
+    return Rotation.from_rotvec(angle * axis).as_matrix()
@@ -5,6 +5,7 @@
 import numpy as np
 import networkx as nx
 from networkx.algorithms.shortest_paths.generic import shortest_path_length
+from networkx.algorithms.shortest_paths.unweighted import single_source_shortest_path_length
 
 
 class Graph:
@@ -19,8 +20,51 @@ class Graph:
 
     def distances(self):
         path_lengths = shortest_path_length(self.G)
-        gds = np.zeros((self.L, self.L), dtype=np.int)
+        gds = np.zeros((self.L, self.L), dtype=np.int64)
         for i, i_lengths in path_lengths:
             for j in i_lengths.keys():
                 gds[i, j] = gds[j, i] = i_lengths[j]
         return gds
+
+    def update_distances(self, gds, added, removed, max_distance=None):
+        """Updates graph distances after edges were added to and removed
+        from the graph, without recomputing all shortest paths.
+
+        Parameters:
+            gds (:obj:`np.ndarray`): Matrix of graph distances in the
+                graph before the update. Graph is assumed to be connected.
+            added (list): Pairs of nodes (u, v) that are now adjacent.
+            removed (list): Pairs of nodes (u, v) that are not
+                adjacent anymore.
+            max_distance (int, optional): Value at which distances in `gds`
+                have been clipped. Distances are clipped at the same value.
+
+        Returns:
+            :obj:`np.ndarray`: Matrix of graph distances in the current graph.
+        """
+        gds = np.array(gds, dtype=np.int64)
+
+        # Removing an edge can only increase distances from the nodes
+        # that reach its two ends at different distances. Shortest paths
+        # from those nodes are recomputed in the current graph.
+        sources = set()
+        for u, v in removed:
+            sources.update(np.where(gds[:, u] != gds[:, v])[0])
+        for i in sources:
+            lengths = single_source_shortest_path_length(self.G, i)
+            gds[i, :] = 0
+            gds[i, list(lengths.keys())] = list(lengths.values())
+            gds[:, i] = gds[i, :]
+        if max_distance is not None:
+            gds = np.minimum(gds, max_distance)
+
+        # Adding an edge (u, v) can only shorten paths through it
+        for u, v in added:
+            d_u, d_v = gds[:, u], gds[:, v]
+            through_uv = np.minimum(
+                    d_u[:, np.newaxis] + 1 + d_v[np.newaxis, :],
+                    d_v[:, np.newaxis] + 1 + d_u[np.newaxis, :])
+            gds = np.minimum(gds, through_uv)
+        if max_distance is not None:
+            gds = np.minimum(gds, max_distance)
+        return gds
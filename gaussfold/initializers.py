@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# initializers.py: Initial 3D embeddings of residues
+# author : Antoine Passemiers
+
+from gaussfold.constraints.distance_restraint import HELIX_DISTANCES, STRAND_DISTANCES
+from gaussfold.geometry import superpose
+
+import numpy as np
+from scipy.optimize import least_squares
+
+
+def classical_mds(distances, n_components=3):
+    """Classical (Torgerson) Multi-Dimensional Scaling.
+
+    The embedding is obtained in closed form from the eigendecomposition
+    of the double-centered matrix of squared distances. It is
+    deterministic and much cheaper than the iterative metric MDS.
+
+    Parameters:
+        distances (:obj:`np.ndarray`): Array of shape (L, L) containing
+            the target distances between each pair of residues.
+        n_components (int): Dimensionality of the embedding.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (L, n_components) representing
+            the embedded points.
+    """
+    L = distances.shape[0]
+    J = np.eye(L) - np.ones((L, L)) / L
+    B = -0.5 * np.dot(J, np.dot(distances ** 2., J))
+    eigenvalues, eigenvectors = np.linalg.eigh(B)
+    indices = np.argsort(eigenvalues)[::-1][:n_components]
+    eigenvalues = np.maximum(eigenvalues[indices], 0.)
+    return eigenvectors[:, indices] * np.sqrt(eigenvalues)
+
+
+def helical_parameters(distances):
+    """Finds the regular helix whose points best match target
+    distances between points i and i + k, for k = 1, 2, ...
+
+    Point i of the helix is located at (r cos(i theta), r sin(i theta), i h).
+
+    Parameters:
+        distances (list): Pairs (mu, sigma) of average and standard
+            deviation of the distance between points i and i + k.
+
+    Returns:
+        tuple: Radius r, angle theta (in radians) and rise h.
+    """
+    mu = np.asarray([m for m, _ in distances])
+    sigma = np.asarray([s for _, s in distances])
+    k = np.arange(1, len(mu) + 1)
+
+    def residuals(x):
+        r, theta, h = x
+        d = np.sqrt(2. * r ** 2. * (1. - np.cos(k * theta)) + (k * h) ** 2.)
+        return (d - mu) / sigma
+
+    # Start from a right-handed alpha helix
+    x0 = [2.3, np.radians(100.), 1.5]
+    if mu[1] > 2. * mu[0] - 1.:
+        # Almost extended chain: start from a beta strand
+        x0 = [1., np.radians(160.), 3.3]
+    return least_squares(residuals, x0).x
+
+
+def ideal_fragment(n, distances):
+    """Creates the C-alpha trace of an ideal helix or strand.
+
+    Parameters:
+        n (int): Number of residues.
+        distances (list): Pairs (mu, sigma) of average and standard
+            deviation of the distance between residues i and i + k.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (n, 3) representing the fragment.
+    """
+    r, theta, h = helical_parameters(distances)
+    i = np.arange(n)
+    return np.asarray([r * np.cos(i * theta), r * np.sin(i * theta), i * h]).T
+
+
+def insert_fragments(coords, ssp, min_length=3):
+    """Replaces the residues of each predicted helix and strand by an ideal
+    fragment, rigidly superposed onto the initial coordinates.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (L, 3) representing
+            the initial coordinates.
+        ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+            3-state secondary structure prediction.
+            0 stands for 'H', 1 for 'E' and 2 for 'C'.
+        min_length (int): Minimum number of residues of a segment
+            for it to be replaced.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (L, 3) representing the
+            new coordinates.
+    """
+    coords = np.copy(coords)
+    L = len(ssp)
+    start = 0
+    for end in range(1, L + 1):
+        if end < L and ssp[end] == ssp[start]:
+            continue
+        if end - start >= min_length and ssp[start] in (0, 1):
+            distances = HELIX_DISTANCES if ssp[start] == 0 else STRAND_DISTANCES
+            fragment = ideal_fragment(end - start, distances)
+            coords[start:end] = superpose(fragment, coords[start:end])
+        start = end
+    return coords
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+# kernels.py: Pluggable implementations of the evaluation hot loops
+# author : Antoine Passemiers
+
+import os
+import numpy as np
+import scipy.spatial
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Names of the kernel backends
+BACKENDS = ['numpy', 'numba']
+
+_backend = 'numpy'
+
+
+def available_backends():
+    """Returns the names of the backends that can be used."""
+    return [backend for backend in BACKENDS if backend != 'numba' or numba is not None]
+
+
+def set_backend(backend='auto'):
+    """Selects the implementation of the kernels used by the models.
+    'numba' runs parallel fused loops over the restraints, which compute
+    each term without allocating temporary arrays, and 'numpy' runs
+    vectorized operations. 'auto' selects 'numba' when it is installed.
+    The choice is stored in the `GAUSSFOLD_BACKEND` environment variable,
+    which is read at import time, so that worker processes use the
+    same backend.
+
+    Parameters:
+        backend (str): Either 'auto', 'numpy' or 'numba'.
+    """
+    global _backend
+    assert(backend in ['auto'] + BACKENDS)
+    if backend == 'auto':
+        backend = 'numba' if numba is not None else 'numpy'
+    elif backend not in available_backends():
+        print('[Warning] Numba is not installed. Falling back to NumPy kernels.')
+        backend = 'numpy'
+    _backend = backend
+    os.environ['GAUSSFOLD_BACKEND'] = backend
+
+
+def get_backend():
+    """Returns the name of the selected backend."""
+    return _backend
+
+
+def describe_backend():
+    """Returns a description of the selected backend, for logging."""
+    if _backend == 'numba':
+        return 'numba %s (%i threads)' % (numba.__version__, numba.get_num_threads())
+    return 'numpy %s' % np.__version__
+
+
+class Workspace:
+    """Scratch buffers of the NumPy kernels. Each buffer is allocated by
+    the first call that needs it and reused by the following calls, so
+    that repeated evaluations of a model do not allocate arrays of the
+    size of the restraints. Buffers are identified by their name only:
+    a buffer grows when a larger array is requested, and smaller ones
+    are views of its first bytes, so that the memory of a workspace is
+    bounded by the largest batch evaluated. A workspace also caches the
+    list of restrained pairs of the matrices given to `dense_energy`,
+    and must be replaced when they change. Workspaces are not shared:
+    copies (for example in worker processes) start empty.
+
+    Attributes:
+        pairs (tuple): Flat indices, in the distance matrix, of the
+            restrained pairs (i, j) with i > j, and their expected
+            distances, standard deviations and weights (None if
+            not weighted). None until the first dense evaluation.
+    """
+
+    def __init__(self):
+        self.pairs = None
+        self._buffers = dict()
+
+    def buffer(self, name, shape, dtype=np.float64):
+        """Returns a contiguous array of given shape and type, backed
+        by the buffer of given name. Its content is undefined."""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if name not in self._buffers or self._buffers[name].nbytes < nbytes:
+            self._buffers[name] = np.empty(nbytes, dtype=np.uint8)
+        return self._buffers[name][:nbytes].view(dtype).reshape(shape)
+
+    def nbytes(self):
+        """Returns the memory used by the buffers, in bytes."""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def __getstate__(self):
+        return { 'pairs': None, '_buffers': dict() }
+
+
+def restraint_energy(coords, rows, cols, mu, sigma, weights=None, workspace=None):
+    """Computes the negative log-likelihood of a list of restraints,
+    up to a constant: 0.5 * sum_k w_k ((d_k - mu_k) / sigma_k) ** 2,
+    where d_k is the distance between atoms `rows[k]` and `cols[k]`.
+    Distances are computed in the type of the parameters, and the terms
+    are summed in double precision.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (n, 3), or
+            (n_solutions, n, 3), of coordinates.
+        rows (:obj:`np.ndarray`): Array of shape (n_restraints,)
+            of first atoms of the restraints.
+        cols (:obj:`np.ndarray`): Array of shape (n_restraints,)
+            of second atoms of the restraints.
+        mu (:obj:`np.ndarray`): Array of shape (n_restraints,)
+            of expected distances.
+        sigma (:obj:`np.ndarray`): Array of shape (n_restraints,)
+            of standard deviations.
+        weights (:obj:`np.ndarray`): Array of shape (n_restraints,)
+            of weights, or None if restraints are not weighted.
+        workspace (:obj:`Workspace`): Scratch buffers of the NumPy
+            backend. Buffers are allocated for this call only if None.
+
+    Returns:
+        float: Negative log-likelihood, or array of shape (n_solutions,).
+    """
+    if _backend == 'numba':
+        coords = np.ascontiguousarray(coords, dtype=mu.dtype)
+        weighted = weights is not None
+        weights = weights if weighted else mu
+        if coords.ndim == 2:
+            return _numba_restraint_energy(coords, rows, cols, mu, sigma, weights, weighted)
+        return _numba_restraint_energy_batch(coords, rows, cols, mu, sigma, weights, weighted)
+    if workspace is None:
+        workspace = Workspace()
+    delta = restraint_deltas(coords, rows, cols, mu.dtype, workspace=workspace)
+    values = _restraint_distances(delta, workspace)
+    values -= mu
+    values /= sigma
+    np.square(values, out=values)
+    if weights is not None:
+        values *= weights
+    return 0.5 * values.sum(axis=-1, dtype=np.float64)
+
+
+def restraint_gradient(coords, rows, cols, mu, sigma, weights=None, grad=None, workspace=None):
+    """Computes the gradient of `restraint_energy` with respect to the
+    coordinates of a single solution.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (n, 3) of coordinates.
+        rows, cols, mu, sigma, weights: See `restraint_energy`.
+        grad (:obj:`np.ndarray`): Array of shape (n, 3) to which
+            the gradient is added. A new array is created if None.
+        workspace (:obj:`Workspace`): See `restraint_energy`.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (n, 3) of derivatives.
+    """
+    n_atoms = len(coords)
+    if grad is None:
+        grad = np.zeros((n_atoms, 3), dtype=np.float64)
+    if _backend == 'numba':
+        coords = np.ascontiguousarray(coords, dtype=mu.dtype)
+        weighted = weights is not None
+        weights = weights if weighted else mu
+        _numba_restraint_gradient(coords, rows, cols, mu, sigma, weights, weighted,
+                                  numba.get_num_threads(), grad)
+        return grad
+    if workspace is None:
+        workspace = Workspace()
+    delta = restraint_deltas(coords, rows, cols, mu.dtype, workspace=workspace)
+    distances = _restraint_distances(delta, workspace)
+    F = workspace.buffer('forces', distances.shape, distances.dtype)
+    np.subtract(distances, mu, out=F)
+    distances *= sigma
+    distances *= sigma
+    F /= distances
+    if weights is not None:
+        F *= weights
+    invalid = workspace.buffer('invalid', F.shape, np.bool_)
+    np.isfinite(F, out=invalid)
+    np.logical_not(invalid, out=invalid)
+    np.copyto(F, 0., where=invalid)
+
+    # Accumulate the contribution of each pair on both atoms
+    for k in range(3):
+        delta[k] *= F
+        grad[:, k] += np.bincount(rows, weights=delta[k], minlength=n_atoms)
+        grad[:, k] -= np.bincount(cols, weights=delta[k], minlength=n_atoms)
+    return grad
+
+
+def restraint_deltas(coords, rows, cols, dtype, workspace=None):
+    """Computes the vectors going from atoms `cols` to atoms `rows`,
+    as an array of shape (..., 3, n_restraints). Coordinates are gathered
+    along the last axis, which is much faster than gathering rows of
+    3 values. If a workspace is given, the returned array is one of its
+    buffers, which is overwritten by the next call."""
+    if workspace is None:
+        coords = np.ascontiguousarray(np.swapaxes(coords, -1, -2), dtype=dtype)
+        delta = np.take(coords, rows, axis=-1)
+        delta -= np.take(coords, cols, axis=-1)
+        return delta
+    coords = np.asarray(coords)
+    shape = coords.shape[:-2] + (3,)
+    transposed = workspace.buffer('coords', shape + coords.shape[-2:-1], dtype)
+    np.copyto(transposed, np.swapaxes(coords, -1, -2))
+    delta = workspace.buffer('delta', shape + rows.shape, dtype)
+    other = workspace.buffer('other', shape + rows.shape, dtype)
+    np.take(transposed, rows, axis=-1, out=delta, mode='clip')
+    np.take(transposed, cols, axis=-1, out=other, mode='clip')
+    delta -= other
+    return delta
+
+
+def _restraint_distances(delta, workspace):
+    # Norms of the vectors returned by `restraint_deltas`
+    squares = workspace.buffer('squares', delta.shape, delta.dtype)
+    distances = workspace.buffer('distances', delta.shape[:-2] + delta.shape[-1:], delta.dtype)
+    np.square(delta, out=squares)
+    np.add(squares[..., 0, :], squares[..., 1, :], out=distances)
+    distances += squares[..., 2, :]
+    return np.sqrt(distances, out=distances)
+
+
+def dense_energy(coords, mu, sigma, weights=None, workspace=None):
+    """Computes the negative log-likelihood of the restraints stored as
+    symmetric matrices, where unrestrained pairs have a `mu` of NaN.
+    Distances are computed in double precision.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (n, 3) of coordinates.
+        mu (:obj:`np.ndarray`): Array of shape (n, n) of expected distances.
+        sigma (:obj:`np.ndarray`): Array of shape (n, n) of standard deviations.
+        weights (:obj:`np.ndarray`): Array of shape (n, n) of weights,
+            or None if restraints are not weighted.
+        workspace (:obj:`Workspace`): Scratch buffers of the NumPy backend,
+            and list of the restrained pairs of `mu`. Both are computed
+            for this call only if None.
+
+    Returns:
+        float: Negative log-likelihood.
+    """
+    if _backend == 'numba':
+        weighted = weights is not None
+        weights = weights if weighted else mu
+        return _numba_dense_energy(
+            np.ascontiguousarray(coords, dtype=np.float64), mu, sigma, weights, weighted)
+    if workspace is None:
+        workspace = Workspace()
+    n = len(coords)
+    if workspace.pairs is None:
+        rows, cols = np.nonzero(~np.isnan(mu))
+        rows, cols = rows[rows > cols], cols[rows > cols]
+        workspace.pairs = (rows * n + cols, mu[rows, cols], sigma[rows, cols],
+                           None if weights is None else weights[rows, cols])
+    indices, mu, sigma, weights = workspace.pairs
+
+    D = workspace.buffer('distance_matrix', (n, n))
+    scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=D)
+    values = workspace.buffer('values', indices.shape)
+    np.take(D.reshape(-1), indices, out=values, mode='clip')
+    values -= mu
+    values /= sigma
+    np.square(values, out=values)
+    if weights is not None:
+        values *= weights
+    return 0.5 * values.sum()
+
+
+def dense_gradient(coords, mu, sigma, weights=None, workspace=None):
+    """Computes the gradient of `dense_energy` with respect to
+    the coordinates.
+
+    Parameters:
+        coords, mu, sigma, weights, workspace: See `dense_energy`.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (n, 3) of derivatives.
+    """
+    if _backend == 'numba':
+        weighted = weights is not None
+        grad = np.empty((len(coords), 3), dtype=np.float64)
+        _numba_dense_gradient(np.ascontiguousarray(coords, dtype=np.float64), mu, sigma,
+                              weights if weighted else mu, weighted, grad)
+        return grad
+    if workspace is None:
+        workspace = Workspace()
+    n = len(coords)
+    D = workspace.buffer('distance_matrix', (n, n))
+    scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=D)
+    F = workspace.buffer('force_matrix', (n, n))
+    np.subtract(D, mu, out=F)
+    D *= sigma
+    D *= sigma
+    F /= D
+    if weights is not None:
+        F *= weights
+
+    # Unrestrained pairs have a NaN force, and pairs of
+    # superimposed atoms have a null direction
+    invalid = workspace.buffer('invalid', (n, n), np.bool_)
+    np.isfinite(F, out=invalid)
+    np.logical_not(invalid, out=invalid)
+    np.copyto(F, 0., where=invalid)
+
+    # Row i of the gradient is sum_j F_ij (x_i - x_j). The sums of
+    # the rows of F come from the product with a column of ones.
+    augmented = workspace.buffer('augmented', (n, 4))
+    augmented[:, :3], augmented[:, 3] = coords, 1.
+    products = workspace.buffer('products', (n, 4))
+    np.dot(F, augmented, out=products)
+    grad = products[:, 3:] * coords
+    grad -= products[:, :3]
+    return grad
+
+
+def bound_violations(coords, lb, ub, indices, out=None):
+    """Counts the pairs of atoms whose distance lies
+    outside of its lower and upper bounds.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (n, 3) of coordinates.
+        lb (:obj:`np.ndarray`): Array of shape (n, n) of lower bounds.
+        ub (:obj:`np.ndarray`): Array of shape (n, n) of upper bounds.
+        indices (tuple): Indices of the pairs to check.
+        out (:obj:`np.ndarray`): Array of shape (n, n) where the NumPy
+            backend stores the distance matrix.
+
+    Returns:
+        int: Number of violated bounds.
+    """
+    if _backend == 'numba':
+        rows, cols = indices
+        return _numba_bound_violations(
+            np.ascontiguousarray(coords, dtype=np.float64), lb, ub, rows, cols)
+    out = scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=out)
+    distances = out[indices]
+    return int((distances < lb[indices]).sum() + (distances > ub[indices]).sum())
+
+
+if numba is not None:
+
+    # Each loop computes the terms of the restraints one at a time, and
+    # loops over restraints (or over solutions) are split between threads
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_restraint_energy(coords, rows, cols, mu, sigma, weights, weighted):
+        total = 0.
+        for p in numba.prange(len(rows)):
+            i, j = rows[p], cols[p]
+            d = np.sqrt((coords[i, 0] - coords[j, 0]) ** 2 +
+                        (coords[i, 1] - coords[j, 1]) ** 2 +
+                        (coords[i, 2] - coords[j, 2]) ** 2)
+            value = ((d - mu[p]) / sigma[p]) ** 2
+            if weighted:
+                value *= weights[p]
+            total += value
+        return 0.5 * total
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_restraint_energy_batch(coords, rows, cols, mu, sigma, weights, weighted):
+        energies = np.empty(coords.shape[0], dtype=np.float64)
+        for s in numba.prange(coords.shape[0]):
+            x = coords[s]
+            total = 0.
+            for p in range(len(rows)):
+                i, j = rows[p], cols[p]
+                d = np.sqrt((x[i, 0] - x[j, 0]) ** 2 +
+                            (x[i, 1] - x[j, 1]) ** 2 +
+                            (x[i, 2] - x[j, 2]) ** 2)
+                value = ((d - mu[p]) / sigma[p]) ** 2
+                if weighted:
+                    value *= weights[p]
+                total += value
+            energies[s] = 0.5 * total
+        return energies
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_restraint_gradient(coords, rows, cols, mu, sigma, weights, weighted,
+                                  n_chunks, grad):
+        # Each thread accumulates the contributions of a contiguous
+        # chunk of restraints in its own copy of the gradient
+        chunk_size = (len(rows) + n_chunks - 1) // n_chunks
+        partial = np.zeros((n_chunks, grad.shape[0], 3), dtype=np.float64)
+        for c in numba.prange(n_chunks):
+            for p in range(c * chunk_size, min((c + 1) * chunk_size, len(rows))):
+                i, j = rows[p], cols[p]
+                d = np.sqrt((coords[i, 0] - coords[j, 0]) ** 2 +
+                            (coords[i, 1] - coords[j, 1]) ** 2 +
+                            (coords[i, 2] - coords[j, 2]) ** 2)
+                F = (d - mu[p]) / (d * sigma[p] ** 2)
+                if weighted:
+                    F *= weights[p]
+                if not np.isfinite(F):
+                    continue
+                for k in range(3):
+                    g = F * (coords[i, k] - coords[j, k])
+                    partial[c, i, k] += g
+                    partial[c, j, k] -= g
+        for c in range(n_chunks):
+            grad += partial[c]
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_dense_energy(coords, mu, sigma, weights, weighted):
+        total = 0.
+        for i in numba.prange(coords.shape[0]):
+            for j in range(i):
+                if np.isnan(mu[i, j]):
+                    continue
+                d = np.sqrt((coords[i, 0] - coords[j, 0]) ** 2 +
+                            (coords[i, 1] - coords[j, 1]) ** 2 +
+                            (coords[i, 2] - coords[j, 2]) ** 2)
+                value = ((d - mu[i, j]) / sigma[i, j]) ** 2
+                if weighted:
+                    value *= weights[i, j]
+                total += value
+        return 0.5 * total
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_dense_gradient(coords, mu, sigma, weights, weighted, grad):
+        # Each thread computes whole rows of the gradient, from
+        # the symmetric matrices, so that no write is shared
+        for i in numba.prange(coords.shape[0]):
+            g0, g1, g2 = 0., 0., 0.
+            for j in range(coords.shape[0]):
+                if j == i or np.isnan(mu[i, j]):
+                    continue
+                d0 = coords[i, 0] - coords[j, 0]
+                d1 = coords[i, 1] - coords[j, 1]
+                d2 = coords[i, 2] - coords[j, 2]
+                d = np.sqrt(d0 ** 2 + d1 ** 2 + d2 ** 2)
+                F = (d - mu[i, j]) / (d * sigma[i, j] ** 2)
+                if weighted:
+                    F *= weights[i, j]
+                if not np.isfinite(F):
+                    continue
+                g0 += F * d0
+                g1 += F * d1
+                g2 += F * d2
+            grad[i, 0], grad[i, 1], grad[i, 2] = g0, g1, g2
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_bound_violations(coords, lb, ub, rows, cols):
+        count = 0
+        for p in numba.prange(len(rows)):
+            i, j = rows[p], cols[p]
+            d = np.sqrt((coords[i, 0] - coords[j, 0]) ** 2 +
+                        (coords[i, 1] - coords[j, 1]) ** 2 +
+                        (coords[i, 2] - coords[j, 2]) ** 2)
+            if d < lb[i, j]:
+                count += 1
+            if d > ub[i, j]:
+                count += 1
+        return count
+
+
+set_backend(os.environ.get('GAUSSFOLD_BACKEND', 'auto'))
@@ -5,7 +5,7 @@
 import scipy.optimize
 
 
-def lbfgs(initial_solution, model, verbose=True):
+def lbfgs(initial_solution, model, verbose=True, continuation=None):
     """Run L-BFGS on an initial solution,
     with given objective function.
 
@@ -15,6 +15,9 @@ def lbfgs(initial_solution, model, verbose=True):
             of residues in the protein.
         model (:obj:`gaussfold.Model`): Gaussian model.
         verbose (bool): Whether to display messages in stdout.
+        continuation (:obj:`gaussfold.Continuation`, optional): Schedule
+            of the Gaussian model. If provided, L-BFGS is run once per
+            stage, each run starting from the solution of the previous one.
 
     Returns:
         :obj:`np.ndarray`: Locally optimal solution.
@@ -37,8 +40,14 @@ def lbfgs(initial_solution, model, verbose=True):
         if verbose:
             print('L-BFGS: %f' % obj(x))
 
-    # Solve the optimization problem
-    x0 = initial_solution.flatten()
-    res = scipy.optimize.minimize(
-        obj, x0, jac=jac, method='L-BFGS-B', callback=callback)
-    return res.x.reshape(L, 3)
+    # Solve the optimization problem, for each stage
+    # of the continuation schedule
+    x = initial_solution.flatten()
+    n_stages = 1 if continuation is None else continuation.n_stages
+    for stage in range(n_stages):
+        if continuation is not None:
+            continuation.apply(model, stage)
+        res = scipy.optimize.minimize(
+            obj, x, jac=jac, method='L-BFGS-B', callback=callback)
+        x = res.x
+    return x.reshape(L, 3)
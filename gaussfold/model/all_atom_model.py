@@ -2,8 +2,9 @@
 # all_atom_model.py
 # author : Antoine Passemiers
 
+from gaussfold import kernels
+
 import numpy as np
-import scipy.spatial
 
 
 class AllAtomModel:
@@ -44,12 +45,8 @@ class AllAtomModel:
     def evaluate(self, coords):
         self.chain.set_atoms_coords(coords)
         
-        scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=self.distances)
-        distances = self.distances[self.triu_indices]
-        lb = self.lb[self.triu_indices]
-        ub = self.ub[self.triu_indices]
-        cost = (distances < lb).sum()
-        cost += (distances > ub).sum()
+        cost = kernels.bound_violations(
+            coords, self.lb, self.ub, self.triu_indices, out=self.distances)
 
         phi, psi = self.chain.dihedral_angles()
         cost += (phi < self.phi_lb).sum()
@@ -3,7 +3,11 @@
 # author : Antoine Passemiers
 
 from gaussfold.constraints.gaussian_constraint import GaussianConstraint
+from gaussfold.constraints.repulsion import Repulsion
+from gaussfold.octree import Octree
+from gaussfold import kernels
 
+import itertools
 import numpy as np
 import scipy.spatial
 
@@ -14,29 +18,98 @@ class AminoAcidModel:
     Attributes:
         mu (np.ndarray): Array of shape (L, L) where element (i, j)
             is the average expected distance between residues i and j.
+            Only built in dense mode.
         sigma (np.ndarray): Array of shape (L, L) where element (i, j)
             is the standard deviation of expected distance between
-            residues i and j.
+            residues i and j. Only built in dense mode.
         weights (np.ndarray): Array of shape (L, L) where element (i, j)
             is the weight of restraint (i, j) in the log-likelihood.
+            Only built in dense mode.
         weighted (bool): Whether restraints are weighted
+        mode (str): Evaluation mode. 'dense' computes all pairwise
+            distances and masks out unrestrained pairs, while 'sparse'
+            only computes distances over the list of restrained pairs.
+            'tiled' computes the distances of blocks of `TILE_SIZE` x
+            `TILE_SIZE` pairs, and keeps the restraints of each block in
+            a list, so that the memory used by the model grows with the
+            number of restraints instead of the square of the number of atoms.
+            'octree' approximates the `Repulsion` restraints (applied to
+            all pairs) with a Barnes-Hut octree, in O(L log L) operations,
+            and computes the other restraints exactly.
+        dtype (type): Floating-point type of the parameters of the
+            restraints, and of the distances computed over lists of
+            restraints (sparse mode, banded and center of mass restraints,
+            corrections of octree mode). Dense and tiled modes compute
+            distances in double precision. Log-likelihoods are always
+            summed in double precision.
+        sigma_scale (float): Factor applied to the standard deviations
+            of all restraints, for example to smooth the log-likelihood
+            during the first stages of a continuation schedule.
+        opening_angle (float): Opening criterion of the octree in
+            'octree' mode. Larger values are faster but less accurate.
+
+    Dense and sparse evaluations and gradients are computed by the kernel
+    backend selected with `gaussfold.kernels.set_backend`. Their scratch
+    buffers are kept in a workspace, created each time the restraints
+    are compiled, so that repeated evaluations do not allocate arrays.
+
+    In sparse mode, restraints between atoms whose ids differ by at most
+    `BAND_WIDTH` (the backbone and secondary structure restraints, when
+    atoms are registered in sequence order with `add_atoms`) are stored
+    as dense diagonals and evaluated with strided slices of the
+    coordinates. Only the other restraints go through index gathering.
+
+    Restraints involving the center of mass (`Interior` and `Exterior`)
+    are not restraints on an additional point: the center of mass is
+    computed analytically as the centroid of the residues, and its
+    contribution is included in the log-likelihood and its derivatives.
+
+    Each compiled restraint is tagged with the label of its constraint
+    (see `GaussianConstraint.label`), so that the energy can be broken
+    down by class of restraints and by residue.
     """
 
-    def __init__(self, weighted=False):
+    # Identifier of the center of mass in the pairs of atoms
+    CENTER = -1
+
+    # Largest difference of atom ids of the banded restraints
+    BAND_WIDTH = 5
+
+    # Number of rows and columns of the blocks of pairs in tiled mode
+    TILE_SIZE = 256
+
+    def __init__(self, weighted=False, mode='dense', dtype=np.float64):
+        assert(mode in ['dense', 'sparse', 'tiled', 'octree'])
         self._constraints = list()
+        self._atoms = list()
         self._atom_to_id = dict()
         self._id_to_atom = dict()
         self._initialized = False
         self._weighted = weighted
+        self._mode = mode
+        self._dtype = dtype
+        self._sigma_scale = 1.
+        self._opening_angle = 0.5
+        self._surrogate = None
+        self._labels = list()
 
-    def _initialize_matrices(self, n_atoms):
+    def _initialize_parameters(self, n_atoms):
         self._n_atoms = n_atoms
-        self._mu = np.full((n_atoms, n_atoms), np.nan, dtype=np.float)
-        self._sigma = np.full((n_atoms, n_atoms), np.nan, dtype=np.float)
-        self._weights = np.ones((n_atoms, n_atoms), dtype=np.float)
-        self._triu_indices = np.triu_indices(n_atoms, k=-1)
-        self._tril_indices = np.tril_indices(n_atoms, k=0)
-        self._distances = np.empty((n_atoms, n_atoms), dtype=np.float)
+        self._center_mu = np.full(n_atoms, np.nan, dtype=self._dtype)
+        self._center_sigma = np.full(n_atoms, np.nan, dtype=self._dtype)
+        self._center_weights = np.ones(n_atoms, dtype=self._dtype)
+        self._center_classes = np.full(n_atoms, -1, dtype=np.int16)
+
+        # Parameters (mu, sigma, weight, class id) of each
+        # restrained pair (i, j), with i > j
+        self._table = dict()
+
+    def add_atoms(self, atoms):
+        """Registers atoms in a given order, for example the residues
+        in sequence order. Registered atoms come first in the coordinates
+        of the model, followed by the other atoms of the constraints."""
+        self._atoms.extend(atoms)
+        self._initialized = False
 
     def add_constraint(self, constraint):
         if constraint not in self._constraints:
@@ -44,30 +117,216 @@ class AminoAcidModel:
         self._initialized = False
 
     def initialize(self):
-        atoms = set()
-        atoms.add(GaussianConstraint.__CENTER_OF_MASS__)
+        atoms = dict.fromkeys(self._atoms)
         for constraint in self._constraints:
             for atom in constraint.atoms():
-                atoms.add(atom)
+                if atom is not GaussianConstraint.__CENTER_OF_MASS__:
+                    atoms[atom] = None
         atoms = list(atoms)
         self._atom_to_id = { atom: i for i, atom in enumerate(atoms) }
         self._id_to_atom = { i: atom for i, atom in enumerate(atoms) }
 
-        self._initialize_matrices(len(atoms))
+        self._initialize_parameters(len(atoms))
+        self._labels = list()
 
+        # When several constraints apply to the same pair of atoms,
+        # the last one added to the model is the one used
+        self._pair_constraints = dict()
         for constraint in self._constraints:
-            atom_a, atom_b = constraint.atoms()
-            i = self._atom_to_id[atom_a]
-            j = self._atom_to_id[atom_b]
+            i, j = self._pair(constraint)
+            self._pair_constraints.setdefault((i, j), list()).append(constraint)
             mu = constraint.mu()
             sigma = constraint.sigma()
             weight = constraint.weight()
-            self._add_restraint(i, j, mu, sigma, weight=weight)
+            self._add_restraint(i, j, mu, sigma, weight=weight, label=constraint.label())
 
         self._initialized = True
         self._weighted = False # TODO
+        self._compile()
         return self
 
+    def _pair(self, constraint):
+        atom_a, atom_b = constraint.atoms()
+        i = self.atom_id(atom_a)
+        j = self.atom_id(atom_b)
+        return max(i, j), min(i, j)
+
+    def atom_id(self, atom):
+        """Returns the index of an atom in the coordinates of the model,
+        or `AminoAcidModel.CENTER` for the center of mass."""
+        if atom is GaussianConstraint.__CENTER_OF_MASS__:
+            return AminoAcidModel.CENTER
+        return self._atom_to_id[atom]
+
+    def pair_constraints(self, atom_a, atom_b):
+        """Returns the constraints applied to a pair of atoms,
+        in the order they were added to the model."""
+        i, j = self.atom_id(atom_a), self.atom_id(atom_b)
+        return list(self._pair_constraints.get((max(i, j), min(i, j)), list()))
+
+    def update_constraints(self, added=(), removed=()):
+        """Adds and removes constraints without re-initializing the model.
+        Only the parameters of the affected pairs of atoms are updated.
+        Atoms of the added constraints must already be part of the model.
+
+        Parameters:
+            added (list): Constraints to add to the model.
+            removed (list): Constraints to remove from the model.
+        """
+        assert(self._initialized)
+        pairs = set()
+        for constraint in removed:
+            pair = self._pair(constraint)
+            self._pair_constraints[pair].remove(constraint)
+            self._constraints.remove(constraint)
+            pairs.add(pair)
+        for constraint in added:
+            pair = self._pair(constraint)
+            self._pair_constraints.setdefault(pair, list()).append(constraint)
+            self._constraints.append(constraint)
+            pairs.add(pair)
+
+        for i, j in pairs:
+            constraints = self._pair_constraints.get((i, j), list())
+            if len(constraints) > 0:
+                constraint = constraints[-1]
+                self._add_restraint(i, j, constraint.mu(), constraint.sigma(),
+                                    weight=constraint.weight(), label=constraint.label())
+            elif j == AminoAcidModel.CENTER:
+                self._center_mu[i] = self._center_sigma[i] = np.nan
+                self._center_weights[i] = 1.
+                self._center_classes[i] = -1
+            else:
+                self._table.pop((i, j), None)
+        self._weighted = False # TODO
+        self._compile()
+
+    def _compile(self):
+        """Builds the list of restrained pairs, sorted by row and column.
+        Each restrained pair (i, j) is stored once, with i > j. Then builds
+        the structures of the evaluation mode, and the list of atoms
+        restrained to the center of mass."""
+        self._workspace = kernels.Workspace()
+        n_pairs = len(self._table)
+        pairs = np.fromiter(itertools.chain.from_iterable(self._table.keys()),
+                            dtype=np.int64, count=2 * n_pairs).reshape(n_pairs, 2)
+        params = np.asarray(list(self._table.values()), dtype=np.float64).reshape(n_pairs, 4)
+        order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        self._rows, self._cols = pairs[order, 0], pairs[order, 1]
+        mu, sigma, weights, classes = params[order].T
+        self._pair_mu = mu.astype(self._dtype)
+        self._pair_sigma = (sigma * self._sigma_scale).astype(self._dtype)
+        self._pair_weights = weights.astype(self._dtype)
+        self._pair_classes = classes.astype(np.int16)
+        self._n_informative = int(np.sum((mu != Repulsion.__MU__) | (sigma != Repulsion.__SIGMA__)))
+
+        # Only dense mode allocates matrices of shape (L, L)
+        self._mu = self._sigma = self._weights = None
+        if self._mode == 'dense':
+            self._compile_dense(mu, sigma, weights)
+        elif self._mode == 'sparse':
+            self._compile_band()
+        elif self._mode == 'tiled':
+            self._compile_tiles()
+        elif self._mode == 'octree':
+            self._compile_corrections(mu, sigma, weights)
+
+        self._center_atoms = np.where(~np.isnan(self._center_mu))[0]
+        self._center_pair_mu = self._center_mu[self._center_atoms].astype(self._dtype)
+        self._center_pair_sigma = self._center_sigma[self._center_atoms].astype(self._dtype)
+        self._center_pair_sigma *= self._sigma_scale
+        self._center_pair_weights = self._center_weights[self._center_atoms].astype(self._dtype)
+        self._center_pair_classes = self._center_classes[self._center_atoms]
+        if self._surrogate is not None:
+            self.set_surrogate(*self._surrogate)
+
+    def _compile_dense(self, mu, sigma, weights):
+        # Symmetric matrices of parameters. Unrestrained pairs
+        # have a mean and a standard deviation of NaN.
+        n = self._n_atoms
+        self._mu = np.full((n, n), np.nan, dtype=self._dtype)
+        self._sigma = np.full((n, n), np.nan, dtype=self._dtype)
+        self._weights = np.ones((n, n), dtype=self._dtype)
+        for matrix, values in [(self._mu, mu), (self._sigma, sigma), (self._weights, weights)]:
+            matrix[self._rows, self._cols] = matrix[self._cols, self._rows] = values
+
+    def _compile_band(self):
+        # Restraints far from the diagonal, evaluated by index gathering
+        offsets = self._rows - self._cols
+        far = (offsets > AminoAcidModel.BAND_WIDTH)
+        self._far_rows, self._far_cols = self._rows[far], self._cols[far]
+        self._far_mu, self._far_sigma = self._pair_mu[far], self._pair_sigma[far]
+        self._far_weights = self._pair_weights[far]
+
+        # Diagonal k of the band holds the restraints (i + k, i). Pairs
+        # without restraint get a weight of zero.
+        self._band = list()
+        for k in range(1, min(AminoAcidModel.BAND_WIDTH, self._n_atoms - 1) + 1):
+            restrained = (offsets == k)
+            if not restrained.any():
+                continue
+            cols = self._cols[restrained]
+            mu = np.zeros(self._n_atoms - k, dtype=self._dtype)
+            sigma = np.ones(self._n_atoms - k, dtype=self._dtype)
+            weights = np.zeros(self._n_atoms - k, dtype=self._dtype)
+            mu[cols], sigma[cols] = self._pair_mu[restrained], self._pair_sigma[restrained]
+            weights[cols] = self._pair_weights[restrained] if self._weighted else 1.
+            self._band.append((k, mu, sigma, weights))
+
+    def _compile_tiles(self):
+        # Restraints of each non-empty block of pairs, with their
+        # row and column indices relative to the block
+        size = AminoAcidModel.TILE_SIZE
+        n, n_blocks = self._n_atoms, (self._n_atoms + size - 1) // size
+        keys = (self._rows // size) * n_blocks + self._cols // size
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        self._tile_list = list()
+        for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(keys)]))):
+            if start == end:
+                continue
+            a, b = divmod(int(keys[start]), n_blocks)
+            a, b = a * size, b * size
+            indices = order[start:end]
+            self._tile_list.append((
+                slice(a, min(a + size, n)), slice(b, min(b + size, n)),
+                self._rows[indices] - a, self._cols[indices] - b,
+                self._pair_mu[indices], self._pair_sigma[indices], self._pair_weights[indices]))
+
+    def _compile_corrections(self, mu, sigma, weights):
+        # In octree mode, Repulsion restraints are applied to all pairs,
+        # and the other pairs correct for it: their own restraint is added
+        # and the repulsion is subtracted
+        background = (mu == Repulsion.__MU__) & (sigma == Repulsion.__SIGMA__)
+        if self._weighted:
+            background &= (weights == 1.)
+        correction = ~background
+        rows, cols = self._rows[correction], self._cols[correction]
+        mu, sigma = mu[correction], sigma[correction]
+        weights = weights[correction] if self._weighted else np.ones(len(mu))
+
+        # Unrestrained pairs only subtract the repulsion. Pairs are
+        # enumerated only if some of them have no restraint.
+        n = self._n_atoms
+        n_pairs = n * (n - 1) // 2
+        if len(self._rows) < n_pairs:
+            # Pair (i, j) has index i * (i - 1) / 2 + j in the lower triangle
+            restrained = np.zeros(n_pairs, dtype=np.bool_)
+            restrained[self._rows * (self._rows - 1) // 2 + self._cols] = True
+            indices = np.flatnonzero(~restrained)
+            i = np.floor((1. + np.sqrt(1. + 8. * indices)) / 2.).astype(np.int64)
+            i -= (i * (i - 1) // 2 > indices)
+            i += ((i + 1) * i // 2 <= indices)
+            rows, cols = np.concatenate((rows, i)), np.concatenate((cols, indices - i * (i - 1) // 2))
+            mu = np.concatenate((mu, np.zeros(len(indices))))
+            sigma = np.concatenate((sigma, np.ones(len(indices))))
+            weights = np.concatenate((weights, np.zeros(len(indices))))
+        self._correction_rows, self._correction_cols = rows, cols
+        self._correction_mu = mu.astype(self._dtype)
+        self._correction_sigma = (sigma * self._sigma_scale).astype(self._dtype)
+        self._correction_weights = weights.astype(self._dtype)
+
     def set_coords(self, coords):
         for i in range(len(coords)):
             atom = self._id_to_atom[i]
@@ -75,12 +334,12 @@ class AminoAcidModel:
 
     def get_coords(self):
         assert(self._initialized)
-        coords = np.empty((self._n_atoms, 3), dtype=np.float)
+        coords = np.empty((self._n_atoms, 3), dtype=np.float64)
         for i in range(self._n_atoms):
             coords[i, :] = self._id_to_atom[i].get_coords()
         return np.nan_to_num(coords)
 
-    def _add_restraint(self, i, j, mu, sigma, weight=1.):
+    def _add_restraint(self, i, j, mu, sigma, weight=1., label=None):
         """Adds Gaussian restraint to the model.
 
         Parameters:
@@ -89,66 +348,518 @@ class AminoAcidModel:
             mu (float): Average expected distance
             sigma (float): Standard deviation of expected distance
             weight (float): Restraint weight in the log-likelihood
+            label (str): Class of the restraint
         """
-        self._mu[i, j] = self._mu[j, i] = mu
-        self._sigma[i, j] = self._sigma[j, i] = sigma
-        self._weights[i, j] = self._weights[j, i] = weight
+        if label not in self._labels:
+            self._labels.append(label)
+        class_id = self._labels.index(label)
+        if j == AminoAcidModel.CENTER:
+            self._center_mu[i], self._center_sigma[i] = mu, sigma
+            self._center_weights[i] = weight
+            self._center_classes[i] = class_id
+            if weight != 1.:
+                self._weighted = True
+            return
+        self._table[(i, j)] = (mu, sigma, weight, class_id)
         if weight != 1.:
             self._weighted = True
 
-    def evaluate(self, coords):
+    def evaluate(self, coords, breakdown=False):
         """Computes log-likelihood given the Gaussian parameters `mu` and `sigma`.
 
         Parameters:
             coords (np.ndarray): Array of shape (L, 3) where ith sub-array represents
                 the coordinates of residue i in three-dimensional space.
+            breakdown (bool): Whether to break the energy (the opposite of
+                the log-likelihood) down by class of restraints and by residue.
+                The log-likelihood and both breakdowns are then computed in
+                a single pass over the list of restraints, whatever the mode.
 
         Returns:
             float: Log-likelihood of the coordinates given the Gaussian parameters.
+                If `breakdown` is true, a tuple containing the log-likelihood,
+                a dictionary mapping each label of restraints to its energy,
+                and an array of shape (L,) of energies of the residues
+                (see `residue_energies`).
         """
-        scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=self._distances)
-        distances = self._distances[self._tril_indices]
-        mu, sigma = self._mu[self._tril_indices], self._sigma[self._tril_indices]
+        if breakdown:
+            return self._evaluate_breakdown(coords)
+        if self._mode == 'sparse':
+            return self._evaluate_sparse(coords)
+        elif self._mode == 'tiled':
+            return self._evaluate_tiled(coords)
+        elif self._mode == 'octree':
+            return -self._energy_octree(coords)[0] + self._evaluate_center(coords)
+        energy = kernels.dense_energy(
+            coords, self._mu, self._sigma, weights=(self._weights if self._weighted else None),
+            workspace=self._workspace)
+        return -energy / self._sigma_scale ** 2. + self._evaluate_center(coords)
+
+    def _pair_deltas(self, coords, rows=None, cols=None):
+        rows = self._rows if rows is None else rows
+        cols = self._cols if cols is None else cols
+        return kernels.restraint_deltas(coords, rows, cols, self._dtype)
+
+    def _evaluate_far(self, coords):
+        # Restraints outside of the band, for one or several solutions
+        return kernels.restraint_energy(
+            coords, self._far_rows, self._far_cols, self._far_mu, self._far_sigma,
+            weights=(self._far_weights if self._weighted else None), workspace=self._workspace)
+
+    def _evaluate_sparse(self, coords):
+        return -self._evaluate_far(coords) + self._evaluate_band(coords) + \
+            self._evaluate_center(coords)
+
+    def _evaluate_band(self, coords):
+        """Log-likelihood of the banded restraints,
+        for one or several solutions."""
+        coords = np.asarray(coords, dtype=self._dtype)
+        n = coords.shape[-2]
+        squares = self._workspace.buffer('band_squares', coords.shape, self._dtype)
+        values = self._workspace.buffer('band_values', coords.shape[:-1], self._dtype)
+        logp = 0.
+        for k, mu, sigma, weights in self._band:
+            delta, v = squares[..., :n - k, :], values[..., :n - k]
+            np.subtract(coords[..., k:, :], coords[..., :-k, :], out=delta)
+            np.square(delta, out=delta)
+            np.sum(delta, axis=-1, out=v)
+            np.sqrt(v, out=v)
+            v -= mu
+            v /= sigma
+            np.square(v, out=v)
+            v *= weights
+            logp += v.sum(axis=-1, dtype=np.float64)
+        return -0.5 * logp
+
+    def _gradient_band(self, coords, grad):
+        """Adds the gradient of the banded restraints."""
+        coords = np.asarray(coords, dtype=self._dtype)
+        for k, mu, sigma, weights in self._band:
+            delta = coords[k:] - coords[:-k]
+            distances = np.sqrt((delta ** 2.).sum(axis=1))
+            F = weights * (distances - mu) / (distances * sigma ** 2.)
+            delta *= np.nan_to_num(F)[:, np.newaxis]
+            grad[k:] += delta
+            grad[:-k] -= delta
+        return grad
 
-        indices = ~np.isnan(mu)
-        distances, mu, sigma = distances[indices], mu[indices], sigma[indices]
+    def _center_deltas(self, coords):
+        # Vectors going from the center of mass to the restrained atoms
+        center = coords.mean(axis=-2)[..., np.newaxis, :]
+        return coords[..., self._center_atoms, :] - center
 
-        logp = ((distances - mu) / sigma) ** 2.
+    def _evaluate_center(self, coords):
+        """Log-likelihood of the restraints to the center of mass,
+        for one or several solutions."""
+        if len(self._center_atoms) == 0:
+            return 0.
+        distances = np.sqrt((self._center_deltas(coords) ** 2.).sum(axis=-1))
+        logp = ((distances - self._center_pair_mu) / self._center_pair_sigma) ** 2.
         if self._weighted:
-            weights = self._weights[self._tril_indices]
-            logp *= weights[indices]
-        return -0.5 * logp.sum()
+            logp *= self._center_pair_weights
+        return -0.5 * logp.sum(axis=-1)
+
+    def _center_forces(self, coords):
+        # Derivatives of the negative log-likelihood of the restraints
+        # to the center of mass, with respect to the atom-center vectors
+        delta = self._center_deltas(coords)
+        distances = np.sqrt((delta ** 2.).sum(axis=-1))
+        F = (distances - self._center_pair_mu) / (distances * self._center_pair_sigma ** 2.)
+        if self._weighted:
+            F *= self._center_pair_weights
+        return np.nan_to_num(F)[:, np.newaxis] * delta
+
+    def _gradient_center(self, coords, grad):
+        """Adds the gradient of the restraints to the center of mass.
+        Each atom moves the center of mass by 1/n of its displacement."""
+        if len(self._center_atoms) == 0:
+            return grad
+        forces = self._center_forces(coords)
+        grad[self._center_atoms] += forces
+        grad -= forces.sum(axis=0) / len(coords)
+        return grad
+
+    def evaluate_batch(self, coords):
+        """Computes log-likelihood of several solutions at once.
+
+        Parameters:
+            coords (np.ndarray): Array of shape (n_solutions, L, 3) where
+                element k represents the coordinates of solution k.
+
+        Returns:
+            np.ndarray: Array of shape (n_solutions,) containing the
+                log-likelihood of each solution.
+        """
+        if self._mode != 'sparse':
+            return np.asarray([self.evaluate(x) for x in coords])
+        return -self._evaluate_far(coords) + self._evaluate_band(coords) + \
+            self._evaluate_center(coords)
 
     def gradient(self, coords):
-        """Computes gradient of log-likelihood given the Gaussian parameters `mu` and `sigma`,
-        with respect to 3D coordinates.
+        """Computes gradient of negative log-likelihood given the Gaussian parameters
+        `mu` and `sigma`, with respect to 3D coordinates.
+
+        Parameters:
+            coords (np.ndarray): Array of shape (L, 3) where ith sub-array represents
+                the coordinates of residue i in three-dimensional space.
+
+        Returns:
+            np.ndarray: Array of shape (L, 3) representing the negative log-likelihood
+                gradient with respect to 3D coordinates.
+        """
+        if self._mode == 'sparse':
+            return self._gradient_sparse(coords)
+        elif self._mode == 'tiled':
+            return self._gradient_tiled(coords)
+        elif self._mode == 'octree':
+            return self._gradient_center(coords, self._energy_octree(coords)[1])
+        grad = kernels.dense_gradient(
+            coords, self._mu, self._sigma, weights=(self._weights if self._weighted else None),
+            workspace=self._workspace)
+        if self._sigma_scale != 1.:
+            grad /= self._sigma_scale ** 2.
+        return self._gradient_center(coords, grad)
+
+    def _evaluate_tiled(self, coords):
+        logp = 0.
+        for rows, cols, i, j, mu, sigma, weights in self._tile_list:
+            D = scipy.spatial.distance.cdist(coords[rows], coords[cols], metric='euclidean')
+            values = ((D[i, j] - mu) / sigma) ** 2.
+            if self._weighted:
+                values *= weights
+            logp += values.sum(dtype=np.float64)
+        return -0.5 * logp + self._evaluate_center(coords)
+
+    def _gradient_tiled(self, coords):
+        # Contribution of each block of pairs on its rows is
+        # sum_j F_ij (x_i - x_j), and the opposite on its columns.
+        # Blocks on the diagonal only hold pairs (i, j) with i > j.
+        coords = np.asarray(coords, dtype=np.float64)
+        grad = np.zeros((self._n_atoms, 3), dtype=np.float64)
+        for rows, cols, i, j, mu, sigma, weights in self._tile_list:
+            X, Y = coords[rows], coords[cols]
+            D = scipy.spatial.distance.cdist(X, Y, metric='euclidean')
+            distances = D[i, j]
+            forces = (distances - mu) / (distances * sigma ** 2.)
+            if self._weighted:
+                forces *= weights
+            F = self._workspace.buffer('tile_forces', D.shape)
+            F.fill(0.)
+            F[i, j] = np.nan_to_num(forces)
+            grad[rows] += F.sum(axis=1)[:, np.newaxis] * X - np.dot(F, Y)
+            grad[cols] += F.sum(axis=0)[:, np.newaxis] * Y - np.dot(F.T, X)
+        return self._gradient_center(coords, grad)
+
+    def _energy_octree(self, coords):
+        """Negative log-likelihood of the pairwise restraints and its
+        gradient, where repulsions are approximated with an octree.
+        Since (d - mu) ** 2 = d ** 2 - 2 mu d + mu ** 2, only the sum of
+        the distances has to be approximated: the sum of the squared
+        distances over all pairs is n sum |x_i| ** 2 - |sum x_i| ** 2."""
+        coords = np.asarray(coords, dtype=np.float64)
+        n = len(coords)
+        mu, sigma = Repulsion.__MU__, Repulsion.__SIGMA__ * self._sigma_scale
+        distance_sum, distance_grad = Octree(coords).distance_sum(self._opening_angle)
+        total = coords.sum(axis=0)
+        squared_sum = n * (coords ** 2.).sum() - (total ** 2.).sum()
+        n_pairs = 0.5 * n * (n - 1)
+        energy = 0.5 * (squared_sum - 2. * mu * distance_sum + n_pairs * mu ** 2.) / sigma ** 2.
+        grad = (n * coords - total - mu * distance_grad) / sigma ** 2.
+
+        # Pairs whose restraint is not a repulsion
+        delta = self._pair_deltas(coords, self._correction_rows, self._correction_cols)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        energies = self._correction_weights * \
+            ((distances - self._correction_mu) / self._correction_sigma) ** 2.
+        energies -= ((distances - mu) / sigma) ** 2.
+        energy += 0.5 * energies.sum()
+        F = self._correction_weights * (distances - self._correction_mu) / \
+            (distances * self._correction_sigma ** 2.)
+        F -= (distances - mu) / (distances * sigma ** 2.)
+        delta *= np.nan_to_num(F)
+        for k in range(3):
+            grad[:, k] += np.bincount(self._correction_rows, weights=delta[k], minlength=n)
+            grad[:, k] -= np.bincount(self._correction_cols, weights=delta[k], minlength=n)
+        return energy, grad
+
+    def _gradient_sparse(self, coords):
+        grad = kernels.restraint_gradient(
+            coords, self._far_rows, self._far_cols, self._far_mu, self._far_sigma,
+            weights=(self._far_weights if self._weighted else None), workspace=self._workspace)
+        self._gradient_band(coords, grad)
+        return self._gradient_center(coords, grad)
+
+    def hessian_vector_product(self, coords, vector):
+        """Computes the product of the Hessian of the negative log-likelihood
+        with a vector, without forming the Hessian, in O(n_restraints) operations.
+
+        For a restrained pair with distance d and unit vector u between
+        its two residues, the Hessian block is (w / sigma ** 2) *
+        ((1 - mu / d) I + (mu / d) u u^T). The same blocks apply to the
+        vectors between atoms and the center of mass, which depend on
+        all atoms through the centroid.
 
         Parameters:
             coords (np.ndarray): Array of shape (L, 3) where ith sub-array represents
                 the coordinates of residue i in three-dimensional space.
+            vector (np.ndarray): Array of shape (L, 3) to be multiplied
+                by the Hessian.
 
         Returns:
-            np.ndarray: Array of shape (L, 3) representing the log-likelihood gradient
-                with respect to 3D coordinates.
+            np.ndarray: Array of shape (L, 3) representing the product.
         """
-        L = coords.shape[0]
-        scipy.spatial.distance.cdist(coords, coords, metric='euclidean', out=self._distances)
-        D = self._distances
-        M, S = self._mu, self._sigma
+        delta = self._pair_deltas(coords).astype(np.float64)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        distances = np.maximum(distances, 1e-12)
+        delta /= distances
+        q = np.take(vector.T, self._rows, axis=-1) - np.take(vector.T, self._cols, axis=-1)
+
+        ratio = self._pair_mu / distances
+        scale = 1. / self._pair_sigma.astype(np.float64) ** 2.
+        if self._weighted:
+            scale *= self._pair_weights
+        h = (1. - ratio) * q + ratio * delta * (delta * q).sum(axis=0)
+        h *= scale
+
+        n_atoms = len(coords)
+        product = np.empty((n_atoms, 3), dtype=np.float64)
+        for k in range(3):
+            product[:, k] = np.bincount(self._rows, weights=h[k], minlength=n_atoms)
+            product[:, k] -= np.bincount(self._cols, weights=h[k], minlength=n_atoms)
 
-        X = np.tile(coords, (L, 1, 1))
-        delta = X - np.transpose(X, (1, 0, 2))
+        # Restraints to the center of mass
+        if len(self._center_atoms) > 0:
+            delta = self._center_deltas(coords)
+            distances = np.maximum(np.sqrt((delta ** 2.).sum(axis=1)), 1e-12)[:, np.newaxis]
+            delta /= distances
+            q = vector[self._center_atoms] - vector.mean(axis=0)
+            ratio = self._center_pair_mu[:, np.newaxis] / distances
+            h = (1. - ratio) * q + ratio * delta * (delta * q).sum(axis=1)[:, np.newaxis]
+            h /= self._center_pair_sigma[:, np.newaxis] ** 2.
+            if self._weighted:
+                h *= self._center_pair_weights[:, np.newaxis]
+            product[self._center_atoms] += h
+            product -= h.sum(axis=0) / n_atoms
+        return product
 
-        F = ((D - M) / (D * S ** 2.))[..., np.newaxis]
-        F[np.isnan(F)] = 0
-        grad = 4. * delta * F
-        grad[self._tril_indices] = 0
-        grad[np.isnan(self._mu)] = 0
+    def gradient_subset(self, coords, indices, weights=None):
+        """Computes gradient of negative log-likelihood restricted to
+        a subset of the restrained pairs, with respect to 3D coordinates.
+        Restraints to the center of mass are always included.
 
+        Parameters:
+            coords (np.ndarray): Array of shape (L, 3) where ith sub-array represents
+                the coordinates of residue i in three-dimensional space.
+            indices (np.ndarray): Indices of the restrained pairs,
+                in the order of `pair_list`.
+            weights (np.ndarray, optional): Factor applied to the
+                contribution of each selected pair.
+
+        Returns:
+            np.ndarray: Array of shape (L, 3) representing the partial
+                negative log-likelihood gradient.
+        """
+        rows, cols = self._rows[indices], self._cols[indices]
+        coords = np.ascontiguousarray(coords.T, dtype=self._dtype)
+        delta = np.take(coords, rows, axis=-1)
+        delta -= np.take(coords, cols, axis=-1)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        sigma = self._pair_sigma[indices]
+        F = (distances - self._pair_mu[indices]) / (distances * sigma ** 2.)
         if self._weighted:
-            weights = self._weights[self._tril_indices]
-            grad *= weights[..., np.newaxis]
-        grad = np.nan_to_num(grad)
+            F *= self._pair_weights[indices]
+        if weights is not None:
+            F *= weights
+        F = np.nan_to_num(F)
+        delta *= F
 
-        grad = grad.sum(axis=0)
-        return grad
+        n_atoms = len(coords.T)
+        grad = np.empty((n_atoms, 3), dtype=np.float64)
+        for k in range(3):
+            grad[:, k] = np.bincount(rows, weights=delta[k], minlength=n_atoms)
+            grad[:, k] -= np.bincount(cols, weights=delta[k], minlength=n_atoms)
+        return self._gradient_center(coords.T, grad)
+
+    def residue_energies(self, coords):
+        """Computes the contribution of each residue to the negative
+        log-likelihood. The energy of each restrained pair is split
+        equally between its two residues, so that energies sum up to
+        the opposite of `evaluate`.
+
+        Parameters:
+            coords (np.ndarray): Array of shape (L, 3) where ith sub-array represents
+                the coordinates of residue i in three-dimensional space.
+
+        Returns:
+            np.ndarray: Array of shape (L,) containing the energy of each residue.
+        """
+        return self._residue_sums(*self._restraint_energies(coords))
+
+    def _restraint_energies(self, coords):
+        # Energy of each compiled restraint, and of each
+        # restraint to the center of mass
+        delta = self._pair_deltas(coords)
+        distances = np.sqrt((delta ** 2.).sum(axis=0))
+        energies = ((distances - self._pair_mu) / self._pair_sigma) ** 2.
+        if self._weighted:
+            energies *= self._pair_weights
+        distances = np.sqrt((self._center_deltas(coords) ** 2.).sum(axis=1))
+        center_energies = ((distances - self._center_pair_mu) / self._center_pair_sigma) ** 2.
+        if self._weighted:
+            center_energies *= self._center_pair_weights
+        return 0.5 * energies, 0.5 * center_energies
+
+    def _residue_sums(self, energies, center_energies):
+        # Restraints to the center of mass are assigned to their atom
+        residue_energies = 0.5 * (
+            np.bincount(self._rows, weights=energies, minlength=self._n_atoms) +
+            np.bincount(self._cols, weights=energies, minlength=self._n_atoms))
+        residue_energies[self._center_atoms] += center_energies
+        return residue_energies
+
+    def _evaluate_breakdown(self, coords):
+        energies, center_energies = self._restraint_energies(coords)
+        n_labels = len(self._labels)
+        class_energies = np.bincount(self._pair_classes, weights=energies, minlength=n_labels) + \
+            np.bincount(self._center_pair_classes, weights=center_energies, minlength=n_labels)
+        logp = -(energies.sum(dtype=np.float64) + center_energies.sum(dtype=np.float64))
+        return logp, dict(zip(self._labels, class_energies)), \
+            self._residue_sums(energies, center_energies)
+
+    def set_surrogate(self, max_sigma=5., fraction=0.1, random_state=None):
+        """Selects the restraints used by `evaluate_surrogate`: all the
+        restraints with a standard deviation of at most `max_sigma`
+        (backbone, contacts and secondary structures), and a random
+        subset of the loose ones (mostly repulsions). The subsampled
+        restraints are weighted by the inverse of their sampling rate,
+        so that the surrogate estimates the full log-likelihood.
+        Restraints to the center of mass are always selected.
+
+        Parameters:
+            max_sigma (float): Largest standard deviation of the
+                restraints that are always selected.
+            fraction (float): Fraction of the other restraints
+                to be randomly selected.
+            random_state (int): Seed used to select the restraints.
+        """
+        self._surrogate = (max_sigma, fraction, random_state)
+        rng = np.random.RandomState(random_state)
+        tight = (self._pair_sigma <= max_sigma * self._sigma_scale)
+        sampled = ~tight & (rng.rand(len(tight)) < fraction)
+        indices = np.where(tight | sampled)[0]
+        self._surrogate_rows = self._rows[indices]
+        self._surrogate_cols = self._cols[indices]
+        self._surrogate_mu = self._pair_mu[indices]
+        self._surrogate_sigma = self._pair_sigma[indices]
+        weights = np.where(sampled[indices], 1. / max(fraction, 1e-12), 1.)
+        if self._weighted:
+            weights *= self._pair_weights[indices]
+        self._surrogate_weights = weights.astype(self._dtype)
+
+    def evaluate_surrogate(self, coords):
+        """Estimates log-likelihood from the restraints selected
+        by `set_surrogate`.
+
+        Parameters:
+            coords (np.ndarray): Array of shape (L, 3), or array of shape
+                (n_solutions, L, 3) for evaluating several solutions at once.
+
+        Returns:
+            float or np.ndarray: Estimated log-likelihood of each solution.
+        """
+        assert(self._surrogate is not None)
+        coords = np.ascontiguousarray(np.swapaxes(coords, -1, -2), dtype=self._dtype)
+        delta = np.take(coords, self._surrogate_rows, axis=-1)
+        delta -= np.take(coords, self._surrogate_cols, axis=-1)
+        distances = np.sqrt((delta ** 2.).sum(axis=-2))
+        logp = ((distances - self._surrogate_mu) / self._surrogate_sigma) ** 2.
+        logp *= self._surrogate_weights
+        return -0.5 * logp.sum(axis=-1, dtype=np.float64) + \
+            self._evaluate_center(np.swapaxes(coords, -1, -2))
+
+    def pair_list(self):
+        """Returns the compiled list of restrained pairs.
+
+        Returns:
+            tuple: Arrays `rows`, `cols`, `mu`, `sigma` and `weights`,
+                each of shape (n_restraints,). Weights are ones if
+                the model is not weighted.
+        """
+        weights = self._pair_weights if self._weighted else np.ones_like(self._pair_mu)
+        return self._rows, self._cols, self._pair_mu, self._pair_sigma, weights
+
+    def center_list(self):
+        """Returns the compiled list of atoms restrained to the center of mass.
+
+        Returns:
+            tuple: Arrays `atoms`, `mu`, `sigma` and `weights`, each of
+                shape (n_center_restraints,). Weights are ones if
+                the model is not weighted.
+        """
+        weights = self._center_pair_weights if self._weighted \
+            else np.ones_like(self._center_pair_mu)
+        return self._center_atoms, self._center_pair_mu, self._center_pair_sigma, weights
+
+    @property
+    def atoms(self):
+        """Atoms registered with `add_atoms`, in registration order."""
+        return list(self._atoms)
+
+    @property
+    def n_atoms(self):
+        return self._n_atoms
+
+    @property
+    def n_restraints(self):
+        return len(self._rows)
+
+    @property
+    def n_informative_restraints(self):
+        """Number of restrained pairs whose restraint is not a repulsion."""
+        return self._n_informative
+
+    @property
+    def labels(self):
+        """Labels of the classes of restraints of the model."""
+        return list(self._labels)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        assert(mode in ['dense', 'sparse', 'tiled', 'octree'])
+        self._mode = mode
+        if self._initialized:
+            self._compile()
+
+    @property
+    def sigma_scale(self):
+        return self._sigma_scale
+
+    @sigma_scale.setter
+    def sigma_scale(self, sigma_scale):
+        self._sigma_scale = sigma_scale
+        if self._initialized:
+            self._compile()
+
+    @property
+    def opening_angle(self):
+        return self._opening_angle
+
+    @opening_angle.setter
+    def opening_angle(self, opening_angle):
+        self._opening_angle = opening_angle
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype):
+        self._dtype = dtype
+        if self._initialized:
+            for name in ['_center_mu', '_center_sigma', '_center_weights']:
+                setattr(self, name, getattr(self, name).astype(dtype, copy=False))
+            self._compile()
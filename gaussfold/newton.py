@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# newton.py: Truncated Newton methods
+# author : Antoine Passemiers
+
+import scipy.optimize
+
+
+def newton(initial_solution, model, verbose=True, method='trust-ncg', max_iter=200):
+    """Run a truncated Newton method on an initial solution,
+    with given objective function. Hessian-vector products are
+    computed exactly by the model, without forming the Hessian.
+
+    Parameters:
+        initial_solution (:obj:`np.ndarray`): Array of shape (L, 3)
+            representing the initial solution, where L is the number
+            of residues in the protein.
+        model (:obj:`gaussfold.Model`): Gaussian model.
+        verbose (bool): Whether to display messages in stdout.
+        method (str): Either 'trust-ncg' (trust-region Newton-CG),
+            'trust-krylov' or 'Newton-CG' (line search Newton-CG).
+        max_iter (int): Maximum number of Newton iterations.
+
+    Returns:
+        :obj:`np.ndarray`: Locally optimal solution.
+    """
+    assert(method in ['trust-ncg', 'trust-krylov', 'Newton-CG'])
+    L = initial_solution.shape[0]
+
+    # Define objective function
+    def obj(x):
+        coords = x.reshape(L, 3)
+        return -model.evaluate(coords)
+
+    # Define gradient function
+    def jac(x):
+        coords = x.reshape(L, 3)
+        grad = model.gradient(coords)
+        return grad.flatten()
+
+    # Define Hessian-vector product
+    def hessp(x, p):
+        coords = x.reshape(L, 3)
+        return model.hessian_vector_product(coords, p.reshape(L, 3)).flatten()
+
+    # Define callback function
+    def callback(x, *args):
+        if verbose:
+            print('%s: %f' % (method, obj(x)))
+
+    # Solve the optimization problem
+    x0 = initial_solution.flatten()
+    res = scipy.optimize.minimize(
+        obj, x0, jac=jac, hessp=hessp, method=method, callback=callback,
+        options={'maxiter': max_iter})
+    return res.x.reshape(L, 3)
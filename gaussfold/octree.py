@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# octree.py: Barnes-Hut approximation of sums of pairwise distances
+# author : Antoine Passemiers
+
+import numpy as np
+
+
+def _expand(items, nodes, indptr, indices):
+    """Replaces each pair (item, node) by the pairs (item, k),
+    for all k in indices[indptr[node]:indptr[node + 1]]."""
+    counts = indptr[nodes + 1] - indptr[nodes]
+    total = counts.sum()
+    starts = np.repeat(indptr[nodes], counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(items, counts), indices[starts + offsets]
+
+
+def _csr(groups, n_groups):
+    """Lists the elements of each group, in compressed sparse row format."""
+    order = np.argsort(groups, kind='stable')
+    indptr = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=n_groups), out=indptr[1:])
+    return indptr, order
+
+
+class Octree:
+    """Octree over a set of points, storing for each cell the number of
+    points, their centroid, their largest distance to the centroid and
+    their second moment around the centroid.
+    All levels are built at once: the cell of a point at level k is
+    obtained by discretizing its coordinates in 2^k bins per axis.
+
+    Attributes:
+        coords (:obj:`np.ndarray`): Array of shape (n, 3) of points.
+        leaf_size (int): Average number of points per cell targeted
+            at the deepest level.
+        depth (int): Index of the deepest level.
+        sizes (list): Side length of the cells of each level.
+        cells (list): Cell of each point, for each level.
+        counts (list): Number of points of each cell, for each level.
+        centers (list): Centroid of each cell, for each level.
+        radii (list): Largest distance between the centroid of each
+            cell and its points, for each level.
+        moments (list): Array of shape (n_cells, 3, 3) of second
+            moments of each cell, for each level.
+        children (list): Children of the cells of each level but the
+            last one, in compressed sparse row format.
+        leaves (tuple): Points of each cell of the deepest level,
+            in compressed sparse row format.
+    """
+
+    def __init__(self, coords, leaf_size=8):
+        self.coords = coords = np.asarray(coords, dtype=np.float64)
+        self.leaf_size = leaf_size
+        n = len(coords)
+        self.depth = max(0, int(np.ceil(np.log(max(n / float(leaf_size), 1.)) / np.log(8.))))
+
+        lower = coords.min(axis=0)
+        side = max((coords.max(axis=0) - lower).max(), 1e-12)
+        scaled = (coords - lower) / side
+        self.sizes, self.cells, self.counts = list(), list(), list()
+        self.centers, self.radii = list(), list()
+        self.moments, self.children = list(), list()
+        for level in range(self.depth + 1):
+            n_bins = 2 ** level
+            bins = np.clip(np.floor(scaled * n_bins).astype(np.int64), 0, n_bins - 1)
+            keys = (bins[:, 0] * n_bins + bins[:, 1]) * n_bins + bins[:, 2]
+            _, cells = np.unique(keys, return_inverse=True)
+            n_cells = cells.max() + 1
+            counts = np.bincount(cells, minlength=n_cells).astype(np.float64)
+            centers = np.empty((n_cells, 3), dtype=np.float64)
+            for k in range(3):
+                centers[:, k] = np.bincount(cells, weights=coords[:, k], minlength=n_cells)
+            centers /= counts[:, np.newaxis]
+            Y = coords - centers[cells]
+            radii = np.zeros(n_cells, dtype=np.float64)
+            np.maximum.at(radii, cells, np.sqrt((Y ** 2.).sum(axis=1)))
+            moments = np.empty((n_cells, 3, 3), dtype=np.float64)
+            for a in range(3):
+                for b in range(a, 3):
+                    moments[:, a, b] = moments[:, b, a] = np.bincount(
+                        cells, weights=Y[:, a] * Y[:, b], minlength=n_cells)
+            if level > 0:
+                # Parent of each cell, taken from any of its points
+                parents = np.empty(n_cells, dtype=np.int64)
+                parents[cells] = self.cells[-1]
+                self.children.append(_csr(parents, len(self.counts[-1])))
+            self.sizes.append(side / n_bins)
+            self.cells.append(cells)
+            self.counts.append(counts)
+            self.centers.append(centers)
+            self.radii.append(radii)
+            self.moments.append(moments)
+        self.leaves = _csr(self.cells[-1], len(self.counts[-1]))
+
+    def distance_sum(self, opening_angle=0.5, chunk_size=2048):
+        """Approximates the sum of distances over all pairs of points,
+        and its gradient. Each point traverses the tree from the root.
+        A cell is approximated by a quadrupole expansion when its radius
+        is less than `opening_angle` times its distance to the point.
+        Otherwise, it is opened, and the points of the opened leaves
+        are handled exactly. Traversal is vectorized over all pairs
+        (point, cell) of a same level, for chunks of points.
+
+        Parameters:
+            opening_angle (float): Opening criterion. Zero gives the
+                exact sum, larger values are faster but less accurate.
+            chunk_size (int): Number of points traversing the tree
+                together, which bounds memory usage.
+
+        Returns:
+            tuple: Sum of the distances over pairs i < j, and array of
+                shape (n, 3) of its gradient with respect to the points.
+        """
+        n = len(self.coords)
+        potentials = np.zeros(n, dtype=np.float64)
+        grad = np.zeros((n, 3), dtype=np.float64)
+        for start in range(0, n, chunk_size):
+            self._traverse(np.arange(start, min(start + chunk_size, n)),
+                           opening_angle, potentials, grad)
+
+        # Each pair has been counted from both of its points
+        return 0.5 * potentials.sum(), grad
+
+    def _traverse(self, points, opening_angle, potentials, grad):
+        X = self.coords
+        n = len(X)
+        nodes = np.zeros(len(points), dtype=np.int64)
+        for level in range(self.depth + 1):
+            r = X[points] - self.centers[level][nodes]
+            distances = np.sqrt((r ** 2.).sum(axis=1))
+            far = (self.radii[level][nodes] < opening_angle * distances)
+            far &= (self.cells[level][points] != nodes)
+
+            # Quadrupole expansion of the distances to the points of
+            # the cell, around its centroid
+            if far.any():
+                p, r, d = points[far], r[far], distances[far][:, np.newaxis]
+                M = self.moments[level][nodes[far]]
+                counts = self.counts[level][nodes[far]][:, np.newaxis]
+                trace = np.trace(M, axis1=1, axis2=2)[:, np.newaxis]
+                Mr = np.einsum('kab,kb->ka', M, r)
+                h = (r * Mr).sum(axis=1)[:, np.newaxis]
+                values = counts * d + trace / (2. * d) - h / (2. * d ** 3.)
+                g = counts * r / d - (trace * r + 2. * Mr) / (2. * d ** 3.) + \
+                    3. * h * r / (2. * d ** 5.)
+                potentials += np.bincount(p, weights=values[:, 0], minlength=n)
+                for k in range(3):
+                    grad[:, k] += np.bincount(p, weights=g[:, k], minlength=n)
+
+            points, nodes = points[~far], nodes[~far]
+            if level < self.depth:
+                points, nodes = _expand(points, nodes, *self.children[level])
+
+        # Exact distances to the points of the opened leaves
+        points, others = _expand(points, nodes, *self.leaves)
+        valid = (points != others)
+        points, others = points[valid], others[valid]
+        r = X[points] - X[others]
+        distances = np.sqrt((r ** 2.).sum(axis=1))
+        potentials += np.bincount(points, weights=distances, minlength=n)
+        r /= np.maximum(distances, 1e-12)[:, np.newaxis]
+        for k in range(3):
+            grad[:, k] += np.bincount(points, weights=r[:, k], minlength=n)
@@ -2,7 +2,11 @@
 # optimizer.py: Heuristic optimizer for Gaussian models
 # author : Antoine Passemiers
 
+from gaussfold.corrector import ProjectionCorrector
+from gaussfold.geometry import kabsch, random_rotation, superpose
 from gaussfold.lbfgs import lbfgs
+from gaussfold.newton import newton
+from gaussfold.torsion import TorsionModel
 
 import random
 import numpy as np
@@ -22,16 +26,94 @@ class Optimizer:
             added for mutating points coordinates.
         init_std (float): Standard deviation used to generate the
             population from an initial solution.
+        angle_mutation_std (float): Standard deviation (in radians) of
+            the mutations of the angles of a `gaussfold.TorsionModel`.
+            A single angle moves the whole downstream chain, so this
+            scale is much smaller than `mutation_std`.
+        angle_init_std (float): Standard deviation (in radians) used to
+            generate the angles of the population of a
+            `gaussfold.TorsionModel` from an initial solution.
         early_stopping (int): Maximum number of iterations without
             score improvement before stopping the algorithm.
         use_lbfgs (bool): Whether to improve local convergence
             with L-BFGS algorithm (slows the solver down).
+        use_newton (bool): Whether to refine the final solution with
+            a trust-region Newton-CG method, after L-BFGS if enabled.
+        batch_size (int): Number of new solutions created at each
+            iteration. New solutions of a same iteration are evaluated
+            at once and replace the worst solutions of the population.
+        sse_mutation_rate (float): Probability for each predicted helix
+            or strand to be moved as a rigid body in a child's solution.
+            Residues of the moved segments are not mutated individually.
+        sse_rotation_std (float): Standard deviation of the rotation
+            angle (in radians) of rigid-body moves.
+        sse_translation_std (float): Standard deviation of the
+            translation of rigid-body moves.
+        sse_cross_over (bool): Whether to apply cross-over at segment
+            boundaries instead of residue level.
+        align_parents (bool): Whether to superpose the second parent
+            onto the first one before applying cross-over. Log-likelihood
+            is invariant to rotations and translations, but cross-over
+            of parents lying in different frames produces broken children.
+        canonicalize_every (int): Number of iterations between two
+            superpositions of the whole population onto its best
+            individual. Zero disables canonicalization.
+        repair (bool): Whether to project consecutive residues of each
+            child onto the C-alpha - C-alpha distance after mutation.
+            Requires `segments` to be set.
+        repair_n_iter (int): Number of projection sweeps per child.
+        energy_bias (float): Between 0 and 1. Extent to which mutation
+            probability and mutation step size of each residue are
+            scaled by its restraint energy in the best solution,
+            relative to the average residue energy. Zero mutates all
+            residues uniformly.
+        continuation (:obj:`gaussfold.Continuation`): Schedule of the
+            Gaussian model. Iterations are split equally between stages,
+            and the next stage starts earlier if no improvement has been
+            made for `early_stopping` iterations. The population is
+            evaluated again at the beginning of each stage.
+        screening (bool): Whether to estimate the log-likelihood of each
+            child with a cheap surrogate of the model before evaluating
+            it exactly. Children that are clearly worse than the worst
+            individual of the population are rejected without exact
+            evaluation.
+        screening_sigma (float): Largest standard deviation of the
+            restraints that are always part of the surrogate.
+        screening_fraction (float): Fraction of the other restraints
+            that are randomly selected in the surrogate.
+        screening_margin (float): Relative tolerance on the estimated
+            log-likelihood before rejecting a child.
+        dtype (type): Floating-point type of the individuals of the
+            population. Fitness values are kept in double precision.
+        segments (list): Indices of the residues of each contiguous
+            segment of predicted secondary structure.
+        sse_segments (list): Indices of the residues of each predicted
+            helix and strand, moved as rigid bodies.
         scores (list): History of best score over time.
+        energies (:obj:`np.ndarray`): Restraint energy of each residue
+            in the best solution. Only maintained if `energy_bias` is
+            strictly positive.
+        pop (list): Population at the end of the last run.
+        pop_scores (:obj:`np.ndarray`): Fitness of the individuals
+            in `pop`.
+        screening_stats (dict): Numbers of screened, accepted and audited
+            children, and of audited children that were wrongly rejected.
     """
 
+    # Fraction of rejected children evaluated exactly
+    # to estimate the false-rejection rate of the surrogate
+    SCREENING_AUDIT_RATE = 0.05
+
     def __init__(self, pop_size=2000, n_iter=200000, partition_size=50,
                  mutation_rate=0.5, mutation_std=0.3, init_std=10.,
-                 early_stopping=300, use_lbfgs=False):
+                 early_stopping=300, use_lbfgs=False, batch_size=1,
+                 sse_mutation_rate=0., sse_rotation_std=0.1,
+                 sse_translation_std=1., sse_cross_over=False,
+                 align_parents=False, canonicalize_every=0,
+                 repair=False, repair_n_iter=5, energy_bias=0.,
+                 continuation=None, screening=False, screening_sigma=5.,
+                 screening_fraction=0.1, screening_margin=0., use_newton=False,
+                 angle_mutation_std=0.02, angle_init_std=0.1, dtype=np.float64):
         self.pop_size = pop_size
         self.n_iter = n_iter
         self.partition_size = partition_size
@@ -40,7 +122,52 @@ class Optimizer:
         self.init_std = init_std
         self.early_stopping = early_stopping
         self.use_lbfgs = use_lbfgs
+        self.batch_size = batch_size
+        self.sse_mutation_rate = sse_mutation_rate
+        self.sse_rotation_std = sse_rotation_std
+        self.sse_translation_std = sse_translation_std
+        self.sse_cross_over = sse_cross_over
+        self.align_parents = align_parents
+        self.canonicalize_every = canonicalize_every
+        self.repair = repair
+        self.repair_n_iter = repair_n_iter
+        self.energy_bias = energy_bias
+        self.continuation = continuation
+        self.screening = screening
+        self.screening_sigma = screening_sigma
+        self.screening_fraction = screening_fraction
+        self.screening_margin = screening_margin
+        self.screening_stats = dict()
+        self.use_newton = use_newton
+        self.angle_mutation_std = angle_mutation_std
+        self.angle_init_std = angle_init_std
+        self.dtype = dtype
+        self.energies = None
+        self.segments = list()
+        self.sse_segments = list()
         self.scores = list()
+        self.pop = None
+        self.pop_scores = None
+        self._n_angles = 0
+
+    def scales(self, std, angle_std, L):
+        """Standard deviations of the rows of a solution. The angles
+        of a `gaussfold.TorsionModel` are searched at their own scale.
+
+        Parameters:
+            std (float): Standard deviation of Cartesian coordinates.
+            angle_std (float): Standard deviation of angles.
+            L (int): Number of rows of a solution.
+
+        Returns:
+            float or :obj:`np.ndarray`: Standard deviation, or array
+                of shape (L, 1) of standard deviations.
+        """
+        if self._n_angles == 0:
+            return std
+        scales = np.full((L, 1), std)
+        scales[:self._n_angles] = angle_std
+        return scales
 
     def random_sol(self, initial_coords):
         """Generates a random solution by adding Gaussian noise
@@ -55,9 +182,10 @@ class Optimizer:
             :obj:`np.ndarray`: A new solution of the same shape.
         """
         L = initial_coords.shape[0]
-        offsets = np.random.normal(0., self.init_std, size=(L, 3))
+        offsets = np.random.normal(0., 1., size=(L, 3))
+        offsets *= self.scales(self.init_std, self.angle_init_std, L)
         individual = initial_coords + offsets
-        return individual
+        return individual.astype(self.dtype)
 
     def cross_over(self, left, right):
         """Cross-over operator between two parent solutions.
@@ -73,6 +201,36 @@ class Optimizer:
         individual = alpha * left + (1. - alpha) * right
         return individual
 
+    def segment_cross_over(self, left, right):
+        """Cross-over operator at segment boundaries. Each segment
+        of the child is taken from one of the two parents. Segments
+        taken from the second parent are superposed onto the
+        corresponding segments of the first parent, so that the
+        geometry of each segment is preserved. Segments of less than
+        3 residues are superposed together with their flanking residues,
+        or kept from the first parent when these are missing.
+
+        Parameters:
+            left (:obj:`np.ndarray`): First solution of shape (L, 3).
+            right (:obj:`np.ndarray`): Second solution of shape (L, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Child solution of shape (L, 3).
+        """
+        individual = np.copy(left)
+        L = len(left)
+        for segment in self.segments:
+            if np.random.rand() < 0.5:
+                if len(segment) >= 3:
+                    individual[segment] = superpose(right[segment], left[segment])
+                else:
+                    # Too few points to define a rotation
+                    start, end = max(segment[0] - 1, 0), min(segment[-1] + 2, L)
+                    if end - start >= 3:
+                        R, t = kabsch(right[start:end], left[start:end])
+                        individual[segment] = np.dot(right[segment], R) + t
+        return individual
+
     def mutate(self, individual):
         """Mutation operator.
 
@@ -83,11 +241,40 @@ class Optimizer:
             :obj:`np.ndarray`: Mutated solution of shape (L, 3).
         """
         L = individual.shape[0]
-        std = self.mutation_std
-        mutations = np.random.normal(0., std, size=(L, 3))
-        mutations *= (np.random.rand(L, 1) < self.mutation_rate)
+        std = self.scales(self.mutation_std, self.angle_mutation_std, L)
+        rate = self.mutation_rate
+        if self.energy_bias > 0 and self.energies is not None:
+            # Focus mutations on residues with large violations
+            relative = self.energies / max(np.mean(self.energies), 1e-12)
+            bias = self.energy_bias
+            std = std * ((1. - bias) + bias * np.sqrt(relative))[:, np.newaxis]
+            rate = np.minimum(rate * ((1. - bias) + bias * relative), 1.)[:, np.newaxis]
+        mutations = np.random.normal(0., 1., size=(L, 3)) * std
+        mutations *= (np.random.rand(L, 1) < rate)
         return individual + mutations
 
+    def rigid_mutate(self, individual):
+        """Mutation operator that moves predicted helices and strands
+        as rigid bodies. Each segment is rotated around its centroid
+        and translated with probability `sse_mutation_rate`, while
+        the other residues are mutated individually.
+
+        Parameters:
+            individual (:obj:`np.ndarray`): Solution of shape (L, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Mutated solution of shape (L, 3).
+        """
+        mutated = self.mutate(individual)
+        for segment in self.sse_segments:
+            if np.random.rand() < self.sse_mutation_rate:
+                X = individual[segment]
+                center = X.mean(axis=0)
+                R = random_rotation(self.sse_rotation_std)
+                t = np.random.normal(0., self.sse_translation_std, size=3)
+                mutated[segment] = np.dot(X - center, R) + center + t
+        return mutated
+
     def new_sol(self, pop, scores):
         """Randomly constructs two partitions from current population,
         plays one tournament in each, elects two parents, applies the
@@ -115,52 +302,204 @@ class Optimizer:
         left_winner = pop[indices[np.argmax(scores[:ps])]]
         right_winner = pop[indices[ps + np.argmax(scores[ps:2*ps])]]
 
+        # Bring both parents in the same frame
+        if self.align_parents:
+            right_winner = superpose(right_winner, left_winner)
+
         # Apply the cross-over and mutation operators
-        individual = self.cross_over(left_winner, right_winner)
-        return self.mutate(individual)
+        if self.sse_cross_over and len(self.segments) > 0:
+            individual = self.segment_cross_over(left_winner, right_winner)
+        else:
+            individual = self.cross_over(left_winner, right_winner)
+        if self.sse_mutation_rate > 0 and len(self.sse_segments) > 0:
+            individual = self.rigid_mutate(individual)
+        else:
+            individual = self.mutate(individual)
+        if self.repair and len(self.segments) > 0:
+            individual = self.repair_sol(individual)
+        return individual.astype(self.dtype, copy=False)
+
+    def repair_sol(self, individual):
+        """Repair operator. Projects consecutive residues onto
+        the C-alpha - C-alpha distance.
+
+        Parameters:
+            individual (:obj:`np.ndarray`): Solution of shape (L, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Repaired solution of shape (L, 3).
+        """
+        # Segments are listed in chain order
+        backbone = np.concatenate(self.segments)
+        corrector = ProjectionCorrector(len(backbone), n_iter=self.repair_n_iter, dtype=self.dtype)
+        individual = np.copy(individual)
+        individual[backbone] = corrector.fit_transform(individual[backbone])
+        return individual
+
+    def canonicalize(self, pop, scores):
+        """Superposes all individuals onto the best one, in place.
+
+        Parameters:
+            pop (list): Current population, represented as a list
+                of solutions (arrays of shape (L, 3)).
+            scores (:obj:`np.ndarray`): Fitness functions associated
+                to the individuals.
+        """
+        X = np.asarray(pop)
+        reference = np.broadcast_to(X[np.argmax(scores)], X.shape)
+        X = superpose(X, reference)
+        for i in range(len(pop)):
+            pop[i][:] = X[i]
+
+    def next_stage(self, model, stage, pop):
+        """Applies a stage of the continuation schedule to the model,
+        and evaluates the population under the updated model.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model.
+            stage (int): Stage index.
+            pop (list): Current population.
+
+        Returns:
+            :obj:`np.ndarray`: Fitness of the individuals.
+        """
+        self.continuation.apply(model, stage)
+        if self.batch_size > 1:
+            scores = model.evaluate_batch(np.asarray(pop))
+        else:
+            scores = np.asarray([model.evaluate(ind) for ind in pop])
+        if self.energy_bias > 0:
+            self.energies = model.residue_energies(pop[np.argmax(scores)])
+        return scores
+
+    def screen(self, model, inds, pop, scores):
+        """Pre-screens new solutions with the surrogate of the model.
+        Estimated log-likelihoods are compared to the estimated
+        log-likelihood of the worst individual of the population,
+        which cancels out most of the bias of the surrogate.
 
-    def run(self, model, verbose=True):
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model, whose
+                surrogate has been set.
+            inds (:obj:`np.ndarray`): New solutions, as an array
+                of shape (n_solutions, L, 3).
+            pop (list): Current population.
+            scores (:obj:`np.ndarray`): Fitness of the individuals
+                of the current population.
+
+        Returns:
+            :obj:`np.ndarray`: Boolean array of shape (n_solutions,)
+                indicating which solutions should be evaluated exactly.
+        """
+        worst = np.argmin(scores)
+        threshold = model.evaluate_surrogate(pop[worst])
+        threshold -= self.screening_margin * np.abs(threshold)
+        accepted = (model.evaluate_surrogate(inds) >= threshold)
+        self.screening_stats['screened'] += len(inds)
+        self.screening_stats['accepted'] += np.sum(accepted)
+
+        # Audit a few rejected solutions
+        audited = ~accepted & (np.random.rand(len(inds)) < Optimizer.SCREENING_AUDIT_RATE)
+        if audited.any():
+            exact_scores = model.evaluate_batch(inds[audited])
+            self.screening_stats['audited'] += np.sum(audited)
+            self.screening_stats['false_rejections'] += np.sum(exact_scores > scores[worst])
+        return accepted
+
+    def run(self, model, verbose=True, pop=None, scores=None):
         """Run heuristic optimizer on an initial solution,
         with given objective function.
 
         Parameters:
             model (:obj:`gaussfold.Model`): Gaussian model
             verbose (bool): Whether to display messages in stdout.
+            pop (list, optional): Population to resume from, for example
+                the `pop` attribute of a previous run. If not provided,
+                the population is generated from the current coordinates
+                of the model.
+            scores (:obj:`np.ndarray`, optional): Fitness of the individuals
+                in `pop`. Computed if not provided.
 
         Returns:
             :obj:`np.ndarray`: Optimal solution.
         """
-        # Randomly initializes population and adds initial
-        # solution to it
-        initial_solution = model.get_coords()
-        pop = [self.random_sol(initial_solution) for i in range(self.pop_size-1)]
-        pop += [initial_solution]
         obj = model.evaluate
+        self._n_angles = model.n_angles if isinstance(model, TorsionModel) else 0
+        n_stages = 1 if self.continuation is None else self.continuation.n_stages
+        stage_length = self.n_iter // n_stages
+        stage = 0
+        if n_stages > 1:
+            self.continuation.apply(model, stage)
+            scores = None
+        if pop is None:
+            # Randomly initializes population and adds initial
+            # solution to it
+            initial_solution = model.get_coords()
+            pop = [self.random_sol(initial_solution) for i in range(self.pop_size-1)]
+            pop += [initial_solution.astype(self.dtype)]
+            scores = None
+        else:
+            pop = [np.array(ind, dtype=self.dtype) for ind in pop]
+
+        # Select the restraints of the surrogate model
+        if self.screening:
+            model.set_surrogate(max_sigma=self.screening_sigma,
+                                fraction=self.screening_fraction)
+            self.screening_stats = {
+                'screened': 0, 'accepted': 0, 'audited': 0, 'false_rejections': 0}
 
-        # Set initial solution as the best one so far
+        # Compute fitness functions on all individuals
+        if scores is None:
+            scores = np.asarray([obj(ind) for ind in pop])
+        else:
+            scores = np.copy(scores)
+
+        # Set the best individual of the initial (or resumed)
+        # population as the best one so far
         self.scores = list()
-        best_score = -np.inf
+        best_score = np.max(scores)
         best_iteration = 0
-
-
-        # Compute fitness functions on all individuals
-        scores = np.asarray([obj(ind) for ind in pop])
+        if self.energy_bias > 0:
+            self.energies = model.residue_energies(pop[np.argmax(scores)])
 
         for k in range(self.n_iter):
-            # Create new solution to replace worst solution
-            new_ind = self.new_sol(pop, scores)
-            worst = np.argmin(scores)
-            pop[worst][:] = new_ind
-            scores[worst] = obj(new_ind)
-            assert(not np.isnan(scores[worst]))
+            if self.batch_size > 1:
+                # Create a batch of new solutions to replace the
+                # worst solutions, and evaluate them at once
+                new_inds = np.asarray([self.new_sol(pop, scores) for i in range(self.batch_size)])
+                if self.screening:
+                    new_inds = new_inds[self.screen(model, new_inds, pop, scores)]
+                n_new = len(new_inds)
+                if n_new > 0:
+                    worst = np.argpartition(scores, n_new - 1)[:n_new]
+                    new_scores = model.evaluate_batch(new_inds)
+                    for i in range(n_new):
+                        pop[worst[i]][:] = new_inds[i]
+                    scores[worst] = new_scores
+                    assert(not np.isnan(new_scores).any())
+                    worst = worst[np.argmax(new_scores)]
+                else:
+                    worst = np.argmin(scores)
+            else:
+                # Create new solution to replace worst solution
+                new_ind = self.new_sol(pop, scores)
+                worst = np.argmin(scores)
+                if not self.screening or self.screen(model, new_ind[np.newaxis], pop, scores)[0]:
+                    pop[worst][:] = new_ind
+                    scores[worst] = obj(new_ind)
+                    assert(not np.isnan(scores[worst]))
 
             # Check if improvement
             if scores[worst] > best_score:
                 best_score = scores[worst]
                 best_iteration = k
+                if self.energy_bias > 0 and scores[worst] >= np.max(scores):
+                    self.energies = model.residue_energies(pop[worst])
             if verbose and (k + 1) % 100 == 0:
                 print('Log-likelihood at iteration %i: %f' \
                     % (k + 1, best_score))
+            if self.canonicalize_every > 0 and (k + 1) % self.canonicalize_every == 0:
+                self.canonicalize(pop, scores)
             self.scores.append(best_score)
 
             if np.isnan(best_score):
@@ -168,10 +507,35 @@ class Optimizer:
                     print('[Warning] Invalid value encountered in heuristic solver')
                 break
 
+            # Tighten the model at the end of each stage
+            if stage < n_stages - 1:
+                if (k + 1 >= (stage + 1) * stage_length) or \
+                        (k - best_iteration >= self.early_stopping):
+                    stage += 1
+                    scores = self.next_stage(model, stage, pop)
+                    best_score, best_iteration = np.max(scores), k
+                    if verbose:
+                        print('[Continuation] Stage %i at iteration %i. Log-likelihood: %f' \
+                            % (stage + 1, k + 1, best_score))
+                    continue
+
             # Stop algorithm if no more improvement
             if k - best_iteration >= self.early_stopping:
                 break
 
+        # Make sure the original model is restored
+        if stage < n_stages - 1:
+            stage = n_stages - 1
+            scores = self.next_stage(model, stage, pop)
+            best_score = np.max(scores)
+
+        if self.screening and verbose:
+            stats = self.screening_stats
+            print('[Screening] Accept rate: %.1f%%, false rejection rate: %.1f%% (%i audited)' % (
+                100. * stats['accepted'] / max(stats['screened'], 1),
+                100. * stats['false_rejections'] / max(stats['audited'], 1),
+                stats['audited']))
+
         # Fine-tune solution with L-BFGS
         best_coords = pop[np.argmax(scores)]
         if self.use_lbfgs:
@@ -179,5 +543,14 @@ class Optimizer:
             if obj(new_coords) > best_score:
                 best_coords = new_coords
 
+        # Refine solution with a truncated Newton method
+        if self.use_newton:
+            new_coords = newton(best_coords, model, verbose=verbose)
+            if obj(new_coords) > obj(best_coords):
+                best_coords = new_coords
+
+        # Keep final population for warm restarts
+        self.pop, self.pop_scores = pop, scores
+
         # Update coordinates in model
         model.set_coords(best_coords)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# portfolio.py: Multi-start racing of initial embeddings
+# author : Antoine Passemiers
+
+import copy
+import numpy as np
+
+
+class Portfolio:
+    """Multi-start portfolio of initial embeddings, raced by successive halving.
+
+    Each start is an initial structure obtained with its own
+    Multi-Dimensional Scaling seed, number of top contacts and
+    embedding algorithm. All starts are optimized with a small budget,
+    the worst half is discarded according to the log-likelihood of the
+    Gaussian model, and the budget of the survivors is doubled.
+    This is repeated until only one start remains.
+
+    Attributes:
+        n_starts (int): Number of initial structures.
+        budget (int): Number of optimizer iterations granted to each
+            structure during the first round.
+        n_tops (tuple): Numbers of top contacts (divided by L) used to
+            build the contact graphs of the initial structures.
+            The Gaussian model itself is always built from the
+            `n_top` value of the `GaussFold` object, so that all starts
+            are compared with the same log-likelihood.
+        initializers (tuple): Embedding algorithms, among the ones
+            supported by `GaussFold.embed`.
+        random_state (int): Seed used to draw the MDS seeds.
+    """
+
+    def __init__(self, n_starts=8, budget=500, n_tops=(2., 2.5, 3.),
+                 initializers=('mds', 'classical'), random_state=None):
+        self.n_starts = n_starts
+        self.budget = budget
+        self.n_tops = n_tops
+        self.initializers = initializers
+        self.random_state = random_state
+
+    def configurations(self):
+        """Lists the settings of each initial structure.
+
+        Returns:
+            list: List of triples (n_top, initializer, seed).
+        """
+        rng = np.random.RandomState(self.random_state)
+        configs = list()
+        for initializer in self.initializers:
+            for n_top in self.n_tops:
+                configs.append((n_top, initializer))
+
+        # Only metric MDS is stochastic: additional
+        # starts differ by their seed
+        while len(configs) < self.n_starts:
+            configs.append((self.n_tops[len(configs) % len(self.n_tops)], 'mds'))
+        configs = configs[:self.n_starts]
+
+        seeds = rng.randint(0, np.iinfo(np.int32).max, size=len(configs))
+        return [(n_top, initializer, seed) for (n_top, initializer), seed in zip(configs, seeds)]
+
+    def run(self, gf, chain, cmap, ssp, model, optimizer, verbose=True):
+        """Races the initial structures and sets the coordinates
+        of the winner in the model.
+
+        Parameters:
+            gf (:obj:`gaussfold.GaussFold`): Object used to compute
+                contact graphs and initial embeddings.
+            chain (:obj:`gaussfold.chain.Chain`): Residue chain
+                of the model.
+            cmap (:obj:`np.ndarray`): Array of shape (L, L) representing
+                predicted contact probabilities.
+            ssp (:obj:`np.ndarray`): Array of shape (L,) representing
+                3-state secondary structure prediction.
+            model (:obj:`gaussfold.AminoAcidModel`): Gaussian model.
+            optimizer (:obj:`gaussfold.Optimizer`): Optimizer whose
+                hyper-parameters are used during the race.
+            verbose (bool): Whether to display messages in stdout.
+
+        Returns:
+            tuple: Population of the winner and the associated fitness
+                values, to resume the optimization from.
+        """
+        # Build the initial structures. Graph distances
+        # are computed once per number of top contacts.
+        graphs = dict()
+        candidates = list()
+        for n_top, initializer, seed in self.configurations():
+            if n_top not in graphs:
+                _, graphs[n_top], _ = gf.contact_graph(cmap, n_top=n_top)
+            coords = gf.embed(graphs[n_top], random_state=seed, initializer=initializer,
+                              ssp=(ssp if gf.fragments else None), verbose=False)
+            for i in range(len(chain)):
+                chain[i].ref().set_coords(*coords[i])
+            candidates.append((model.get_coords(), None, None))
+
+        # Optimizer used for the race: L-BFGS fine-tuning and
+        # Newton refinement are only applied to the winner
+        racer = copy.copy(optimizer)
+        racer.use_lbfgs = False
+        racer.use_newton = False
+
+        # The racer has its own continuation schedule, whose
+        # contact restraints remain the ones of the model
+        if optimizer.continuation is not None:
+            memo = { id(constraint): constraint
+                     for group in optimizer.continuation.contacts for constraint in group }
+            racer.continuation = copy.deepcopy(optimizer.continuation, memo)
+
+        budget = self.budget
+        while len(candidates) > 1:
+            racer.n_iter = budget
+            results, best_scores = list(), list()
+            for coords, pop, scores in candidates:
+                model.set_coords(coords)
+                racer.run(model, verbose=False, pop=pop, scores=scores)
+                results.append((model.get_coords(), racer.pop, racer.pop_scores))
+                best_scores.append(np.max(racer.pop_scores))
+
+            # Discard the worst half and double the budget of the survivors
+            n_kept = int(np.ceil(len(candidates) / 2.))
+            order = np.argsort(best_scores)[::-1][:n_kept]
+            candidates = [results[i] for i in order]
+            if verbose:
+                print('[Portfolio] %i starts left after %i iterations. Best log-likelihood: %f' \
+                    % (n_kept, budget, best_scores[order[0]]))
+            budget *= 2
+
+        coords, pop, scores = candidates[0]
+        model.set_coords(coords)
+        return pop, scores
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# replica_exchange.py: Parallel tempering over Gaussian models
+# author : Antoine Passemiers
+
+from gaussfold.lbfgs import lbfgs
+
+import multiprocessing
+import os
+import numpy as np
+
+
+# Restraints of the model, shared by the worker processes
+_NEIGHBOURS = None
+
+
+def _neighbours(model):
+    """Lists the restraints of each atom of a model.
+
+    Parameters:
+        model (:obj:`gaussfold.Model`): Gaussian model.
+
+    Returns:
+        tuple: List containing, for each atom, a tuple of arrays
+            `(neighbours, mu, sigma)` describing the restraints involving
+            this atom, and tuple of arrays `(atoms, mu, sigma)` describing
+            the restraints to the center of mass. Weights are folded
+            into the standard deviations.
+    """
+    rows, cols, mu, sigma, weights = model.pair_list()
+    sigma = sigma / np.sqrt(weights)
+    atoms = np.concatenate((rows, cols))
+    others = np.concatenate((cols, rows))
+    mu, sigma = np.tile(mu, 2).astype(np.float64), np.tile(sigma, 2).astype(np.float64)
+    order = np.argsort(atoms, kind='stable')
+    indptr = np.searchsorted(atoms[order], np.arange(model.n_atoms + 1))
+    neighbours = list()
+    for i in range(model.n_atoms):
+        indices = order[indptr[i]:indptr[i+1]]
+        neighbours.append((others[indices], mu[indices], sigma[indices]))
+
+    atoms, mu, sigma, weights = model.center_list()
+    center = (atoms, mu.astype(np.float64), (sigma / np.sqrt(weights)).astype(np.float64))
+    return neighbours, center
+
+
+def _set_neighbours(neighbours):
+    global _NEIGHBOURS
+    _NEIGHBOURS = neighbours
+
+
+def _sample(args):
+    """Runs Metropolis sweeps on a replica. In each sweep, each atom
+    is displaced once, in random order, and the energy difference
+    is computed from the restraints of the displaced atom only, and
+    from the restraints to the center of mass, which moves along.
+
+    Parameters:
+        args (tuple): Coordinates, energy, temperature, step size,
+            number of sweeps and random seed of the replica.
+
+    Returns:
+        tuple: Final coordinates, final energy, acceptance rate,
+            and lowest-energy coordinates along with their energy.
+    """
+    coords, energy, temperature, step_size, n_sweeps, seed = args
+    neighbours, (center_atoms, center_mu, center_sigma) = _NEIGHBOURS
+    rng = np.random.RandomState(seed)
+    coords = np.copy(coords)
+    n_atoms = len(coords)
+    centroid = coords.mean(axis=0)
+    center_index = np.full(n_atoms, -1)
+    center_index[center_atoms] = np.arange(len(center_atoms))
+    best_coords, best_energy = np.copy(coords), energy
+    n_accepted = 0
+    for sweep in range(n_sweeps):
+        moves = rng.normal(0., step_size, size=(n_atoms, 3))
+        thresholds = np.log(rng.rand(n_atoms))
+        for i in rng.permutation(n_atoms):
+            others, mu, sigma = neighbours[i]
+            old = np.sqrt(((coords[others] - coords[i]) ** 2.).sum(axis=1))
+            new_position = coords[i] + moves[i]
+            new = np.sqrt(((coords[others] - new_position) ** 2.).sum(axis=1))
+            delta = 0.5 * ((((new - mu) / sigma) ** 2.).sum() - (((old - mu) / sigma) ** 2.).sum())
+            if len(center_atoms) > 0:
+                old_vectors = coords[center_atoms] - centroid
+                new_vectors = old_vectors - moves[i] / n_atoms
+                if center_index[i] >= 0:
+                    new_vectors[center_index[i]] += moves[i]
+                old = np.sqrt((old_vectors ** 2.).sum(axis=1))
+                new = np.sqrt((new_vectors ** 2.).sum(axis=1))
+                delta += 0.5 * ((((new - center_mu) / center_sigma) ** 2.).sum() -
+                                (((old - center_mu) / center_sigma) ** 2.).sum())
+            if -delta / temperature > thresholds[i]:
+                coords[i] = new_position
+                centroid += moves[i] / n_atoms
+                energy += delta
+                n_accepted += 1
+        if energy < best_energy:
+            best_coords, best_energy = np.copy(coords), energy
+    return coords, energy, n_accepted / float(n_sweeps * n_atoms), best_coords, best_energy
+
+
+class ReplicaExchange:
+    """Replica-exchange Monte Carlo (parallel tempering) sampler.
+
+    Replicas of the protein are sampled at increasing temperatures
+    with single-atom Metropolis moves, each replica in a worker process.
+    After each round of sweeps, configurations of neighbouring
+    temperatures are swapped according to the Metropolis criterion.
+    Energy is the negative log-likelihood of the Gaussian model.
+
+    Attributes:
+        n_replicas (int): Number of temperatures.
+        n_iter (int): Maximum number of rounds of sweeps.
+        n_sweeps (int): Number of sweeps between two rounds of swaps.
+        max_temperature (float): Temperature of the hottest replica.
+            Temperatures are spaced geometrically from 1.
+        step_size (float): Initial standard deviation of the moves.
+            Step sizes are adapted separately for each temperature.
+        init_std (float): Standard deviation of the noise added to
+            the initial solution to get the initial replicas.
+        early_stopping (int): Maximum number of rounds without
+            improvement of the lowest energy before stopping.
+        n_burnin (int): Number of rounds before collecting the ensemble.
+        use_lbfgs (bool): Whether to fine-tune the lowest-energy
+            solution with L-BFGS algorithm.
+        n_workers (int): Number of worker processes. Defaults to the
+            number of available cores, up to `n_replicas`.
+        random_state (int): Seed of the random number generators.
+        temperatures (:obj:`np.ndarray`): Temperature of each replica.
+        scores (list): History of best score over time.
+        pop (list): Configurations of the replicas at the end of the
+            last run, from the coldest to the hottest.
+        pop_scores (:obj:`np.ndarray`): Log-likelihood of the replicas.
+        ensemble (list): Configurations of the coldest replica
+            collected after each round, once burn-in is over.
+        ensemble_scores (:obj:`np.ndarray`): Log-likelihood of the
+            configurations in `ensemble`.
+        swap_rates (:obj:`np.ndarray`): Acceptance rate of the swaps
+            between each pair of neighbouring temperatures.
+    """
+
+    # Range of acceptance rates targeted by step size adaptation
+    MIN_ACCEPTANCE_RATE = 0.2
+    MAX_ACCEPTANCE_RATE = 0.5
+
+    def __init__(self, n_replicas=8, n_iter=200, n_sweeps=10, max_temperature=10.,
+                 step_size=0.5, init_std=1., early_stopping=50, n_burnin=20,
+                 use_lbfgs=False, n_workers=None, random_state=None):
+        self.n_replicas = n_replicas
+        self.n_iter = n_iter
+        self.n_sweeps = n_sweeps
+        self.max_temperature = max_temperature
+        self.step_size = step_size
+        self.init_std = init_std
+        self.early_stopping = early_stopping
+        self.n_burnin = n_burnin
+        self.use_lbfgs = use_lbfgs
+        self.n_workers = n_workers
+        self.random_state = random_state
+        self.temperatures = None
+        self.segments = list()
+        self.sse_segments = list()
+        self.continuation = None
+        self.scores = list()
+        self.pop = None
+        self.pop_scores = None
+        self.ensemble = list()
+        self.ensemble_scores = None
+        self.swap_rates = None
+
+    def run(self, model, verbose=True, pop=None, scores=None):
+        """Runs parallel tempering on the current coordinates of
+        a model, and sets the lowest-energy solution in the model.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model
+            verbose (bool): Whether to display messages in stdout.
+            pop (list, optional): Solutions to initialize the replicas
+                from, for example the `pop` attribute of a previous run.
+                Best solutions are assigned to the coldest replicas.
+            scores (:obj:`np.ndarray`, optional): Fitness of the
+                solutions in `pop`. Computed if not provided.
+
+        Returns:
+            :obj:`np.ndarray`: Optimal solution.
+        """
+        rng = np.random.RandomState(self.random_state)
+        K = self.n_replicas
+        if K > 1:
+            self.temperatures = self.max_temperature ** (np.arange(K) / float(K - 1))
+        else:
+            self.temperatures = np.ones(1)
+
+        # Initialize replicas
+        if pop is None:
+            initial_solution = model.get_coords()
+            replicas = [initial_solution] + [
+                initial_solution + rng.normal(0., self.init_std, size=initial_solution.shape)
+                for k in range(K - 1)]
+        else:
+            if scores is None:
+                scores = np.asarray([model.evaluate(ind) for ind in pop])
+            order = np.argsort(scores)[::-1]
+            replicas = [np.copy(pop[order[k % len(pop)]]) for k in range(K)]
+        energies = np.asarray([-model.evaluate(x) for x in replicas])
+        step_sizes = np.full(K, self.step_size)
+
+        best = np.argmin(energies)
+        best_coords, best_energy = np.copy(replicas[best]), energies[best]
+        best_iteration = 0
+        self.scores = list()
+        self.ensemble, ensemble_scores = list(), list()
+        n_swaps, n_swap_attempts = np.zeros(max(K - 1, 1)), np.zeros(max(K - 1, 1))
+
+        n_workers = self.n_workers
+        if n_workers is None:
+            n_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+                else (os.cpu_count() or 1)
+        n_workers = max(1, min(n_workers, K))
+        neighbours = _neighbours(model)
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers, initializer=_set_neighbours,
+                                        initargs=(neighbours,))
+            sample = pool.map
+        else:
+            pool = None
+            _set_neighbours(neighbours)
+            sample = lambda f, args: list(map(f, args))
+
+        try:
+            for k in range(self.n_iter):
+                # Sample all replicas
+                seeds = rng.randint(0, np.iinfo(np.int32).max, size=K)
+                results = sample(_sample, [
+                    (replicas[r], energies[r], self.temperatures[r], step_sizes[r],
+                     self.n_sweeps, seeds[r]) for r in range(K)])
+                for r, (coords, energy, acceptance_rate, coords_r, energy_r) in enumerate(results):
+                    replicas[r], energies[r] = coords, energy
+                    if energy_r < best_energy:
+                        best_coords, best_energy = coords_r, energy_r
+                        best_iteration = k
+
+                    # Adapt step size to the acceptance rate
+                    if acceptance_rate < ReplicaExchange.MIN_ACCEPTANCE_RATE:
+                        step_sizes[r] *= 0.8
+                    elif acceptance_rate > ReplicaExchange.MAX_ACCEPTANCE_RATE:
+                        step_sizes[r] *= 1.25
+
+                # Swap neighbouring replicas, alternating
+                # between even and odd pairs
+                for r in range(k % 2, K - 1, 2):
+                    beta_diff = 1. / self.temperatures[r] - 1. / self.temperatures[r + 1]
+                    log_ratio = beta_diff * (energies[r] - energies[r + 1])
+                    n_swap_attempts[r] += 1
+                    if np.log(rng.rand()) < log_ratio:
+                        replicas[r], replicas[r + 1] = replicas[r + 1], replicas[r]
+                        energies[r], energies[r + 1] = energies[r + 1], energies[r]
+                        n_swaps[r] += 1
+
+                # Collect the ensemble at the lowest temperature
+                if k >= self.n_burnin:
+                    self.ensemble.append(np.copy(replicas[0]))
+                    ensemble_scores.append(-energies[0])
+
+                self.scores.append(-best_energy)
+                if verbose and (k + 1) % 10 == 0:
+                    print('[ReplicaExchange] Log-likelihood at round %i: %f (coldest replica: %f)' \
+                        % (k + 1, -best_energy, -energies[0]))
+
+                # Stop algorithm if no more improvement
+                if k - best_iteration >= self.early_stopping:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.swap_rates = n_swaps / np.maximum(n_swap_attempts, 1)
+        if verbose:
+            print('[ReplicaExchange] Swap acceptance rates: %s' \
+                % ', '.join('%.2f' % rate for rate in self.swap_rates))
+        self.ensemble_scores = np.asarray(ensemble_scores)
+
+        # Fine-tune solution with L-BFGS
+        if self.use_lbfgs:
+            new_coords = lbfgs(best_coords, model, verbose=verbose)
+            if -model.evaluate(new_coords) < best_energy:
+                best_coords = new_coords
+
+        # Keep final replicas for warm restarts.
+        # Energies are recomputed to avoid accumulated rounding errors.
+        self.pop = replicas
+        self.pop_scores = np.asarray([model.evaluate(x) for x in replicas])
+
+        # Update coordinates in model
+        model.set_coords(best_coords)
+        return best_coords
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# smacof.py: Sparse weighted stress majorization
+# author : Antoine Passemiers
+
+from gaussfold.lbfgs import lbfgs
+
+import numpy as np
+
+
+def _laplacian_dot(X, rows, cols, weights, center=None):
+    """Computes V X, where V is the weighted Laplacian of the pairs
+    and of the restraints to the center of mass."""
+    delta = weights[:, np.newaxis] * (X[rows] - X[cols])
+    out = _accumulate(delta, rows, cols, len(X))
+    if center is not None:
+        atoms, _, center_weights = center
+        _accumulate_center(center_weights[:, np.newaxis] * _center_deltas(X, atoms), atoms, out)
+    return out
+
+
+def _accumulate(delta, rows, cols, n):
+    out = np.empty((n, delta.shape[1]), dtype=np.float64)
+    for k in range(delta.shape[1]):
+        out[:, k] = np.bincount(rows, weights=delta[:, k], minlength=n)
+        out[:, k] -= np.bincount(cols, weights=delta[:, k], minlength=n)
+    return out
+
+
+def _center_deltas(X, atoms):
+    return X[atoms] - X.mean(axis=0)
+
+
+def _accumulate_center(delta, atoms, out):
+    # The vector between atom i and the centroid is (e_i - 1 / n) X
+    out[atoms] += delta
+    out -= delta.sum(axis=0) / len(out)
+    return out
+
+
+def stress(X, rows, cols, mu, weights, center=None):
+    """Computes the weighted stress of a configuration.
+
+    Parameters:
+        X (:obj:`np.ndarray`): Array of shape (n, 3) of coordinates.
+        rows (:obj:`np.ndarray`): First point of each pair.
+        cols (:obj:`np.ndarray`): Second point of each pair.
+        mu (:obj:`np.ndarray`): Target distance of each pair.
+        weights (:obj:`np.ndarray`): Weight of each pair.
+        center (tuple, optional): Arrays `(atoms, mu, weights)` of
+            target distances between atoms and the center of mass.
+
+    Returns:
+        float: Sum over the pairs of w * (d - mu) ** 2.
+    """
+    distances = np.sqrt(((X[rows] - X[cols]) ** 2.).sum(axis=1))
+    value = np.sum(weights * (distances - mu) ** 2.)
+    if center is not None:
+        atoms, center_mu, center_weights = center
+        distances = np.sqrt((_center_deltas(X, atoms) ** 2.).sum(axis=1))
+        value += np.sum(center_weights * (distances - center_mu) ** 2.)
+    return value
+
+
+def sparse_smacof(X, rows, cols, mu, weights, n_iter=300, eps=1e-6,
+                  cg_iter=20, cg_tol=1e-8, center=None, verbose=False):
+    """Minimizes the weighted stress over a list of pairs with
+    the SMACOF algorithm. At each iteration, the stress is majorized
+    by a quadratic function, whose minimizer is given by the Guttman
+    transform V X = B(Z) Z. The linear system is solved approximately
+    by conjugate gradient, warm-started from the current configuration.
+    Both V and B(Z) are applied matrix-free, in O(n_pairs) operations.
+    Distances to the center of mass are linear in the coordinates
+    as well, and are majorized the same way.
+
+    Parameters:
+        X (:obj:`np.ndarray`): Array of shape (n, 3) of initial coordinates.
+        rows (:obj:`np.ndarray`): First point of each pair.
+        cols (:obj:`np.ndarray`): Second point of each pair.
+        mu (:obj:`np.ndarray`): Target distance of each pair.
+        weights (:obj:`np.ndarray`): Non-negative weight of each pair.
+        n_iter (int): Maximum number of majorization steps.
+        eps (float): Relative decrease of stress under which
+            the algorithm stops.
+        cg_iter (int): Maximum number of conjugate gradient
+            iterations per Guttman transform.
+        cg_tol (float): Relative residual under which conjugate
+            gradient stops.
+        center (tuple, optional): Arrays `(atoms, mu, weights)` of
+            target distances between atoms and the center of mass.
+        verbose (bool): Whether to display messages in stdout.
+
+    Returns:
+        tuple: Array of shape (n, 3) of optimized coordinates,
+            and history of the stress.
+    """
+    X = np.array(X, dtype=np.float64)
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    mu = np.asarray(mu, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(X)
+    if center is not None:
+        atoms, center_mu, center_weights = center
+        center = (np.asarray(atoms), np.asarray(center_mu, dtype=np.float64),
+                  np.asarray(center_weights, dtype=np.float64))
+
+    history = [stress(X, rows, cols, mu, weights, center=center)]
+    for k in range(n_iter):
+        # Right-hand side of the Guttman transform: B(Z) Z
+        delta = X[rows] - X[cols]
+        distances = np.sqrt((delta ** 2.).sum(axis=1))
+        s = np.zeros_like(distances)
+        nonzero = (distances > 0)
+        s[nonzero] = weights[nonzero] * mu[nonzero] / distances[nonzero]
+        rhs = _accumulate(s[:, np.newaxis] * delta, rows, cols, n)
+        if center is not None:
+            atoms, center_mu, center_weights = center
+            delta = _center_deltas(X, atoms)
+            distances = np.sqrt((delta ** 2.).sum(axis=1))
+            s = np.zeros_like(distances)
+            nonzero = (distances > 0)
+            s[nonzero] = center_weights[nonzero] * center_mu[nonzero] / distances[nonzero]
+            _accumulate_center(s[:, np.newaxis] * delta, atoms, rhs)
+
+        # Conjugate gradient on V X = B(Z) Z, one scalar
+        # step per coordinate axis
+        residual = rhs - _laplacian_dot(X, rows, cols, weights, center=center)
+        direction = np.copy(residual)
+        rr = (residual ** 2.).sum(axis=0)
+        threshold = cg_tol ** 2. * max((rhs ** 2.).sum(), 1e-300)
+        for i in range(cg_iter):
+            if rr.sum() <= threshold:
+                break
+            Vd = _laplacian_dot(direction, rows, cols, weights, center=center)
+            dVd = (direction * Vd).sum(axis=0)
+            alpha = np.where(dVd > 0, rr / np.maximum(dVd, 1e-300), 0.)
+            X += alpha * direction
+            residual -= alpha * Vd
+            new_rr = (residual ** 2.).sum(axis=0)
+            beta = np.where(rr > 0, new_rr / np.maximum(rr, 1e-300), 0.)
+            direction = residual + beta * direction
+            rr = new_rr
+
+        history.append(stress(X, rows, cols, mu, weights, center=center))
+        if verbose and (k + 1) % 10 == 0:
+            print('[SMACOF] Stress at iteration %i: %f' % (k + 1, history[-1]))
+        if history[-2] - history[-1] <= eps * history[-2]:
+            break
+    return X, history
+
+
+class StressMajorization:
+    """Optimizer of Gaussian models based on stress majorization.
+
+    Since the negative log-likelihood of the Gaussian model is
+    0.5 * sum w_ij (d_ij - mu_ij) ** 2 / sigma_ij ** 2, it is exactly
+    half of the weighted stress with weights w_ij / sigma_ij ** 2,
+    restricted to the restrained pairs and to the distances between
+    atoms and the center of mass. SMACOF decreases this stress
+    monotonically (up to the accuracy of the conjugate gradient solver).
+
+    Attributes:
+        n_iter (int): Maximum number of majorization steps.
+        eps (float): Relative decrease of stress under which
+            the algorithm stops.
+        cg_iter (int): Maximum number of conjugate gradient
+            iterations per step.
+        cg_tol (float): Relative residual under which conjugate
+            gradient stops.
+        use_lbfgs (bool): Whether to improve local convergence
+            with L-BFGS algorithm.
+        scores (list): Log-likelihood after each step.
+        pop (list): Solution found during the last run.
+        pop_scores (:obj:`np.ndarray`): Fitness of the solution in `pop`.
+    """
+
+    def __init__(self, n_iter=1000, eps=1e-7, cg_iter=20, cg_tol=1e-8,
+                 use_lbfgs=False):
+        self.n_iter = n_iter
+        self.eps = eps
+        self.cg_iter = cg_iter
+        self.cg_tol = cg_tol
+        self.use_lbfgs = use_lbfgs
+        self.segments = list()
+        self.sse_segments = list()
+        self.continuation = None
+        self.scores = list()
+        self.pop = None
+        self.pop_scores = None
+
+    def run(self, model, verbose=True, pop=None, scores=None):
+        """Runs stress majorization on the current coordinates of a model.
+
+        Parameters:
+            model (:obj:`gaussfold.Model`): Gaussian model
+            verbose (bool): Whether to display messages in stdout.
+            pop (list, optional): Solutions to start from, for example
+                the `pop` attribute of a previous run. Optimization
+                starts from the best one.
+            scores (:obj:`np.ndarray`, optional): Fitness of the
+                solutions in `pop`. Computed if not provided.
+
+        Returns:
+            :obj:`np.ndarray`: Optimal solution.
+        """
+        if pop is None:
+            x = model.get_coords()
+        else:
+            if scores is None:
+                scores = np.asarray([model.evaluate(ind) for ind in pop])
+            x = np.copy(pop[np.argmax(scores)])
+
+        rows, cols, mu, sigma, weights = model.pair_list()
+        weights = weights.astype(np.float64) / sigma.astype(np.float64) ** 2.
+        atoms, center_mu, center_sigma, center_weights = model.center_list()
+        center_weights = center_weights.astype(np.float64) / center_sigma.astype(np.float64) ** 2.
+        x, history = sparse_smacof(
+                x, rows, cols, mu, weights, n_iter=self.n_iter, eps=self.eps,
+                cg_iter=self.cg_iter, cg_tol=self.cg_tol,
+                center=(atoms, center_mu, center_weights), verbose=verbose)
+        self.scores = [-0.5 * value for value in history]
+        score = model.evaluate(x)
+
+        # Fine-tune solution with L-BFGS
+        if self.use_lbfgs:
+            new_coords = lbfgs(x, model, verbose=verbose)
+            new_score = model.evaluate(new_coords)
+            if new_score > score:
+                x, score = new_coords, new_score
+
+        self.pop, self.pop_scores = [x], np.asarray([score])
+
+        # Update coordinates in model
+        model.set_coords(x)
+        return x
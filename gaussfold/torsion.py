@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# torsion.py: Internal-coordinate parameterization of the C-alpha trace
+# author : Antoine Passemiers
+
+from gaussfold.corrector import DeviationCorrector
+from gaussfold.geometry import kabsch
+
+import numpy as np
+
+
+def internal_coordinates(coords):
+    """Computes pseudo bond angles and pseudo torsion angles
+    of a C-alpha trace.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (L, 3) representing
+            the coordinates of the residues, in sequence order.
+
+    Returns:
+        tuple: Arrays of shape (L - 2,) of bond angles and torsion angles.
+            Angle j is the bond angle at residue j + 1 and the torsion
+            angle around the bond between residues j and j + 1.
+            The first torsion angle is not defined and is set to zero.
+    """
+    bonds = np.diff(coords, axis=0)
+    bonds /= np.linalg.norm(bonds, axis=1)[:, np.newaxis]
+    theta = np.arccos(np.clip(-(bonds[:-1] * bonds[1:]).sum(axis=1), -1., 1.))
+
+    # Torsion angles of the successive triplets of bonds
+    b1, b2, b3 = bonds[:-2], bonds[1:-1], bonds[2:]
+    n1, n2 = np.cross(b1, b2), np.cross(b2, b3)
+    x = (n1 * n2).sum(axis=1)
+    y = (np.cross(n1, n2) * b2).sum(axis=1)
+    phi = np.zeros(len(theta))
+    phi[1:] = np.arctan2(y, x)
+    return theta, phi
+
+
+def _rotations(theta, phi):
+    """Rotation from the frame of a bond to the frame of the next one."""
+    ct, st = np.cos(theta), np.sin(theta)
+    cp, sp = np.cos(phi), np.sin(phi)
+    R = np.empty(theta.shape + (3, 3), dtype=np.float64)
+    R[..., 0, 0], R[..., 0, 1], R[..., 0, 2] = -ct, -st, 0.
+    R[..., 1, 0], R[..., 1, 1], R[..., 1, 2] = cp * st, -cp * ct, -sp
+    R[..., 2, 0], R[..., 2, 1], R[..., 2, 2] = sp * st, -sp * ct, cp
+    return R
+
+
+def nerf(theta, phi, bond_length=DeviationCorrector.CA_CA_DISTANCE, return_frames=False):
+    """Builds C-alpha traces from internal coordinates, with fixed
+    virtual bond lengths. The frame of each bond is the product of the
+    rotations of all previous residues. These prefix products are
+    computed with a parallel scan, in a logarithmic number of
+    vectorized matrix products.
+
+    Parameters:
+        theta (:obj:`np.ndarray`): Array of shape (..., L - 2)
+            of bond angles, in radians.
+        phi (:obj:`np.ndarray`): Array of shape (..., L - 2)
+            of torsion angles, in radians.
+        bond_length (float): Distance between consecutive residues.
+        return_frames (bool): Whether to return the frames of the bonds.
+
+    Returns:
+        :obj:`np.ndarray`: Array of shape (..., L, 3) of coordinates.
+            The first residue is located at the origin and the first
+            bond is aligned with the x-axis. If `return_frames` is true,
+            the array of shape (..., L - 1, 3, 3) of bond frames is
+            returned as well.
+    """
+    theta, phi = np.asarray(theta, dtype=np.float64), np.asarray(phi, dtype=np.float64)
+    R = _rotations(theta, phi)
+
+    # Inclusive prefix products R_1 R_2 ... R_j
+    shift = 1
+    while shift < R.shape[-3]:
+        R = np.concatenate((R[..., :shift, :, :],
+                            np.matmul(R[..., :-shift, :, :], R[..., shift:, :, :])), axis=-3)
+        shift *= 2
+    identity = np.broadcast_to(np.eye(3), theta.shape[:-1] + (1, 3, 3))
+    frames = np.concatenate((identity, R), axis=-3)
+
+    bonds = bond_length * frames[..., :, 0]
+    coords = np.zeros(theta.shape[:-1] + (theta.shape[-1] + 2, 3), dtype=np.float64)
+    np.cumsum(bonds, axis=-2, out=coords[..., 1:, :])
+    if return_frames:
+        return coords, frames
+    return coords
+
+
+def nerf_gradient(coords, frames, grad):
+    """Back-propagates a gradient with respect to the coordinates
+    of a C-alpha trace built by `nerf` to its internal coordinates.
+    Changing the angles of residue j rotates all the following residues
+    as a rigid body around residue j: the derivative is the projection
+    of the torque of the downstream gradients on the rotation axis.
+
+    Parameters:
+        coords (:obj:`np.ndarray`): Array of shape (L, 3) returned by `nerf`.
+        frames (:obj:`np.ndarray`): Array of shape (L - 1, 3, 3)
+            returned by `nerf`.
+        grad (:obj:`np.ndarray`): Array of shape (L, 3) of derivatives
+            with respect to the coordinates.
+
+    Returns:
+        tuple: Arrays of shape (L - 2,) of derivatives with respect to
+            the bond angles and to the torsion angles.
+    """
+    # Suffix sums of the gradients and of their moments,
+    # over residues k > j
+    g_sums = np.cumsum(grad[::-1], axis=0)[::-1]
+    m_sums = np.cumsum(np.cross(coords, grad)[::-1], axis=0)[::-1]
+    g_sums, m_sums = g_sums[2:], m_sums[2:]
+    torques = m_sums - np.cross(coords[1:-1], g_sums)
+
+    # Torsion j rotates around the bond (j, j + 1), bond angle j
+    # rotates around the normal of the plane of bonds j and j + 1
+    torsion_axes = frames[:-1, :, 0]
+    bending_axes = frames[1:, :, 2]
+    d_theta = -(bending_axes * torques).sum(axis=1)
+    d_phi = (torsion_axes * torques).sum(axis=1)
+    return d_theta, d_phi
+
+
+class TorsionModel:
+    """Gaussian model parameterized by the internal coordinates of the
+    C-alpha trace, with fixed virtual bond lengths. It exposes the
+    interface of `AminoAcidModel` used by `Optimizer` and `lbfgs`, so
+    that they can search the reduced space directly. Hessian-vector
+    products and the compiled list of restrained pairs are not
+    available in this space.
+
+    Solutions are arrays of shape (L - 2 + n_extra, 3): row j contains
+    the bond angle and the torsion angle of residue j + 1 (the last
+    column is unused), and the remaining rows contain the coordinates
+    of the atoms of the model that are not residues of the chain, if any.
+
+    Bond angles are clipped to [`MIN_BOND_ANGLE`, `MAX_BOND_ANGLE`] when
+    solutions are decoded, so that residues i and i + 2 never overlap,
+    and torsion angles are wrapped to [-pi, pi).
+
+    Attributes:
+        model (:obj:`gaussfold.AminoAcidModel`): Cartesian model.
+        backbone (:obj:`np.ndarray`): Indices, in the coordinates of
+            the model, of the residues in sequence order.
+        extra (:obj:`np.ndarray`): Indices of the other atoms.
+    """
+
+    # Residues i and i + 2 are at least one C-alpha - C-alpha
+    # distance apart
+    MIN_BOND_ANGLE = np.pi / 3.
+    MAX_BOND_ANGLE = np.radians(175.)
+
+    def __init__(self, model, backbone):
+        self.model = model
+        self.backbone = np.asarray(backbone)
+        assert(len(self.backbone) >= 3)
+        self.extra = np.setdiff1d(np.arange(model.n_atoms), self.backbone)
+
+    def encode(self, coords):
+        """Converts Cartesian coordinates of the model to a solution.
+
+        Parameters:
+            coords (:obj:`np.ndarray`): Array of shape (n_atoms, 3).
+
+        Returns:
+            :obj:`np.ndarray`: Solution in internal coordinates.
+        """
+        trace = coords[self.backbone]
+        theta, phi = internal_coordinates(trace)
+        n_angles = len(theta)
+        x = np.zeros((n_angles + len(self.extra), 3), dtype=np.float64)
+        x[:n_angles, 0], x[:n_angles, 1] = theta, phi
+
+        # Bring the other atoms into the frame of the rebuilt chain
+        R, t = kabsch(nerf(theta, phi), trace)
+        x[n_angles:] = np.dot(coords[self.extra] - t, R.T)
+        return x
+
+    def decode(self, x, return_frames=False):
+        """Converts solutions to Cartesian coordinates of the model.
+
+        Parameters:
+            x (:obj:`np.ndarray`): Solution, or array of shape
+                (n_solutions, L - 2 + n_extra, 3).
+            return_frames (bool): Whether to return the bond frames.
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (..., n_atoms, 3).
+        """
+        x = np.asarray(x)
+        n_angles = self.n_angles
+        theta, phi = self.angles(x)
+        trace, frames = nerf(theta, phi, return_frames=True)
+        coords = np.empty(x.shape[:-2] + (self.model.n_atoms, 3), dtype=np.float64)
+        coords[..., self.backbone, :] = trace
+        coords[..., self.extra, :] = x[..., n_angles:, :]
+        if return_frames:
+            return coords, trace, frames
+        return coords
+
+    def angles(self, x):
+        """Extracts the valid bond angles and torsion angles of solutions.
+
+        Parameters:
+            x (:obj:`np.ndarray`): Solution, or array of shape
+                (n_solutions, L - 2 + n_extra, 3).
+
+        Returns:
+            tuple: Arrays of shape (..., L - 2) of bond angles, clipped
+                to [`MIN_BOND_ANGLE`, `MAX_BOND_ANGLE`], and of torsion
+                angles, wrapped to [-pi, pi).
+        """
+        n_angles = self.n_angles
+        theta = np.clip(x[..., :n_angles, 0], TorsionModel.MIN_BOND_ANGLE, TorsionModel.MAX_BOND_ANGLE)
+        phi = np.mod(x[..., :n_angles, 1] + np.pi, 2. * np.pi) - np.pi
+        return theta, phi
+
+    def get_coords(self):
+        return self.encode(self.model.get_coords())
+
+    def set_coords(self, x):
+        self.model.set_coords(self.decode(x))
+
+    def evaluate(self, x):
+        return self.model.evaluate(self.decode(x))
+
+    def evaluate_batch(self, x):
+        return self.model.evaluate_batch(self.decode(x))
+
+    def gradient(self, x):
+        """Computes gradient of negative log-likelihood with respect
+        to the internal coordinates.
+
+        Parameters:
+            x (:obj:`np.ndarray`): Solution in internal coordinates.
+
+        Returns:
+            :obj:`np.ndarray`: Gradient, with the shape of `x`.
+        """
+        coords, trace, frames = self.decode(x, return_frames=True)
+        grad = self.model.gradient(coords)
+        d_theta, d_phi = nerf_gradient(trace, frames, grad[self.backbone])
+        n_angles = len(d_theta)
+
+        # Clipped bond angles do not move the chain
+        theta = x[:n_angles, 0]
+        d_theta[(theta < TorsionModel.MIN_BOND_ANGLE) | (theta > TorsionModel.MAX_BOND_ANGLE)] = 0.
+        out = np.zeros_like(x)
+        out[:n_angles, 0], out[:n_angles, 1] = d_theta, d_phi
+        out[n_angles:] = grad[self.extra]
+        return out
+
+    def residue_energies(self, x):
+        """Computes the restraint energy of each row of a solution.
+        The angles of row j are assigned the energy of residue j + 1,
+        around which they rotate the rest of the chain.
+
+        Parameters:
+            x (:obj:`np.ndarray`): Solution in internal coordinates.
+
+        Returns:
+            :obj:`np.ndarray`: Array of shape (L - 2 + n_extra,).
+        """
+        energies = self.model.residue_energies(self.decode(x))
+        return np.concatenate((energies[self.backbone[1:-1]], energies[self.extra]))
+
+    def set_surrogate(self, *args, **kwargs):
+        self.model.set_surrogate(*args, **kwargs)
+
+    def evaluate_surrogate(self, x):
+        return self.model.evaluate_surrogate(self.decode(x))
+
+    def update_constraints(self, *args, **kwargs):
+        self.model.update_constraints(*args, **kwargs)
+
+    @property
+    def sigma_scale(self):
+        return self.model.sigma_scale
+
+    @sigma_scale.setter
+    def sigma_scale(self, sigma_scale):
+        self.model.sigma_scale = sigma_scale
+
+    @property
+    def n_angles(self):
+        return len(self.backbone) - 2
+
+    @property
+    def n_atoms(self):
+        return self.n_angles + len(self.extra)
@@ -13,4 +13,5 @@ setup(
     author='Antoine Passemiers',
     author_email='apassemi@ulb.ac.be',
     packages=['gaussfold', 'gaussfold.model', 'gaussfold.aa', 'gaussfold.atom', 'gaussfold.chain',
-              'gaussfold.constraints'])
+              'gaussfold.constraints'],
+    extras_require={'numba': ['numba']})
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# test_autoconfig.py: Resource-aware choice of hyper-parameters
+# author : Antoine Passemiers
+
+from gaussfold.atom import DummyAtom
+from gaussfold.autoconfig import AutoConfig
+from gaussfold.constraints import DistanceRestraint, Repulsion
+from gaussfold.model import AminoAcidModel
+
+import numpy as np
+
+
+def n_pairs(L):
+    return L * (L - 1) // 2
+
+
+def test_large_sparse_inputs_pick_sparse_mode():
+    config = AutoConfig(n_cpus=4, memory_limit=16e9)
+    L = 1000
+    n_informative = 10 * L
+
+    # Repulsions restrain all the other pairs
+    plan = config.plan(L, n_pairs(L), n_informative)
+    assert plan.mode == 'sparse'
+    assert plan.dtype == np.float32
+
+    # Pair lists holding the informative restraints only
+    plan = config.plan(L, n_informative)
+    assert plan.mode == 'sparse'
+
+
+def test_dense_inputs_pick_dense_mode():
+    config = AutoConfig(n_cpus=4, memory_limit=16e9)
+    plan = config.plan(300, n_pairs(300), n_pairs(300))
+    assert plan.mode == 'dense' and plan.dtype == np.float64
+    assert plan.batch_size == 1
+
+
+def test_dense_inputs_pick_tiled_mode_when_memory_is_short():
+    config = AutoConfig(n_cpus=4, memory_limit=1e8)
+    plan = config.plan(2000, n_pairs(2000), n_pairs(2000))
+    assert plan.mode == 'tiled'
+
+
+def test_small_sparse_inputs_are_evaluated_in_batches():
+    config = AutoConfig(n_cpus=1, memory_limit=16e9)
+    plan = config.plan(40, 200, 100)
+    assert plan.mode == 'sparse' and plan.batch_size > 1
+    assert plan.batch_size <= plan.pop_size // 4
+
+
+def test_informative_restraints_of_model():
+    L = 30
+    atoms = [DummyAtom('CA') for i in range(L)]
+    model = AminoAcidModel()
+    model.add_atoms(atoms)
+    for i in range(L):
+        for j in range(i):
+            if i == j + 1:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], 3.8, 0.1))
+            else:
+                model.add_constraint(Repulsion(atoms[i], atoms[j]))
+    model.initialize()
+    assert model.n_restraints == n_pairs(L)
+    assert model.n_informative_restraints == L - 1
+    assert AutoConfig(n_cpus=1, memory_limit=16e9).plan(
+        L, model.n_restraints, model.n_informative_restraints).mode == 'sparse'
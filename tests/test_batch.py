@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# test_batch.py: Evaluation and optimization of several models at once
+# author : Antoine Passemiers
+
+from gaussfold.atom import DummyAtom
+from gaussfold.batch import BatchModel, BatchOptimizer
+from gaussfold.constraints import DistanceRestraint, Interior, Repulsion
+from gaussfold.model import AminoAcidModel
+
+import numpy as np
+
+
+def random_coords(L, random_state):
+    rng = np.random.RandomState(random_state)
+    steps = rng.normal(0., 1., size=(L, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    return np.cumsum(steps, axis=0)
+
+
+def create_model(L, random_state):
+    # Restraints satisfied by a random C-alpha trace
+    native = random_coords(L, random_state)
+    atoms = [DummyAtom('CA') for i in range(L)]
+    model = AminoAcidModel()
+    model.add_atoms(atoms)
+    for i in range(L):
+        if i % 5 == 0:
+            model.add_constraint(Interior(atoms[i]))
+        for j in range(i):
+            d = np.linalg.norm(native[i] - native[j])
+            if i == j + 1:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], 3.8, 0.1))
+            elif d < 8.:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], d, 1.))
+            else:
+                model.add_constraint(Repulsion(atoms[i], atoms[j]))
+    model.initialize()
+    return model, native
+
+
+def test_batch_model_matches_models():
+    models = [create_model(L, k)[0] for k, L in enumerate([20, 33, 27])]
+    batch = BatchModel(models)
+    coords = [random_coords(model.n_atoms, 10 + k) for k, model in enumerate(models)]
+    padded = batch.pad(coords)
+    assert all(np.array_equal(x, y) for x, y in zip(batch.unpad(padded), coords))
+
+    expected = [model.evaluate(x) for model, x in zip(models, coords)]
+    assert np.allclose(batch.evaluate(padded), expected, rtol=1e-10)
+    solutions = np.stack([padded, 2. * padded], axis=1)
+    assert np.allclose(batch.evaluate(solutions)[:, 0], expected, rtol=1e-10)
+
+    grad = batch.gradient(padded)
+    for k, (model, x) in enumerate(zip(models, coords)):
+        assert np.allclose(grad[k, :len(x)], model.gradient(x))
+        assert np.allclose(grad[k, len(x):], 0.)
+
+
+def test_batch_optimizer_improves_all_models():
+    np.random.seed(0)
+    models, natives = zip(*[create_model(L, k) for k, L in enumerate([20, 33])])
+    batch = BatchModel(list(models))
+    rng = np.random.RandomState(1)
+    initial = batch.pad([x + rng.normal(0., 2., size=x.shape) for x in natives])
+    optimizer = BatchOptimizer(pop_size=50, n_iter=300, partition_size=5, init_std=1.)
+    best = optimizer.run(batch, initial, verbose=False)
+    assert np.all(batch.evaluate(best) > batch.evaluate(initial))
+    assert np.all(np.diff(np.asarray(optimizer.scores), axis=0) >= 0.)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# test_graph.py: Contact graphs and incremental refolding
+# author : Antoine Passemiers
+
+from gaussfold import GaussFold
+from gaussfold.chain.chain import Chain
+from gaussfold.constraints import DisulfideBond, DistanceRestraint, Repulsion
+from gaussfold.graph import Graph
+from gaussfold.model import AminoAcidModel
+
+import numpy as np
+
+
+L = 60
+
+
+def random_cmap(random_state):
+    rng = np.random.RandomState(random_state)
+    cmap = rng.rand(L, L)
+    cmap = (cmap + cmap.T) / 2.
+    np.fill_diagonal(cmap, 0)
+    return cmap
+
+
+def perturb(cmap, n_changes, random_state):
+    rng = np.random.RandomState(random_state)
+    cmap = np.copy(cmap)
+    for _ in range(n_changes):
+        i, j = rng.randint(0, L, size=2)
+        if i != j:
+            cmap[i, j] = cmap[j, i] = rng.rand()
+    return cmap
+
+
+def top_contacts(cmap, n_top, sep=1):
+    proba = cmap[np.triu_indices(L, -sep)]
+    proba.sort()
+    return cmap > proba[-n_top]
+
+
+def test_update_distances_matches_recomputation():
+    gf = GaussFold()
+    cmap = random_cmap(0)
+    A, gds, n_top = gf.contact_graph(cmap)
+    assert Graph(A).is_connected()
+
+    for random_state in range(5):
+        new_cmap = perturb(cmap, 100, random_state)
+        new_A = top_contacts(new_cmap, n_top)
+        G = Graph(new_A)
+        if not G.is_connected():
+            continue
+        changed = np.triu(new_A != A, k=1)
+        added = list(zip(*np.where(changed & new_A)))
+        removed = list(zip(*np.where(changed & ~new_A)))
+        assert len(added) > 0 and len(removed) > 0
+
+        expected = np.minimum(G.distances(), GaussFold.MAX_GRAPH_DISTANCE)
+        actual = G.update_distances(gds, added, removed,
+                                    max_distance=GaussFold.MAX_GRAPH_DISTANCE)
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_update_distances_without_clipping():
+    cmap = random_cmap(1)
+    A = top_contacts(cmap, L)
+    A[np.arange(L - 1), np.arange(1, L)] = A[np.arange(1, L), np.arange(L - 1)] = True
+    gds = Graph(A).distances()
+    new_A = np.copy(A)
+    new_A[0, L - 1] = new_A[L - 1, 0] = True
+    for i, j in zip(*np.where(np.triu(A, k=2))):
+        new_A[i, j] = new_A[j, i] = False
+        break
+    G = Graph(new_A)
+    changed = np.triu(new_A != A, k=1)
+    added = list(zip(*np.where(changed & new_A)))
+    removed = list(zip(*np.where(changed & ~new_A)))
+    np.testing.assert_array_equal(G.update_distances(gds, added, removed), G.distances())
+
+
+def disulfide_pairs(model, chain):
+    pairs = set()
+    for i in range(len(chain)):
+        for j in range(i):
+            for constraint in model.pair_constraints(chain[i].ref(), chain[j].ref()):
+                if isinstance(constraint, DisulfideBond):
+                    pairs.add((j, i))
+    return pairs
+
+
+def test_update_disulfide_bonds():
+    gf = GaussFold()
+    chain = Chain.from_string('ACAACAAACAACAA')
+    n = len(chain)
+    model = AminoAcidModel()
+    model.add_atoms([chain[i].ref() for i in range(n)])
+    for i in range(n):
+        for j in range(i):
+            model.add_constraint(Repulsion(chain[i].ref(), chain[j].ref()))
+
+    cmap = np.zeros((n, n))
+    cmap[1, 4] = cmap[4, 1] = cmap[8, 11] = cmap[11, 8] = 0.9
+    for constraint in gf.make_disulfide_bonds(cmap, chain):
+        model.add_constraint(constraint)
+    contact = DistanceRestraint(chain[1].ref(), chain[8].ref(), 6., 1.)
+    model.add_constraint(contact)
+    model.initialize()
+    assert disulfide_pairs(model, chain) == {(1, 4), (8, 11)}
+
+    # Cysteines 1 and 8 are now predicted to be bonded
+    new_cmap = np.copy(cmap)
+    new_cmap[1, 8] = new_cmap[8, 1] = 1.
+    added, removed = gf.update_disulfide_bonds(chain, model, new_cmap)
+    model.update_constraints(added=added, removed=removed)
+    assert disulfide_pairs(model, chain) == {(1, 8), (4, 11)}
+
+    # Contact restraint still takes precedence over the new bond
+    constraints = model.pair_constraints(chain[1].ref(), chain[8].ref())
+    assert constraints[-1] is contact
+
+    # Unchanged pairing leaves the model untouched
+    assert gf.update_disulfide_bonds(chain, model, new_cmap) == ([], [])
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# test_kernels.py: Kernels of the Gaussian model and their backends
+# author : Antoine Passemiers
+
+from gaussfold import kernels
+from gaussfold.atom import DummyAtom
+from gaussfold.constraints import DistanceRestraint, Repulsion
+from gaussfold.model import AminoAcidModel
+
+import pickle
+import pytest
+import numpy as np
+
+
+L = 40
+
+requires_numba = pytest.mark.skipif(
+        'numba' not in kernels.available_backends(), reason='numba is not installed')
+
+
+def tolerance(dtype):
+    return 1e-8 if dtype == np.float64 else 1e-4
+
+
+@pytest.fixture
+def backend():
+    previous = kernels.get_backend()
+    kernels.set_backend('numpy')
+    yield
+    kernels.set_backend(previous)
+
+
+def create_model(mode, dtype, weighted):
+    rng = np.random.RandomState(0)
+    atoms = [DummyAtom('CA') for i in range(L)]
+    model = AminoAcidModel(weighted=weighted, mode=mode, dtype=dtype)
+    model.add_atoms(atoms)
+    for i in range(L):
+        for j in range(i):
+            weight = rng.uniform(0.5, 2.) if weighted else 1.
+            if i == j + 1:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], 3.8, 0.1, weight=weight))
+            elif rng.rand() < 0.2:
+                model.add_constraint(DistanceRestraint(
+                    atoms[i], atoms[j], rng.uniform(4., 12.), rng.uniform(0.5, 2.), weight=weight))
+            else:
+                model.add_constraint(Repulsion(atoms[i], atoms[j], weight=weight))
+    model.initialize()
+    return model
+
+
+def random_coords(shape=()):
+    rng = np.random.RandomState(1)
+    steps = rng.normal(0., 1., size=shape + (L, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    return np.cumsum(steps, axis=-2)
+
+
+def random_restraints(n_restraints, weighted):
+    rng = np.random.RandomState(2)
+    rows = rng.randint(1, L, size=n_restraints)
+    cols = np.asarray([rng.randint(0, i) for i in rows], dtype=np.int64)
+    mu = rng.uniform(4., 12., size=n_restraints)
+    sigma = rng.uniform(0.5, 2., size=n_restraints)
+    weights = rng.uniform(0.5, 2., size=n_restraints) if weighted else None
+    return rows.astype(np.int64), cols, mu, sigma, weights
+
+
+def naive_energy(coords, rows, cols, mu, sigma, weights):
+    d = np.linalg.norm(coords[rows] - coords[cols], axis=1)
+    terms = ((d - mu) / sigma) ** 2
+    if weights is not None:
+        terms *= weights
+    return 0.5 * terms.sum()
+
+
+def numerical_gradient(f, coords, eps=1e-6):
+    grad = np.zeros_like(coords)
+    for i in range(coords.shape[0]):
+        for k in range(3):
+            x = np.copy(coords)
+            x[i, k] += eps
+            fp = f(x)
+            x[i, k] -= 2. * eps
+            grad[i, k] = (fp - f(x)) / (2. * eps)
+    return grad
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_restraint_energy(backend, weighted):
+    coords = random_coords()
+    rows, cols, mu, sigma, weights = random_restraints(200, weighted)
+    expected = naive_energy(coords, rows, cols, mu, sigma, weights)
+    actual = kernels.restraint_energy(coords, rows, cols, mu, sigma, weights=weights,
+                                      workspace=kernels.Workspace())
+    assert np.isclose(actual, expected, rtol=1e-10)
+
+
+def test_restraint_energy_batch(backend):
+    coords = random_coords((4,))
+    rows, cols, mu, sigma, weights = random_restraints(200, True)
+    workspace = kernels.Workspace()
+    expected = [naive_energy(x, rows, cols, mu, sigma, weights) for x in coords]
+    actual = kernels.restraint_energy(coords, rows, cols, mu, sigma, weights=weights, workspace=workspace)
+    assert np.allclose(actual, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_restraint_gradient(backend, weighted):
+    coords = random_coords()
+    rows, cols, mu, sigma, weights = random_restraints(200, weighted)
+    expected = numerical_gradient(
+            lambda x: naive_energy(x, rows, cols, mu, sigma, weights), coords)
+    actual = kernels.restraint_gradient(coords, rows, cols, mu, sigma, weights=weights,
+                                        workspace=kernels.Workspace())
+    assert np.allclose(actual, expected, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_dense_kernels_match_restraint_kernels(backend, weighted):
+    coords = random_coords()
+    rows, cols, mu, sigma, weights = random_restraints(200, weighted)
+    rows, index = np.unique(rows * L + cols, return_index=True)
+    rows, cols = rows // L, rows % L
+    mu, sigma = mu[index], sigma[index]
+    weights = None if weights is None else weights[index]
+    mu_matrix, sigma_matrix = np.full((L, L), np.nan), np.full((L, L), np.nan)
+    weights_matrix = np.ones((L, L))
+    for matrix, values in [(mu_matrix, mu), (sigma_matrix, sigma), (weights_matrix, weights)]:
+        if values is not None:
+            matrix[rows, cols] = matrix[cols, rows] = values
+    weights_matrix = None if weights is None else weights_matrix
+
+    workspace = kernels.Workspace()
+    energy = kernels.dense_energy(coords, mu_matrix, sigma_matrix, weights_matrix, workspace=workspace)
+    assert np.isclose(energy, kernels.restraint_energy(coords, rows, cols, mu, sigma, weights))
+    grad = kernels.dense_gradient(coords, mu_matrix, sigma_matrix, weights_matrix, workspace=workspace)
+    assert np.allclose(grad, kernels.restraint_gradient(coords, rows, cols, mu, sigma, weights))
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_dense_and_sparse_modes_agree(backend, dtype):
+    coords = random_coords()
+    dense, sparse = create_model('dense', dtype, True), create_model('sparse', dtype, True)
+    assert np.isclose(dense.evaluate(coords), sparse.evaluate(coords), rtol=tolerance(dtype))
+    expected = dense.gradient(coords)
+    assert np.allclose(sparse.gradient(coords), expected,
+                       atol=tolerance(dtype) * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_evaluate_batch_matches_evaluate(backend, dtype):
+    coords = random_coords((5,))
+    model = create_model('sparse', dtype, False)
+    expected = np.asarray([model.evaluate(x) for x in coords])
+    assert np.allclose(model.evaluate_batch(coords), expected, rtol=tolerance(dtype))
+
+
+def test_workspace_buffers_are_reused():
+    workspace = kernels.Workspace()
+    a = workspace.buffer('a', (4, 5))
+    assert a.shape == (4, 5) and a.dtype == np.float64 and a.flags['C_CONTIGUOUS']
+    assert np.shares_memory(a, workspace.buffer('a', (4, 5)))
+    assert not np.shares_memory(a, workspace.buffer('b', (4, 5)))
+    assert workspace.nbytes() == 2 * 4 * 5 * 8
+
+
+def test_workspace_buffers_are_keyed_by_name():
+    workspace = kernels.Workspace()
+    a = workspace.buffer('a', (10, 3))
+
+    # Smaller arrays and other types are views of the same buffer
+    b = workspace.buffer('a', (2, 3), np.float32)
+    assert b.shape == (2, 3) and b.dtype == np.float32
+    assert np.shares_memory(a, b)
+    c = workspace.buffer('a', (7,), np.bool_)
+    assert c.shape == (7,) and np.shares_memory(a, c)
+    assert workspace.nbytes() == 10 * 3 * 8
+
+
+def test_workspace_grows_to_the_largest_request():
+    workspace = kernels.Workspace()
+    for batch_size in [1, 7, 32, 5, 64, 3, 64, 17]:
+        x = workspace.buffer('batch', (batch_size, L, 3))
+        assert x.shape == (batch_size, L, 3)
+    assert workspace.nbytes() == 64 * L * 3 * 8
+
+
+def test_workspace_copies_start_empty():
+    workspace = kernels.Workspace()
+    workspace.buffer('a', (100,))
+    workspace.pairs = (np.arange(3),)
+    copy = pickle.loads(pickle.dumps(workspace))
+    assert copy.nbytes() == 0 and copy.pairs is None
+
+
+def test_model_workspace_is_bounded(backend):
+    model = create_model('sparse', np.float64, False)
+    coords = random_coords((64,))
+    model.evaluate_batch(coords)
+    nbytes = model._workspace.nbytes()
+    for batch_size in [1, 7, 32, 5, 3, 17]:
+        model.evaluate_batch(coords[:batch_size])
+    assert model._workspace.nbytes() == nbytes
+
+
+def compare_backends(f, mode, dtype, weighted):
+    model = create_model(mode, dtype, weighted)
+    results = list()
+    for name in ['numpy', 'numba']:
+        kernels.set_backend(name)
+        results.append(f(model))
+    expected, actual = results
+    scale = np.max(np.abs(expected))
+    assert np.max(np.abs(actual - expected)) <= tolerance(dtype) * scale
+
+
+@requires_numba
+@pytest.mark.parametrize('mode', ['dense', 'sparse'])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_backends_evaluate(backend, mode, dtype, weighted):
+    coords = random_coords()
+    compare_backends(lambda model: model.evaluate(coords), mode, dtype, weighted)
+
+
+@requires_numba
+@pytest.mark.parametrize('mode', ['dense', 'sparse'])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_backends_gradient(backend, mode, dtype, weighted):
+    coords = random_coords()
+    compare_backends(lambda model: model.gradient(coords), mode, dtype, weighted)
+
+
+@requires_numba
+@pytest.mark.parametrize('mode', ['dense', 'sparse'])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_backends_evaluate_batch(backend, mode, dtype):
+    coords = random_coords((5,))
+    compare_backends(lambda model: model.evaluate_batch(coords), mode, dtype, False)
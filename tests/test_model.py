@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# test_model.py: Evaluation modes of the Gaussian model
+# author : Antoine Passemiers
+
+from gaussfold import kernels
+from gaussfold.atom import DummyAtom
+from gaussfold.constraints import DistanceRestraint, Interior, Repulsion
+from gaussfold.model import AminoAcidModel
+
+import pytest
+import numpy as np
+
+
+L = 70
+
+
+@pytest.fixture
+def backend():
+    previous = kernels.get_backend()
+    kernels.set_backend('numpy')
+    yield
+    kernels.set_backend(previous)
+
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    # Several blocks of pairs, including partial ones
+    monkeypatch.setattr(AminoAcidModel, 'TILE_SIZE', 16)
+
+
+def create_model(mode, repulsion_rate, random_state=0):
+    rng = np.random.RandomState(random_state)
+    atoms = [DummyAtom('CA') for i in range(L)]
+    model = AminoAcidModel(mode=mode)
+    model.add_atoms(atoms)
+    for i in range(L):
+        if rng.rand() < 0.2:
+            model.add_constraint(Interior(atoms[i]))
+        for j in range(i):
+            if i == j + 1:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], 3.8, 0.1))
+            elif rng.rand() < 0.1:
+                model.add_constraint(DistanceRestraint(
+                    atoms[i], atoms[j], rng.uniform(4., 12.), rng.uniform(0.5, 2.)))
+            elif rng.rand() < repulsion_rate:
+                model.add_constraint(Repulsion(atoms[i], atoms[j]))
+    model.initialize()
+    return model
+
+
+def random_coords(random_state=1):
+    rng = np.random.RandomState(random_state)
+    steps = rng.normal(0., 1., size=(L, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    return np.cumsum(steps, axis=0)
+
+
+@pytest.mark.parametrize('repulsion_rate', [0., 0.5, 1.])
+@pytest.mark.parametrize('sigma_scale', [1., 2.])
+def test_dense_and_tiled_modes_agree(backend, small_tiles, repulsion_rate, sigma_scale):
+    coords = random_coords()
+    dense, tiled = create_model('dense', repulsion_rate), create_model('tiled', repulsion_rate)
+    dense.sigma_scale = tiled.sigma_scale = sigma_scale
+    assert np.isclose(tiled.evaluate(coords), dense.evaluate(coords), rtol=1e-10)
+    expected = dense.gradient(coords)
+    assert np.allclose(tiled.gradient(coords), expected, atol=1e-10 * np.abs(expected).max())
+
+
+def test_tiled_mode_does_not_allocate_matrices(small_tiles):
+    model = create_model('tiled', 0.5)
+    assert model._mu is None and model._sigma is None and model._weights is None
+    n_stored = sum(len(tile[2]) for tile in model._tile_list)
+    assert n_stored == model.n_restraints
+
+
+@pytest.mark.parametrize('mode', ['sparse', 'tiled', 'octree'])
+def test_mode_can_be_changed_after_initialization(backend, mode):
+    coords = random_coords()
+    expected = create_model('dense', 0.5).evaluate(coords)
+    model = create_model('dense', 0.5)
+    model.mode = mode
+    rtol = 1e-2 if mode == 'octree' else 1e-10
+    assert np.isclose(model.evaluate(coords), expected, rtol=rtol)
+
+
+def test_update_constraints_in_tiled_mode(backend, small_tiles):
+    coords = random_coords()
+    models = [create_model('dense', 0.5), create_model('tiled', 0.5)]
+    for model in models:
+        atoms = model.atoms
+        model.update_constraints(
+                added=[DistanceRestraint(atoms[30], atoms[2], 6., 1.)],
+                removed=model.pair_constraints(atoms[1], atoms[0]))
+    dense, tiled = models
+    assert tiled.n_restraints == dense.n_restraints
+    assert np.isclose(tiled.evaluate(coords), dense.evaluate(coords), rtol=1e-10)
+    expected = dense.gradient(coords)
+    assert np.allclose(tiled.gradient(coords), expected, atol=1e-10 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('sigma_scale', [1., 2.])
+def test_hessian_vector_product(backend, sigma_scale):
+    coords = random_coords()
+    vector = np.random.RandomState(2).normal(size=coords.shape)
+    model = create_model('sparse', 0.5)
+    model.sigma_scale = sigma_scale
+    eps = 1e-6
+    expected = (model.gradient(coords + eps * vector) - model.gradient(coords - eps * vector)) / (2. * eps)
+    actual = model.hessian_vector_product(coords, vector)
+    assert np.allclose(actual, expected, atol=1e-5 * np.abs(expected).max())
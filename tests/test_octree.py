@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# test_octree.py: Barnes-Hut approximation of the sum of distances
+# author : Antoine Passemiers
+
+from gaussfold.octree import Octree
+
+import scipy.spatial
+import numpy as np
+
+
+def random_coords(n, random_state=0):
+    rng = np.random.RandomState(random_state)
+    steps = rng.normal(0., 1., size=(n, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    return np.cumsum(steps, axis=0)
+
+
+def exact_distance_sum(coords):
+    delta = coords[:, np.newaxis, :] - coords[np.newaxis, :, :]
+    D = np.sqrt((delta ** 2.).sum(axis=2))
+    np.fill_diagonal(D, 1.)
+    grad = (delta / D[..., np.newaxis]).sum(axis=1)
+    return scipy.spatial.distance.pdist(coords).sum(), grad
+
+
+def test_zero_opening_angle_is_exact():
+    coords = random_coords(300)
+    expected, expected_grad = exact_distance_sum(coords)
+    actual, grad = Octree(coords).distance_sum(opening_angle=0.)
+    assert np.isclose(actual, expected, rtol=1e-10)
+    assert np.allclose(grad, expected_grad, atol=1e-8)
+
+
+def test_approximation_error_decreases_with_opening_angle():
+    coords = random_coords(500)
+    expected, expected_grad = exact_distance_sum(coords)
+    errors = list()
+    for opening_angle in [1., 0.5, 0.25]:
+        actual, grad = Octree(coords).distance_sum(opening_angle=opening_angle, chunk_size=128)
+        errors.append(abs(actual - expected) / expected)
+        grad_error = np.abs(grad - expected_grad).max() / np.abs(expected_grad).max()
+        assert grad_error < 0.05
+    assert errors[1] < 1e-3
+    assert errors[2] <= errors[0]
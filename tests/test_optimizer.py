@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# test_optimizer.py: Genetic operators of the optimizer
+# author : Antoine Passemiers
+
+from gaussfold.adam import MinibatchAdam
+from gaussfold.atom import DummyAtom
+from gaussfold.constraints import DistanceRestraint, Interior, Repulsion
+from gaussfold.continuation import Continuation
+from gaussfold.differential_evolution import DifferentialEvolution
+from gaussfold.geometry import random_rotation
+from gaussfold.model import AminoAcidModel
+from gaussfold.optimizer import Optimizer
+from gaussfold.replica_exchange import ReplicaExchange
+from gaussfold.smacof import StressMajorization, sparse_smacof, stress
+
+import pytest
+import numpy as np
+
+
+L = 20
+
+
+def random_coords(random_state):
+    rng = np.random.RandomState(random_state)
+    steps = rng.normal(0., 1., size=(L, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    return np.cumsum(steps, axis=0)
+
+
+def test_segment_cross_over_keeps_short_segments_in_place():
+    np.random.seed(0)
+    left = random_coords(0)
+    R = random_rotation(2.)
+    right = np.dot(left, R) + np.asarray([50., -20., 10.])
+
+    optimizer = Optimizer()
+    optimizer.segments = [[0], [1, 2], list(range(3, 10)), [10, 11], list(range(12, L))]
+    for _ in range(20):
+        # Second parent is a rigid motion of the first one: every
+        # segment must be superposed back onto the first parent
+        child = optimizer.segment_cross_over(left, right)
+        assert np.allclose(child, left, atol=1e-8)
+
+
+def test_segment_cross_over_falls_back_to_first_parent():
+    np.random.seed(0)
+    left, right = random_coords(0)[:2], random_coords(1)[:2] + 100.
+    optimizer = Optimizer()
+    optimizer.segments = [[0, 1]]
+    for _ in range(10):
+        assert np.array_equal(optimizer.segment_cross_over(left, right), left)
+
+
+def create_model():
+    # Restraints satisfied by a random C-alpha trace, and
+    # a noisy version of the trace to start from
+    native = random_coords(0)
+    atoms = [DummyAtom('CA') for i in range(L)]
+    model = AminoAcidModel()
+    model.add_atoms(atoms)
+    contacts = list()
+    for i in range(L):
+        if i % 5 == 0:
+            model.add_constraint(Interior(atoms[i]))
+        for j in range(i):
+            d = np.linalg.norm(native[i] - native[j])
+            if i == j + 1:
+                model.add_constraint(DistanceRestraint(atoms[i], atoms[j], 3.8, 0.1))
+            elif d < 8.:
+                contacts.append([DistanceRestraint(atoms[i], atoms[j], d, 1.)])
+                model.add_constraint(contacts[-1][0])
+            else:
+                model.add_constraint(Repulsion(atoms[i], atoms[j]))
+    model.initialize()
+    initial = native + np.random.RandomState(1).normal(0., 2., size=native.shape)
+    model.set_coords(initial)
+    return model, initial, contacts
+
+
+@pytest.mark.parametrize('optimizer', [
+    Optimizer(pop_size=50, n_iter=300, partition_size=5, init_std=1.),
+    Optimizer(pop_size=50, n_iter=100, partition_size=5, init_std=1., batch_size=8),
+    DifferentialEvolution(pop_size=20, n_iter=50, random_state=0),
+    MinibatchAdam(n_iter=200, batch_size=50, n_polish=20, random_state=0),
+    ReplicaExchange(n_replicas=3, n_iter=10, n_sweeps=2, n_workers=1, random_state=0),
+    StressMajorization(n_iter=50)])
+def test_optimizers_improve_log_likelihood(optimizer):
+    np.random.seed(0)
+    model, initial, _ = create_model()
+    optimizer.segments = [np.arange(L)]
+    optimizer.run(model, verbose=False)
+    best = model.get_coords()
+    assert model.evaluate(best) > model.evaluate(initial)
+    assert np.isclose(np.max(optimizer.pop_scores), max(model.evaluate(x) for x in optimizer.pop))
+
+
+def test_sparse_smacof_decreases_stress():
+    model, initial, _ = create_model()
+    rows, cols, mu, sigma, weights = model.pair_list()
+    weights = weights / sigma ** 2.
+    X, history = sparse_smacof(initial, rows, cols, mu, weights, n_iter=30, eps=0.)
+    assert np.all(np.diff(history) <= 1e-6 * history[0])
+    assert np.isclose(stress(X, rows, cols, mu, weights), history[-1])
+
+
+def test_continuation_schedule():
+    continuation = Continuation(n_stages=4, sigma_scale=3., min_fraction=0.25)
+    continuation.set_contacts([[None]] * 10, np.linspace(0., 1., 10))
+    assert continuation.parameters(0) == (3., 3)
+    assert continuation.parameters(3) == (1., 10)
+    sigma_scales = [continuation.parameters(stage)[0] for stage in range(4)]
+    assert np.all(np.diff(sigma_scales) < 0)
+    assert Continuation(n_stages=1).parameters(0)[0] == 1.
+
+
+def test_continuation_restores_the_model():
+    model, initial, contacts = create_model()
+    n_restraints, expected = model.n_restraints, model.evaluate(initial)
+    continuation = Continuation(n_stages=3)
+    continuation.set_contacts(contacts, np.arange(len(contacts)))
+    continuation.apply(model, 0)
+    n_active = continuation.parameters(0)[1]
+    assert model.n_restraints == n_restraints - (len(contacts) - n_active)
+    assert model.sigma_scale == 3.
+
+    # Contacts with the highest probabilities are kept
+    kept = contacts[-1][0]
+    assert kept in model.pair_constraints(kept.atom_a, kept.atom_b)
+    continuation.apply(model, 2)
+    assert model.n_restraints == n_restraints
+    assert np.isclose(model.evaluate(initial), expected)
+
+
+def test_optimizer_restores_the_model_after_continuation():
+    np.random.seed(0)
+    model, initial, contacts = create_model()
+    n_restraints, expected = model.n_restraints, model.evaluate(initial)
+    optimizer = Optimizer(pop_size=30, n_iter=90, partition_size=5, init_std=1.,
+                          continuation=Continuation(n_stages=3))
+    optimizer.continuation.set_contacts(contacts, np.arange(len(contacts)))
+    optimizer.run(model, verbose=False)
+    best = model.get_coords()
+    assert model.n_restraints == n_restraints and model.sigma_scale == 1.
+    assert np.isclose(model.evaluate(initial), expected)
+    assert model.evaluate(best) > expected
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# test_portfolio.py: Multi-start racing of initial embeddings
+# author : Antoine Passemiers
+
+from gaussfold import GaussFold
+from gaussfold.chain.chain import Chain
+from gaussfold.continuation import Continuation
+from gaussfold.optimizer import Optimizer
+from gaussfold.portfolio import Portfolio
+
+import scipy.spatial
+import numpy as np
+
+
+L = 40
+
+# Continuations applied to the model, with their stage
+applied = list()
+
+
+class RecordingContinuation(Continuation):
+
+    def apply(self, model, stage):
+        applied.append((self, stage))
+        Continuation.apply(self, model, stage)
+
+
+def create_problem():
+    rng = np.random.RandomState(0)
+    steps = rng.normal(0., 1., size=(L, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1)[..., np.newaxis]
+    native = np.cumsum(steps, axis=0)
+    D = scipy.spatial.distance.cdist(native, native)
+    cmap = 1. / (1. + np.exp(D - 8.))
+    np.fill_diagonal(cmap, 0)
+    ssp, acc = np.full(L, 2), np.ones(L, dtype=int)
+
+    gf = GaussFold()
+    _, gds, _ = gf.contact_graph(cmap)
+    chain = Chain.from_string('A' * L, c='CA')
+    model = gf.create_model(chain, cmap, gds, ssp, acc, np.ones((L, L)))
+    return gf, chain, cmap, gds, ssp, model
+
+
+def test_configurations():
+    portfolio = Portfolio(n_starts=8, n_tops=(2., 3.), initializers=('mds', 'classical'),
+                          random_state=0)
+    configs = portfolio.configurations()
+    assert len(configs) == 8
+    assert {(n_top, initializer) for n_top, initializer, _ in configs[:4]} == \
+        {(2., 'mds'), (3., 'mds'), (2., 'classical'), (3., 'classical')}
+    assert all(initializer == 'mds' for _, initializer, _ in configs[4:])
+    assert configs == portfolio.configurations()
+
+
+def test_race_keeps_the_continuation_of_the_optimizer():
+    np.random.seed(0)
+    gf, chain, cmap, gds, ssp, model = create_problem()
+    optimizer = Optimizer(pop_size=20, n_iter=40, partition_size=4, init_std=1.,
+                          continuation=RecordingContinuation(n_stages=2))
+    optimizer.continuation.set_contacts(*gf.ranked_contacts(chain, model, cmap, gds, ssp))
+    continuation = optimizer.continuation
+    n_active, n_restraints = continuation._n_active, model.n_restraints
+
+    portfolio = Portfolio(n_starts=4, budget=10, n_tops=(2., 3.), random_state=0)
+    del applied[:]
+    pop, scores = portfolio.run(gf, chain, cmap, ssp, model, optimizer, verbose=False)
+    assert optimizer.continuation is continuation
+
+    # Racers use copies of the schedule, over the restraints of the model
+    assert len(applied) > 0
+    for racer_continuation, _ in applied:
+        assert racer_continuation is not continuation
+        assert all(a is b for group_a, group_b in zip(racer_continuation.contacts, continuation.contacts)
+                   for a, b in zip(group_a, group_b))
+    assert continuation._n_active == n_active
+    assert model.n_restraints == n_restraints and model.sigma_scale == 1.
+
+    # Winner is set in the model and its population can be resumed
+    assert len(pop) == 20 and np.isclose(np.max(scores), model.evaluate(model.get_coords()))
+    optimizer.run(model, verbose=False, pop=pop, scores=scores)
+    assert np.max(optimizer.pop_scores) >= np.max(scores)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# test_torsion.py: Internal coordinates of the C-alpha trace
+# author : Antoine Passemiers
+
+from gaussfold.atom import DummyAtom
+from gaussfold.constraints import DistanceRestraint, Interior, Repulsion
+from gaussfold.model import AminoAcidModel
+from gaussfold.torsion import TorsionModel, internal_coordinates, nerf, nerf_gradient
+
+import scipy.spatial
+import numpy as np
+
+
+L = 30
+
+
+def random_angles(shape=(), random_state=0):
+    rng = np.random.RandomState(random_state)
+    theta = rng.uniform(np.radians(80.), np.radians(150.), size=shape + (L - 2,))
+    phi = rng.uniform(-np.pi, np.pi, size=shape + (L - 2,))
+    return theta, phi
+
+
+def create_model():
+    # Residues in sequence order, followed by an atom
+    # that is not part of the chain
+    rng = np.random.RandomState(1)
+    atoms = [DummyAtom('CA') for i in range(L)]
+    extra = DummyAtom('CB')
+    model = AminoAcidModel()
+    model.add_atoms(atoms)
+    for i in range(L):
+        if i % 4 == 0:
+            model.add_constraint(Interior(atoms[i]))
+        for j in range(i):
+            if i - j > 3 and rng.rand() < 0.2:
+                model.add_constraint(DistanceRestraint(
+                    atoms[i], atoms[j], rng.uniform(4., 12.), rng.uniform(0.5, 2.)))
+            else:
+                model.add_constraint(Repulsion(atoms[i], atoms[j]))
+    model.add_constraint(DistanceRestraint(extra, atoms[5], 2.5, 0.5))
+    model.initialize()
+    return model
+
+
+def test_nerf_inverts_internal_coordinates():
+    theta, phi = random_angles()
+    coords = nerf(theta, phi)
+    assert np.allclose(np.linalg.norm(np.diff(coords, axis=0), axis=1), 3.8, atol=0.1)
+    theta_hat, phi_hat = internal_coordinates(coords)
+    assert np.allclose(theta_hat, theta)
+
+    # First torsion angle has no influence on the trace
+    assert np.allclose(np.cos(phi_hat[1:] - phi[1:]), 1.)
+
+
+def test_nerf_builds_batches():
+    theta, phi = random_angles((4,))
+    coords = nerf(theta, phi)
+    for k in range(4):
+        assert np.allclose(coords[k], nerf(theta[k], phi[k]))
+
+
+def test_nerf_gradient():
+    theta, phi = random_angles()
+    weights = np.random.RandomState(2).normal(size=(L, 3))
+    f = lambda theta, phi: (weights * nerf(theta, phi) ** 2.).sum()
+    coords, frames = nerf(theta, phi, return_frames=True)
+    d_theta, d_phi = nerf_gradient(coords, frames, 2. * weights * coords)
+
+    eps = 1e-6
+    for angles, derivatives in [(theta, d_theta), (phi, d_phi)]:
+        for j in range(L - 2):
+            angles[j] += eps
+            fp = f(theta, phi)
+            angles[j] -= 2. * eps
+            fm = f(theta, phi)
+            angles[j] += eps
+            assert np.isclose(derivatives[j], (fp - fm) / (2. * eps), rtol=1e-5, atol=1e-5)
+
+
+def test_torsion_model_gradient():
+    model = create_model()
+    target = TorsionModel(model, np.arange(L))
+    theta, phi = random_angles()
+    x = np.zeros((target.n_atoms, 3))
+    x[:L - 2, 0], x[:L - 2, 1] = theta, phi
+    x[L - 2:] = np.random.RandomState(3).normal(size=(1, 3))
+
+    # Encoding is defined up to a rigid motion of all atoms
+    coords = target.decode(x)
+    assert np.allclose(scipy.spatial.distance.pdist(target.decode(target.encode(coords))),
+                       scipy.spatial.distance.pdist(coords))
+
+    grad = target.gradient(x)
+    eps = 1e-6
+    for i in range(len(x)):
+        for k in range(2 if i < L - 2 else 3):
+            x[i, k] += eps
+            fp = -target.evaluate(x)
+            x[i, k] -= 2. * eps
+            fm = -target.evaluate(x)
+            x[i, k] += eps
+            assert np.isclose(grad[i, k], (fp - fm) / (2. * eps), rtol=1e-4, atol=1e-4)